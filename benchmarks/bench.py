@@ -0,0 +1,387 @@
+"""
+Benchmark the listing and transfer paths of sbackup offline.
+
+A moto server stands in for s3 and a fakeredis TCP server for redis (or
+the db given with --db-url), synthetic trees are generated from a fixed
+seed, and every case runs the real sbackup command with --metrics-file
+so that listed objects, transferred bytes and db and s3 operations are
+read from its own counters. Results are saved as JSON and two result
+files can be compared with --compare.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS = Path(__file__).resolve().parent / "results"
+SEED = 2023
+
+# name: (files, smallest size, largest size, directory depth) at scale 1
+DATASETS = {
+    "small": (2000, 1024, 8 * 1024, 2),
+    "huge": (3, 40 * 1024**2, 48 * 1024**2, 1),
+    "deep": (1000, 2 * 1024, 2 * 1024, 16),
+}
+
+CASES = ("list_local", "upload", "list_s3", "download", "copy_local")
+
+SAMPLE = re.compile(r"^(\w+)(?:\{(.*)\})? (\S+)$")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_tree(path, files, smallest, largest, depth, rng):
+    """Write <files> files of random content, <depth> directories deep."""
+
+    size = 0
+    for i in range(files):
+        parts = [f"d{(i >> (2 * level)) % 4}" for level in range(depth)]
+        folder = path.joinpath(*parts)
+        folder.mkdir(parents=True, exist_ok=True)
+        data = rng.randbytes(rng.randint(smallest, largest))
+        (folder / f"f{i:06}.bin").write_bytes(data)
+        size += len(data)
+    return size
+
+
+def read_metrics(path):
+    """Sum the samples of a Prometheus textfile by metric name."""
+
+    totals = {}
+    for line in Path(path).read_text().splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            name, _, value = match.groups()
+            totals[name] = totals.get(name, 0) + float(value)
+    return totals
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.tmp = Path(tempfile.mkdtemp(prefix="sbackup-bench-"))
+        self.env = dict(os.environ)
+        self.servers = []
+        self.results = []
+
+    def start(self):
+        from moto.server import ThreadedMotoServer
+
+        port = free_port()
+        moto = ThreadedMotoServer(
+            ip_address="127.0.0.1", port=port, verbose=False
+        )
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        moto.start()
+        self.servers.append(moto)
+        endpoint = f"http://127.0.0.1:{port}"
+        for prefix in ("SBACKUP_", "SBACKUP_DEST_"):
+            self.env[f"{prefix}AWS_ENDPOINT_URL"] = endpoint
+            self.env[f"{prefix}AWS_DEFAULT_REGION"] = "us-east-1"
+            self.env[f"{prefix}AWS_ACCESS_KEY_ID"] = "bench"
+            self.env[f"{prefix}AWS_SECRET_ACCESS_KEY"] = "bench"
+
+        import boto3
+
+        self.s3 = boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            region_name="us-east-1",
+            aws_access_key_id="bench",
+            aws_secret_access_key="bench",
+        )
+
+        db_url = self.args.db_url
+        if db_url is None:
+            import threading
+
+            from fakeredis import TcpFakeServer
+
+            port = free_port()
+            server = TcpFakeServer(("127.0.0.1", port))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+            db_url = f"redis://127.0.0.1:{port}"
+        elif db_url == "sqlite":
+            db_url = f"sqlite:///{self.tmp}/state.db"
+        self.env["SBACKUP_DB_URL"] = db_url
+        self.db_url = db_url
+        self.env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [str(ROOT), os.environ.get("PYTHONPATH")])
+        )
+
+    def stop(self):
+        for server in self.servers:
+            if hasattr(server, "stop"):
+                server.stop()
+            else:
+                server.shutdown()
+                server.server_close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def sbackup(self, *options):
+        """Run sbackup once and return its wall time and counters."""
+
+        metrics = self.tmp / "metrics.prom"
+        command = [
+            sys.executable,
+            "-m",
+            "safe_backup.safe_backup",
+            "--workers",
+            str(self.args.workers),
+            "--metrics-file",
+            str(metrics),
+            *options,
+        ]
+        start = time.perf_counter()
+        done = subprocess.run(
+            command, env=self.env, cwd=ROOT, capture_output=True, text=True
+        )
+        seconds = time.perf_counter() - start
+        if done.returncode:
+            raise RuntimeError(
+                f"{' '.join(command[3:])} failed:\n{done.stderr[-2000:]}"
+            )
+        return seconds, read_metrics(metrics), done.stdout
+
+    def startup(self):
+        """Time the interpreter and import alone, to be left out of rates."""
+
+        command = [sys.executable, "-c", "import safe_backup.safe_backup"]
+        runs = []
+        for _ in range(3):
+            start = time.perf_counter()
+            subprocess.run(command, env=self.env, cwd=ROOT, check=True)
+            runs.append(time.perf_counter() - start)
+        return min(runs)
+
+    def record(self, dataset, case, files, size, seconds, metrics):
+        net = max(seconds - self.startup_seconds, 1e-9)
+        db_ops = metrics.get("sbackup_db_operation_seconds_count", 0)
+        s3_requests = metrics.get("sbackup_s3_request_seconds_count", 0)
+        result = {
+            "dataset": dataset,
+            "case": case,
+            "files": files,
+            "bytes": size,
+            "seconds": round(seconds, 4),
+            "db_ops_per_file": round(db_ops / max(files, 1), 3),
+            "s3_requests_per_file": round(s3_requests / max(files, 1), 3),
+        }
+        if case.startswith("list"):
+            listed = metrics.get("sbackup_listed_objects_total", 0)
+            result["keys_per_second"] = round(listed / net, 1)
+        else:
+            moved = metrics.get("sbackup_transferred_bytes_total", 0)
+            result["mb_per_second"] = round(moved / net / 1024**2, 2)
+        self.results.append(result)
+        print(format_result(result), flush=True)
+
+    def run_dataset(self, name):
+        files, smallest, largest, depth = DATASETS[name]
+        if name == "huge":
+            smallest *= self.args.scale
+            largest *= self.args.scale
+        else:
+            files *= self.args.scale
+        files = max(int(files), 1)
+        rng = random.Random(f"{SEED}-{name}")
+        tree = self.tmp / name / "tree"
+        size = make_tree(tree, files, int(smallest), int(largest), depth, rng)
+        bucket = f"bench-{name}-{os.getpid()}"
+        self.s3.create_bucket(Bucket=bucket)
+
+        def listing(kind, address):
+            seconds, metrics, stdout = self.sbackup("-l", kind, address)
+            db_key = re.search(r"db_key = '([^']*)'", stdout)[1]
+            return seconds, metrics, db_key
+
+        cases = self.args.cases
+        seconds, metrics, db_key = listing("local", str(tree))
+        if "list_local" in cases:
+            self.record(name, "list_local", files, size, seconds, metrics)
+        if {"upload", "list_s3", "download"} & set(cases):
+            seconds, metrics, _ = self.sbackup("-d", db_key, f"s3:{bucket}")
+            if "upload" in cases:
+                self.record(name, "upload", files, size, seconds, metrics)
+            seconds, metrics, s3_key = listing("s3", bucket)
+            if "list_s3" in cases:
+                self.record(name, "list_s3", files, size, seconds, metrics)
+            if "download" in cases:
+                dest = self.tmp / name / "download"
+                dest.mkdir()
+                seconds, metrics, _ = self.sbackup("-d", s3_key, str(dest))
+                self.record(name, "download", files, size, seconds, metrics)
+                shutil.rmtree(dest)
+        if "copy_local" in cases:
+            _, _, db_key = listing("local", str(tree))
+            dest = self.tmp / name / "copy"
+            dest.mkdir()
+            seconds, metrics, _ = self.sbackup("-d", db_key, str(dest))
+            self.record(name, "copy_local", files, size, seconds, metrics)
+        shutil.rmtree(self.tmp / name)
+
+    def run(self):
+        self.start()
+        try:
+            self.startup_seconds = self.startup()
+            for name in self.args.datasets:
+                self.run_dataset(name)
+        finally:
+            self.stop()
+        return {
+            "version": version(self.env),
+            "commit": commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "db": self.db_url.split("://", 1)[0],
+            "scale": self.args.scale,
+            "workers": self.args.workers,
+            "startup_seconds": round(self.startup_seconds, 4),
+            "results": self.results,
+        }
+
+
+def version(env):
+    command = [
+        sys.executable,
+        "-c",
+        "from safe_backup import __version__; print(__version__)",
+    ]
+    done = subprocess.run(
+        command, env=env, cwd=ROOT, capture_output=True, text=True
+    )
+    return done.stdout.strip() or "unknown"
+
+
+def commit():
+    done = subprocess.run(
+        ["git", "-C", str(ROOT), "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+    )
+    return done.stdout.strip() or None
+
+
+def rate(result):
+    if "keys_per_second" in result:
+        return result["keys_per_second"], "keys/s"
+    return result["mb_per_second"], "MB/s"
+
+
+def format_result(result):
+    value, unit = rate(result)
+    return (
+        f" {result['dataset']:<6} {result['case']:<11} "
+        f"{result['files']:>7} files {value:>10} {unit:<6} "
+        f"{result['db_ops_per_file']:>7} db ops/file "
+        f"{result['s3_requests_per_file']:>7} s3 requests/file"
+    )
+
+
+def compare(old_path, new_path):
+    old = json.loads(Path(old_path).read_text())
+    new = json.loads(Path(new_path).read_text())
+    before = {(r["dataset"], r["case"]): r for r in old["results"]}
+    print(f" {old['version']} -> {new['version']}")
+    for result in new["results"]:
+        previous = before.get((result["dataset"], result["case"]))
+        if previous is None:
+            continue
+        (value, unit), (was, _) = rate(result), rate(previous)
+        change = (value / was - 1) * 100 if was else 0
+        ops = result["db_ops_per_file"] - previous["db_ops_per_file"]
+        print(
+            f" {result['dataset']:<6} {result['case']:<11} "
+            f"{was:>10} -> {value:>10} {unit:<6} ({change:+.1f}%) "
+            f"db ops/file {ops:+.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bench",
+        description="Benchmark sbackup listings and transfers offline.",
+    )
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        choices=DATASETS,
+        default=list(DATASETS),
+        help="Synthetic trees to run (default all)",
+    )
+    parser.add_argument(
+        "--cases",
+        nargs="+",
+        choices=CASES,
+        default=list(CASES),
+        help="Listings and transfers to time (default all)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1,
+        metavar=("<N>"),
+        help="Multiply the number of files, or the file sizes of 'huge' "
+        "(default 1)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        metavar=("<N>"),
+        help="--workers of every transfer (default 4)",
+    )
+    parser.add_argument(
+        "--db-url",
+        metavar=("<URL>"),
+        help="Keep the state in this SBACKUP_DB_URL, or 'sqlite' for a "
+        "temporary SQLite file, instead of a fakeredis server",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar=("<PATH>"),
+        help="Write the JSON results to <PATH> "
+        "(default benchmarks/results/<VERSION>.json)",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("<OLD>", "<NEW>"),
+        help="Compare two JSON result files and exit",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    report = Bench(args).run()
+    output = Path(args.output or RESULTS / f"{report['version']}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f" Results saved in '{output}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
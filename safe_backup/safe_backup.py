@@ -18,18 +18,63 @@
 # limitations under the License.
 #
 
+import contextlib
+import cProfile
+import errno
+import functools
+import hashlib
+import http.server
+import inspect
+import io
+import json
 import logging
 import os
+import pstats
+import re
 import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import ClientError
+from botocore.exceptions import BotoCoreError, IncompleteReadError
 from pathlib import Path
 import redis
 import argparse
-import urllib.parse
-import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from safe_backup import __version__
 
+try:
+    import zstandard
+except ImportError:  # optional, only needed for zstd compression
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, reflinks are then skipped
+    fcntl = None
+
+try:
+    import xxhash
+except ImportError:  # optional, --checksum falls back to crc32
+    xxhash = None
+
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy
+except ImportError:  # optional, only needed for --dedup
+    fastcdc_cy = None
+
 # levels => 10    -> 20   -> 30      -> 40    -> 50
 # LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
 FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
@@ -46,107 +91,1773 @@ colors = {
     "UNDERLINE": "\033[4m",  # "UNDERLINE"
 }
 
+# S3 multipart limits
+MIN_PART_SIZE = 5 * 1024**2
+MAX_PARTS = 10000
+
+SIZE_UNITS = {
+    "": 1,
+    "B": 1,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "KIB": 1024,
+    "MIB": 1024**2,
+    "GIB": 1024**3,
+}
+
+# Small files packed into tar archives are uploaded under this prefix
+PACK_PREFIX = ".sbackup/packs"
+
+# Object headers a relayed s3 to s3 copy carries over, as CopyObject does
+RELAY_HEADERS = (
+    "CacheControl",
+    "ContentDisposition",
+    "ContentEncoding",
+    "ContentLanguage",
+    "ContentType",
+    "Metadata",
+)
+
+# Returned by a transfer whose member waits in a pack to be uploaded
+PACKED = object()
+
+# Object metadata naming the codec a transfer was compressed with
+CODEC_METADATA = "sbackup-codec"
+CODEC_CHUNK_SIZE = 1024**2
+# zlib window bits for the gzip container
+GZIP_WBITS = 31
+
+# Deduplicated files are stored as recipes of content-defined chunks
+DEDUP_PREFIX = ".sbackup/dedup"
+CDC_MIN_SIZE = 256 * 1024
+CDC_AVG_SIZE = 1024**2
+CDC_MAX_SIZE = 4 * 1024**2
+# Bytes handed to fastcdc at a time, many chunks long
+CDC_WINDOW_SIZE = 16 * 1024**2
+
+# Number of local files saved in the db with one pipelined SADD
+LOCAL_BATCH_SIZE = 1000
+
+# ioctl that makes a file share the extents of another (btrfs, xfs)
+FICLONE = 0x40049409
+# Errors telling that a copy method does not work between two devices
+COPY_UNSUPPORTED = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.ETXTBSY,
+    errno.EXDEV,
+}
+
+# Hash with 'bandwidth' and 'requests' fields that overrides the limits
+# of --bandwidth-limit and --request-limit while a backup runs
+LIMITS_KEY = "limits_sbackup"
+LIMITS_POLL_INTERVAL = 5
+
+# Methods whose calls make up the stages reported by --profile
+PROFILE_STAGES = {
+    "save_files_list_in_db": "list",
+    "__scan_directory": "list",
+    "__s3_list_shard": "list",
+    "claim": "queue",
+    "ack": "queue",
+    "requeue": "queue",
+    "__transfer_member": "transfer",
+    "__pack_upload": "transfer",
+    "__restore_member": "transfer",
+    "verify_files": "verify",
+}
+# Seconds between two stack samples of --profile-stacks
+PROFILE_SAMPLE_INTERVAL = 0.01
+
+# Tries of a download whose response breaks off
+DOWNLOAD_ATTEMPTS = 3
+
+# Pushed to the queue of copy_files when the listing is over; no member
+# is an empty string
+QUEUE_END = ""
+
+# Transferred members are acknowledged in batches of this size
+ACK_BATCH_SIZE = 100
+
+# Move up to ARGV[1] random members of the set KEYS[1] to the claimed
+# set KEYS[2] and return them
+CLAIM_POP_SCRIPT = """
+local members = redis.call("SPOP", KEYS[1], ARGV[1])
+if #members > 0 then
+    redis.call("SADD", KEYS[2], unpack(members))
+end
+return members
+"""
+
+# Move the given members of the set KEYS[1] to the claimed set KEYS[2]
+# and return the ones that were still in KEYS[1]
+CLAIM_MEMBERS_SCRIPT = """
+local members = {}
+for _, member in ipairs(ARGV) do
+    if redis.call("SMOVE", KEYS[1], KEYS[2], member) == 1 then
+        members[#members + 1] = member
+    end
+end
+return members
+"""
+
+# State keys look like "<DB_KEY>-<COMMAND_KEY>-<KIND>_sbackup" where the
+# command key starts with the option letter, e.g. "c__s3__bucket__/tmp".
+STATE_KEY_PATTERN = re.compile(
+    r"^(?P<db_key>.+?)-(?P<command>[lcd]__.+)-(?P<kind>[a-z_]+_sbackup)$"
+)
+
+
+def color_log(loglevel="CRITICAL", message="DEBUG message", *args):
+    """
+    Log a colored message. Extra args are merged into the message
+    %-style by logging, and only when the level is enabled, so hot
+    paths should pass them instead of building f-strings.
+    """
 
-def color_log(loglevel="CRITICAL", message="DEBUG message"):
     numeric_level = getattr(logging, loglevel.upper(), None)
     if isinstance(numeric_level, int):
+        if not logging.root.isEnabledFor(numeric_level):
+            return
         msg = f"{colors[loglevel.upper()]}{message}{colors['RESET']}"
-        logging.log(
-            numeric_level,
-            msg,
-        )
+        logging.log(numeric_level, msg, *args)
     else:
         message = f"{loglevel = } args in color_log() function is wrong!"
         msg = f"{colors['ERROR']}{message}{colors['RESET']}"
         logging.log(40, msg)
 
 
+def split_state_key(key):
+    """
+    Split a state key into (db_key, command_key) or return None
+    if the key was not made by safe_backup.
+    """
+
+    match = STATE_KEY_PATTERN.match(key)
+    if match is None:
+        return None
+    return match["db_key"], match["command"]
+
+
+def parse_size(text):
+    """
+    Parse a size such as '1024', '8MB' or '64MiB' into bytes.
+    """
+
+    match = re.fullmatch(r"\s*(\d+)\s*([a-zA-Z]*)\s*", str(text))
+    if match is None or match[2].upper() not in SIZE_UNITS:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a valid size")
+    return int(match[1]) * SIZE_UNITS[match[2].upper()]
+
+
+def make_compressor(codec):
+    if codec == "gzip":
+        return zlib.compressobj(wbits=GZIP_WBITS)
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def make_decompressor(codec):
+    if codec == "gzip":
+        return zlib.decompressobj(wbits=GZIP_WBITS)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def cdc_chunks(stream):
+    """
+    Yield content-defined chunks of a binary stream. FastCDC cuts a
+    chunk where a gear rolling hash matches, so an edit only changes the
+    chunks around it and the rest deduplicate. The last chunk of each
+    window is cut by the window end and is chunked again with the next.
+    """
+
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < CDC_WINDOW_SIZE:
+            data = stream.read(CDC_WINDOW_SIZE)
+            eof = not data
+            buffer += data
+        if not buffer:
+            return
+        chunks = list(
+            fastcdc_cy(buffer, CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE)
+        )
+        if not eof:
+            chunks.pop()
+        for chunk in chunks:
+            yield bytes(buffer[chunk.offset:chunk.offset + chunk.length])
+        del buffer[:chunks[-1].offset + chunks[-1].length]
+
+
+def _reflink(source_fd, dest_fd, size):
+    fcntl.ioctl(dest_fd, FICLONE, source_fd)
+    return size
+
+
+def _copy_file_range(source_fd, dest_fd, size):
+    offset = 0
+    while offset < size:
+        sent = os.copy_file_range(
+            source_fd, dest_fd, size - offset, offset, offset
+        )
+        if not sent:
+            break
+        offset += sent
+    return offset
+
+
+def _sendfile(source_fd, dest_fd, size):
+    os.lseek(dest_fd, 0, os.SEEK_SET)
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dest_fd, source_fd, offset, size - offset)
+        if not sent:
+            break
+        offset += sent
+    return offset
+
+
+def _read_write(source_fd, dest_fd, size):
+    os.lseek(source_fd, 0, os.SEEK_SET)
+    os.lseek(dest_fd, 0, os.SEEK_SET)
+    offset = 0
+    while chunk := os.read(source_fd, CODEC_CHUNK_SIZE):
+        view = memoryview(chunk)
+        while view:
+            written = os.write(dest_fd, view)
+            view = view[written:]
+        offset += len(chunk)
+    return offset
+
+
+COPY_METHODS = [
+    (name, method)
+    for name, method, available in (
+        ("reflink", _reflink, fcntl is not None),
+        ("copy_file_range", _copy_file_range, hasattr(os, "copy_file_range")),
+        ("sendfile", _sendfile, hasattr(os, "sendfile")),
+        ("read/write", _read_write, True),
+    )
+    if available
+]
+
+
+def fast_copy(source, dest, unsupported):
+    """
+    Copy the data of a file the fastest way the file systems allow: a
+    reflink, then copy_file_range, then sendfile in the kernel, then
+    read/write. A method failing as unsupported is added to unsupported
+    as (name, source device, dest device) and skipped for that pair
+    afterwards. A kernel method that stops short of the size, as some
+    file systems do by copying nothing, leaves the file to the next one.
+    Return the name of the method used and the size copied.
+    """
+
+    with open(source, "rb") as source_file, open(dest, "wb") as dest_file:
+        source_fd, dest_fd = source_file.fileno(), dest_file.fileno()
+        stat = os.fstat(source_fd)
+        devices = (stat.st_dev, os.fstat(dest_fd).st_dev)
+        for name, method in COPY_METHODS:
+            if (name, *devices) in unsupported:
+                continue
+            try:
+                size = method(source_fd, dest_fd, stat.st_size)
+            except OSError as e:
+                if e.errno not in COPY_UNSUPPORTED or name == "read/write":
+                    raise
+                unsupported.add((name, *devices))
+                os.ftruncate(dest_fd, 0)
+                continue
+            # read/write copies what is left of a file that shrank.
+            if size == stat.st_size or name == "read/write":
+                return name, size
+            os.ftruncate(dest_fd, 0)
+    raise AssertionError("read/write is always tried")
+
+
+class CopyStats:
+    """Count the files, bytes and copy time of each copy method."""
+
+    def __init__(self):
+        self.methods = {}
+        self._lock = threading.Lock()
+
+    def add(self, method, size, seconds):
+        with self._lock:
+            files, total, elapsed = self.methods.get(method, (0, 0, 0.0))
+            self.methods[method] = (files + 1, total + size, elapsed + seconds)
+
+    def lines(self):
+        with self._lock:
+            methods = dict(self.methods)
+        for method, (files, size, seconds) in sorted(methods.items()):
+            rate = size / seconds / 1024**2 if seconds else 0.0
+            yield (
+                f"{files} files ({size} bytes) with {method} "
+                f"at {rate:.1f} MiB/s per worker"
+            )
+
+
+class CodecStats:
+    """Count raw and encoded bytes and the CPU time of a codec."""
+
+    def __init__(self):
+        self.raw = 0
+        self.encoded = 0
+        self.cpu = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, raw, encoded, cpu):
+        with self._lock:
+            self.raw += raw
+            self.encoded += encoded
+            self.cpu += cpu
+
+    def __str__(self):
+        ratio = self.raw / self.encoded if self.encoded else 0.0
+        return (
+            f"{self.raw} bytes as {self.encoded} bytes "
+            f"(ratio {ratio:.2f}) in {self.cpu:.2f}s of CPU"
+        )
+
+
+class CompressingReader(io.RawIOBase):
+    """
+    Read-only file object that compresses another file in chunks while
+    it is read, so whole files are never held in memory.
+    """
+
+    def __init__(self, file, codec, stats):
+        self.file = file
+        self.compressor = make_compressor(codec)
+        self.stats = stats
+        self.buffer = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.file.read(CODEC_CHUNK_SIZE)
+            start = time.thread_time()
+            if chunk:
+                data = self.compressor.compress(chunk)
+            else:
+                data = self.compressor.flush()
+                self.eof = True
+            self.stats.add(len(chunk), len(data), time.thread_time() - start)
+            self.buffer += data
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class StreamChecksum:
+    """
+    Hash bytes while they stream: a fast digest of the content (xxh3_64
+    with the optional xxhash, crc32 otherwise) and, when part_size is
+    given, the S3 ETag of an upload in parts of that size, which is a
+    single PUT below threshold. digest names the content algorithm,
+    'xxh3', 'crc32' or None for none.
+    """
+
+    def __init__(self, part_size=None, threshold=0, digest="auto"):
+        self.size = 0
+        self.part_size = part_size
+        self.threshold = threshold
+        if digest == "auto":
+            digest = "crc32" if xxhash is None else "xxh3"
+        self._xxh = xxhash.xxh3_64() if digest == "xxh3" else None
+        self._crc = 0 if digest == "crc32" else None
+        self._part = hashlib.md5() if part_size else None
+        self._part_fill = 0
+        self._parts = []
+        # A single PUT below the threshold may be longer than a part.
+        self._whole = None
+        if part_size and threshold > part_size:
+            self._whole = hashlib.md5()
+
+    def update(self, data):
+        self.size += len(data)
+        if self._xxh is not None:
+            self._xxh.update(data)
+        elif self._crc is not None:
+            self._crc = zlib.crc32(data, self._crc)
+        if self._whole is not None:
+            if self.size < self.threshold:
+                self._whole.update(data)
+            else:
+                self._whole = None
+        if self._part is None:
+            return
+        view = memoryview(data)
+        while view:
+            room = self.part_size - self._part_fill
+            piece, view = view[:room], view[room:]
+            self._part.update(piece)
+            self._part_fill += len(piece)
+            if self._part_fill == self.part_size:
+                self._parts.append(self._part.digest())
+                self._part = hashlib.md5()
+                self._part_fill = 0
+
+    @property
+    def digest(self):
+        if self._xxh is not None:
+            return f"xxh3:{self._xxh.hexdigest()}"
+        if self._crc is not None:
+            return f"crc32:{self._crc:08x}"
+        return None
+
+    @property
+    def etag(self):
+        if self._part is None:
+            return None
+        parts = list(self._parts)
+        if self._part_fill or not parts:
+            parts.append(self._part.digest())
+        if self.size < self.threshold:
+            whole = self._whole.digest() if self._whole else parts[0]
+            return whole.hex()
+        return f"{hashlib.md5(b''.join(parts)).hexdigest()}-{len(parts)}"
+
+
+class HashingReader(io.RawIOBase):
+    """Read-only file object that feeds what is read to checksums."""
+
+    def __init__(self, file, *checksums):
+        self.file = file
+        self.checksums = checksums
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        for checksum in self.checksums:
+            checksum.update(data)
+        return data
+
+
+def hash_file(path, digest):
+    """
+    Re-hash a local file with the algorithm of a saved digest and return
+    the new digest.
+    """
+
+    algorithm = digest.split(":")[0]
+    if algorithm == "xxh3" and xxhash is None:
+        raise ValueError(f"{algorithm} needs 'pip install xxhash'")
+    checksum = StreamChecksum(digest=algorithm)
+    with open(path, "rb") as file:
+        while chunk := file.read(CODEC_CHUNK_SIZE):
+            checksum.update(chunk)
+    return checksum.digest
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at rate tokens per second with up
+    to one second of burst; a rate of 0 is unlimited. A take larger than
+    the burst runs the bucket into debt that later takes wait out.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def take(self, amount=1):
+        while True:
+            with self._lock:
+                if not self.rate:
+                    return
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.stamp) * self.rate
+                )
+                self.stamp = now
+                if self.tokens >= 0:
+                    self.tokens -= amount
+                    return
+                delay = -self.tokens / self.rate
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """
+    Bytes and requests per second shared by every s3 client it is
+    attached to. Each SlowDown halves the request rate and pauses all
+    requests with an exponential backoff; the rate then grows back by
+    10% per second up to the configured limit, or when there is none,
+    up to the rate that ran into SlowDown before the limit is dropped.
+    """
+
+    def __init__(self, bandwidth=0, requests=0, poll=None):
+        self.bandwidth = bandwidth
+        self.requests = requests
+        self.bytes_bucket = TokenBucket(bandwidth)
+        self.requests_bucket = TokenBucket(requests)
+        self.slowdowns = 0
+        self._poll = poll
+        self._next_poll = 0.0
+        self._streak = 0
+        self._paused_until = 0.0
+        self._adapted = None
+        self._ceiling = None
+        self._adjusted = time.monotonic()
+        self._window = self._adjusted
+        self._sent = 0
+        self._lock = threading.Lock()
+
+    def attach(self, client):
+        events = client.meta.events
+        events.register("before-send.s3", self.before_send)
+        events.register("after-call.s3", self.after_call)
+        events.register("needs-retry.s3", self.needs_retry)
+
+    def set_limits(self, bandwidth, requests):
+        with self._lock:
+            self.bandwidth, self.requests = bandwidth, requests
+            self._adapted = None
+        self.bytes_bucket.set_rate(bandwidth)
+        self.requests_bucket.set_rate(requests)
+
+    def _refresh(self, now):
+        """Read the runtime limits from db at most every few seconds."""
+
+        with self._lock:
+            if self._poll is None or now < self._next_poll:
+                return
+            self._next_poll = now + LIMITS_POLL_INTERVAL
+        limits = self._poll() or {}
+        try:
+            bandwidth = parse_size(limits.get("bandwidth", self.bandwidth))
+            requests = int(limits.get("requests", self.requests))
+        except (argparse.ArgumentTypeError, ValueError):
+            color_log("warning", " Ignoring bad limits %r", limits)
+            return
+        if (bandwidth, requests) != (self.bandwidth, self.requests):
+            color_log("info", " Limits %s B/s %s req/s", bandwidth, requests)
+            self.set_limits(bandwidth, requests)
+
+    def _recover(self, now):
+        with self._lock:
+            if self._adapted is None or now - self._adjusted < 1:
+                return
+            self._adjusted = now
+            self._adapted *= 1.1
+            if self._adapted >= self._ceiling:
+                self._adapted = None
+            rate = self._adapted or self.requests
+        self.requests_bucket.set_rate(rate)
+
+    def before_send(self, request, **kwargs):
+        now = time.monotonic()
+        self._refresh(now)
+        self._recover(now)
+        pause = self._paused_until - now
+        if pause > 0:
+            time.sleep(pause)
+        self.requests_bucket.take()
+        headers = request.headers
+        # Newer botocore sends bodies aws-chunked with the size apart.
+        size = headers.get("X-Amz-Decoded-Content-Length")
+        self.bytes_bucket.take(int(size or headers.get("Content-Length", 0)))
+        with self._lock:
+            self._sent += 1
+
+    def after_call(self, http_response, parsed, model, **kwargs):
+        if model.name == "GetObject" and http_response.status_code < 300:
+            self.bytes_bucket.take(parsed.get("ContentLength", 0))
+        with self._lock:
+            self._streak = 0
+
+    def needs_retry(self, response=None, **kwargs):
+        if response is None:
+            return None
+        code = response[1].get("Error", {}).get("Code")
+        if code != "SlowDown" and response[0].status_code != 503:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self.slowdowns += 1
+            self._streak += 1
+            sent_rate = self._sent / max(now - self._window, 1)
+            self._window, self._sent = now, 0
+            rate = self._adapted or self.requests or sent_rate
+            if self._adapted is None:
+                self._ceiling = self.requests or rate
+            self._adapted = max(rate / 2, 1)
+            self._adjusted = now
+            self._paused_until = max(
+                self._paused_until, now + min(0.1 * 2**self._streak, 20)
+            )
+            rate = self._adapted
+        self.requests_bucket.set_rate(rate)
+        # The retry handler of botocore decides, this one only adapts.
+        return None
+
+
+class Throughput:
+    """Count processed items and report their rate per second."""
+
+    def __init__(self, unit="keys"):
+        self.unit = unit
+        self.count = 0
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, count=1):
+        with self._lock:
+            self.count += count
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.count} {self.unit} in {self.elapsed:.2f}s "
+            f"({self.rate:.1f} {self.unit}/s)"
+        )
+
+
+# name: (type, help) of every metric, see Metrics
+METRICS_HELP = {
+    "sbackup_listed_objects_total": (
+        "counter",
+        "Objects listed from the source into db",
+    ),
+    "sbackup_listed_bytes_total": (
+        "counter",
+        "Bytes of the objects listed from s3 sources",
+    ),
+    "sbackup_transferred_objects_total": (
+        "counter",
+        "Objects transferred to the destination",
+    ),
+    "sbackup_transferred_bytes_total": (
+        "counter",
+        "Bytes uploaded to s3, downloaded from s3 or copied locally",
+    ),
+    "sbackup_db_operation_seconds": (
+        "histogram",
+        "Latency of DB operations",
+    ),
+    "sbackup_s3_request_seconds": (
+        "histogram",
+        "Latency of s3 API calls, retries included",
+    ),
+    "sbackup_pending_members": (
+        "gauge",
+        "Members left in the db set of a transfer",
+    ),
+    "sbackup_claimed_members": (
+        "gauge",
+        "Members claimed by workers and not acknowledged yet",
+    ),
+    "sbackup_workers": ("gauge", "Transfer worker threads"),
+    "sbackup_workers_busy": ("gauge", "Transfer workers running a transfer"),
+    "sbackup_worker_busy_seconds_total": (
+        "counter",
+        "Time transfer workers spent transferring",
+    ),
+    "sbackup_errors_total": ("counter", "Errors by type"),
+}
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """
+    Process-wide counters, gauges and histograms rendered in the
+    Prometheus text format. Everything is a no-op until enable() is
+    called, so uninstrumented runs only pay an attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._values = {}
+        self._histograms = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def set_function(self, name, function, **labels):
+        """Read a gauge by calling function when the metrics are read."""
+
+        if not self.enabled:
+            return
+        with self._lock:
+            self._functions[(name, tuple(sorted(labels.items())))] = function
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts = self._histograms.setdefault(
+                key, [0] * len(METRICS_BUCKETS) + [0, 0.0]
+            )
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def attach(self, client):
+        """Time the s3 calls of a client and count their bytes and errors."""
+
+        events = client.meta.events
+        events.register("before-call.s3", self._before_call)
+        events.register("before-send.s3", self._before_send)
+        events.register("after-call.s3", self._after_call)
+        events.register("after-call-error.s3", self._after_call_error)
+
+    def _before_call(self, model, context, **kwargs):
+        context["sbackup_call"] = (model.name, time.monotonic())
+
+    def _before_send(self, request, **kwargs):
+        headers = request.headers
+        size = headers.get("X-Amz-Decoded-Content-Length")
+        size = int(size or headers.get("Content-Length", 0))
+        if size and request.method == "PUT":
+            self.inc("sbackup_transferred_bytes_total", size, path="upload")
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        operation, start = context.get("sbackup_call", (model.name, None))
+        if start is not None:
+            self.observe(
+                "sbackup_s3_request_seconds",
+                time.monotonic() - start,
+                operation=operation,
+            )
+        if http_response.status_code >= 300:
+            code = parsed.get("Error", {}).get("Code", "unknown")
+            self.inc("sbackup_errors_total", type=f"s3:{code}")
+        elif model.name == "GetObject":
+            self.inc(
+                "sbackup_transferred_bytes_total",
+                parsed.get("ContentLength", 0),
+                path="download",
+            )
+
+    def _after_call_error(self, exception, context, **kwargs):
+        self.inc("sbackup_errors_total", type=type(exception).__name__)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                color_log("debug", " *** metric %s failed: %s", key[0], e)
+        lines = []
+        for name, (kind, text) in METRICS_HELP.items():
+            samples = sorted(k for k in values if k[0] == name)
+            series = sorted(k for k in histograms if k[0] == name)
+            if not samples and not series:
+                continue
+            lines += [f"# HELP {name} {text}.", f"# TYPE {name} {kind}"]
+            for key in samples:
+                lines.append(f"{name}{_labels(key[1])} {values[key]}")
+            for key in series:
+                counts = histograms[key]
+                for bound, count in zip(METRICS_BUCKETS, counts):
+                    labels = _labels(key[1] + (("le", bound),))
+                    lines.append(f"{name}_bucket{labels} {count}")
+                labels = _labels(key[1] + (("le", "+Inf"),))
+                lines.append(f"{name}_bucket{labels} {counts[-2]}")
+                lines.append(f"{name}_count{_labels(key[1])} {counts[-2]}")
+                lines.append(f"{name}_sum{_labels(key[1])} {counts[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Export the metrics atomically for a textfile collector."""
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            file.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics over HTTP from a daemon thread."""
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                color_log("debug", " *** metrics " + format, *args)
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=server.serve_forever, name="sbackup-metrics", daemon=True
+        ).start()
+        return server
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return f"{{{pairs}}}"
+
+
+METRICS = Metrics()
+
+
+def instrument_db():
+    """Time every DB operation into sbackup_db_operation_seconds."""
+
+    for name, value in list(vars(DB).items()):
+        if name.startswith("_") or not callable(value):
+            continue
+        # Generators would only be timed until their first item.
+        if inspect.isgeneratorfunction(inspect.unwrap(value)):
+            continue
+        setattr(DB, name, _timed(value))
+
+
+def _timed(func):
+    name = inspect.unwrap(func).__name__
+
+    @functools.wraps(func)
+    def wrapper_timed(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            METRICS.observe(
+                "sbackup_db_operation_seconds",
+                time.monotonic() - start,
+                method=name,
+            )
+
+    return wrapper_timed
+
+
+class Profiler:
+    """
+    Wall and CPU time per method and per stage of a run. Times are kept
+    per thread, so a call costs two clock reads and no lock; CPU time is
+    the time of the calling thread. A stage counts only its outermost
+    call in each thread, its elapsed time runs from the first call that
+    started to the last one that ended over all threads.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._local = threading.local()
+        self._tables = []
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._stacks = None
+        self._sampler = None
+        self._wrappers = set()
+
+    def enable(self, stats=False, stacks=False):
+        """
+        Start timing. With stats, every thread started from now on also
+        runs cProfile; with stacks, a thread samples the stacks of all
+        threads every PROFILE_SAMPLE_INTERVAL seconds.
+        """
+
+        self.enabled = True
+        self.start = (time.perf_counter(), time.process_time())
+        if stacks:
+            self._stacks = {}
+            self._sampler = threading.Event()
+            threading.Thread(
+                target=self._sample, name="sbackup-sampler", daemon=True
+            ).start()
+        if stats:
+            if sys.version_info >= (3, 12):
+                # cProfile follows all threads through sys.monitoring.
+                self._start_profile()
+            else:
+                threading.setprofile(self._start_profile)
+                self._start_profile()
+
+    def _start_profile(self, *args):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def _table(self):
+        table = getattr(self._local, "table", None)
+        if table is None:
+            table = self._local.table = {"methods": {}, "stages": {}}
+            self._local.stages = set()
+            with self._lock:
+                self._tables.append(table)
+        return table
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Count the time spent in the block to the stage name."""
+
+        if not self.enabled or name in getattr(self._local, "stages", ()):
+            yield
+            return
+        table = self._table()
+        self._local.stages.add(name)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self._local.stages.discard(name)
+            end = time.perf_counter()
+            row = table["stages"].setdefault(name, [0, 0.0, 0.0, wall, end])
+            row[0] += 1
+            row[1] += end - wall
+            row[2] += time.thread_time() - cpu
+            row[3] = min(row[3], wall)
+            row[4] = max(row[4], end)
+
+    def wrap(self, func, name):
+        stage = PROFILE_STAGES.get(inspect.unwrap(func).__name__)
+
+        @functools.wraps(func)
+        def wrapper_profiled(*args, **kwargs):
+            if stage:
+                with self.stage(stage):
+                    return timed(*args, **kwargs)
+            return timed(*args, **kwargs)
+
+        def timed(*args, **kwargs):
+            methods = self._table()["methods"]
+            row = methods.get(name)
+            if row is None:
+                row = methods[name] = [0, 0.0, 0.0]
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                row[0] += 1
+                row[1] += time.perf_counter() - wall
+                row[2] += time.thread_time() - cpu
+
+        self._wrappers.update((wrapper_profiled.__code__, timed.__code__))
+        return wrapper_profiled
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._sampler.wait(PROFILE_SAMPLE_INTERVAL):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    if code not in self._wrappers:
+                        name = getattr(code, "co_qualname", code.co_name)
+                        module = frame.f_globals.get("__name__", "?")
+                        stack.append(f"{module}:{name}")
+                    frame = frame.f_back
+                # Workers of one pool share a flame.
+                thread = re.sub(r"_\d+$", "", names.get(ident, "thread"))
+                stack.append(thread)
+                line = ";".join(reversed(stack))
+                self._stacks[line] = self._stacks.get(line, 0) + 1
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler.set()
+        if self._profiles:
+            threading.setprofile(None)
+            for profile in self._profiles:
+                profile.disable()
+
+    def write_stats(self, path):
+        """Save the merged cProfile data of all threads for pstats."""
+
+        stats = pstats.Stats(self._profiles[0])
+        for profile in self._profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+    def write_stacks(self, path):
+        """Save the samples in the collapsed format of flamegraph.pl."""
+
+        with open(path, "w") as file:
+            for line, count in sorted(self._stacks.items()):
+                file.write(f"{line} {count}\n")
+
+    def lines(self, top=20):
+        """Describe the stages and the slowest methods of the run."""
+
+        methods = {}
+        stages = {}
+        with self._lock:
+            tables = list(self._tables)
+        for table in tables:
+            for name, row in list(table["methods"].items()):
+                total = methods.setdefault(name, [0, 0.0, 0.0])
+                for i in range(3):
+                    total[i] += row[i]
+            for name, row in list(table["stages"].items()):
+                total = stages.get(name)
+                if total is None:
+                    stages[name] = list(row)
+                    continue
+                for i in range(3):
+                    total[i] += row[i]
+                total[3] = min(total[3], row[3])
+                total[4] = max(total[4], row[4])
+
+        wall = time.perf_counter() - self.start[0]
+        cpu = time.process_time() - self.start[1]
+        lines = [
+            f"Profile of {wall:.2f}s wall and {cpu:.2f}s CPU time:",
+            f"{'stage':<40} {'calls':>9} {'elapsed':>9} {'busy':>9} "
+            f"{'cpu':>9}",
+        ]
+        for name in ("list", "queue", "transfer", "verify"):
+            if name in stages:
+                calls, busy, used, first, last = stages[name]
+                lines.append(
+                    f"{name:<40} {calls:>9} {last - first:>8.2f}s "
+                    f"{busy:>8.2f}s {used:>8.2f}s"
+                )
+        lines.append(
+            f"{'method':<40} {'calls':>9} {'wall':>9} {'per call':>9} "
+            f"{'cpu':>9}"
+        )
+        slowest = sorted(methods.items(), key=lambda item: -item[1][1])
+        for name, (calls, busy, used) in slowest[:top]:
+            lines.append(
+                f"{name[-40:]:<40} {calls:>9} {busy:>8.2f}s "
+                f"{busy / calls * 1000:>7.2f}ms {used:>8.2f}s"
+            )
+        return lines
+
+
+PROFILER = Profiler()
+
+
+def profile_methods():
+    """Time every method of the traced classes with PROFILER."""
+
+    for cls in _traced_classes:
+        for name, value in list(vars(cls).items()):
+            func = inspect.unwrap(value) if callable(value) else None
+            if not inspect.isfunction(func):
+                continue
+            # Generators would only be timed until their first item.
+            if inspect.isgeneratorfunction(func):
+                continue
+            qualname = f"{cls.__name__}.{func.__name__}"
+            setattr(cls, name, PROFILER.wrap(value, qualname))
+
+
+# Classes whose methods can be traced with trace_methods()
+_traced_classes = []
+
+
 # Debugging all class methods
 def debug_methods(cls):
-    for name, value in vars(cls).items():
-        if callable(value):
-            setattr(cls, name, debug_method(value))
+    """
+    Register a class for tracing. Its methods stay unwrapped, and so
+    cost nothing, until trace_methods() is called.
+    """
+
+    _traced_classes.append(cls)
     return cls
 
 
+def trace_methods(names=None):
+    """
+    Wrap the methods of all registered classes with debug_method, or
+    only the methods in names (leading underscores are ignored). Dunder
+    methods are left alone: debug_method logs self with %r, so a traced
+    __repr__ would log itself without end.
+    """
+
+    wanted = {name.lstrip("_") for name in names} if names else None
+    for cls in _traced_classes:
+        for name, value in list(vars(cls).items()):
+            if not callable(value) or hasattr(value, "__wrapped__"):
+                continue
+            if name.startswith("__") and name.endswith("__"):
+                continue
+            if wanted is None or value.__name__.lstrip("_") in wanted:
+                setattr(cls, name, debug_method(value))
+
+
 def debug_method(func):
     """Print the function signature and return value"""
 
+    @functools.wraps(func)
     def wrapper_debug(*args, **kwargs):
+        if not logging.root.isEnabledFor(logging.INFO):
+            return func(*args, **kwargs)
+
         # Do something before
         color_log(
             "info",
-            f"---- Calling {func.__name__}(*args={args} and **kwargs={kwargs})",
+            "---- Calling %s(*args=%r and **kwargs=%r)",
+            func.__name__,
+            args,
+            kwargs,
         )
 
         value = func(*args, **kwargs)
 
         # Do something after
-        color_log("info", f"#### End of {func.__name__!r} returned {value!r}")
+        color_log("info", "#### End of %r returned %r", func.__name__, value)
 
         return value
 
     return wrapper_debug
 
 
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """
+    Size-limited redis connection pool shared by all threads; callers
+    wait for a free connection instead of opening more. It counts the
+    connections in use, the peak and the time spent waiting.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.peak = 0
+        self.gets = 0
+        self.waited = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        start = time.monotonic()
+        connection = super().get_connection(*args, **kwargs)
+        with self._stats_lock:
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            self.gets += 1
+            self.waited += time.monotonic() - start
+        return connection
+
+    def release(self, connection):
+        with self._stats_lock:
+            self.in_use -= 1
+        return super().release(connection)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "max_connections": self.max_connections,
+                "in_use": self.in_use,
+                "peak": self.peak,
+                "gets": self.gets,
+                "waited": self.waited,
+            }
+
+
+# One pool per db url, shared by every DB user of this process
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+
+@debug_methods
+class SQLiteState:
+    """
+    Embedded state store in one SQLite file that answers the redis
+    commands DB uses, so a single host backup needs no redis server.
+    The file is in WAL mode and every pipeline runs as one transaction.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS strings (
+            key TEXT PRIMARY KEY, value TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sets (
+            key TEXT, member TEXT, UNIQUE (key, member)
+        );
+        CREATE INDEX IF NOT EXISTS sets_key ON sets (key);
+        CREATE TABLE IF NOT EXISTS hashes (
+            key TEXT, field TEXT, value TEXT, PRIMARY KEY (key, field)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS lists (key TEXT, value TEXT);
+        CREATE INDEX IF NOT EXISTS lists_key ON lists (key);
+    """
+    TABLES = ("strings", "sets", "hashes", "lists")
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.RLock()
+        self._pushed = threading.Condition(self._lock)
+        self._depth = 0
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def __repr__(self):
+        return f"SQLiteState({self.path!r})"
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            if not self._depth:
+                self._conn.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                self._depth -= 1
+                if not self._depth:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if not self._depth:
+                self._conn.execute("COMMIT")
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def pipeline(self, transaction=True):
+        return SQLitePipeline(self)
+
+    def exists(self, *keys):
+        return sum(
+            bool(
+                self._query(
+                    f"SELECT 1 FROM {table} WHERE key = ? LIMIT 1", key
+                )
+            )
+            for key in keys
+            for table in self.TABLES
+        )
+
+    def keys(self, pattern="*"):
+        union = " UNION ".join(
+            f"SELECT key FROM {table} WHERE key GLOB ?"
+            for table in self.TABLES
+        )
+        return [
+            row[0]
+            for row in self._query(union, *[pattern] * len(self.TABLES))
+        ]
+
+    def scan_iter(self, match="*", count=None):
+        yield from self.keys(match)
+
+    def delete(self, *keys):
+        deleted = set()
+        with self._transaction() as conn:
+            for key in keys:
+                for table in self.TABLES:
+                    cursor = conn.execute(
+                        f"DELETE FROM {table} WHERE key = ?", (key,)
+                    )
+                    if cursor.rowcount:
+                        deleted.add(key)
+        return len(deleted)
+
+    def set(self, key, value):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO strings VALUES (?, ?)",
+                (key, str(value)),
+            )
+        return True
+
+    def get(self, key):
+        rows = self._query("SELECT value FROM strings WHERE key = ?", key)
+        return rows[0][0] if rows else None
+
+    def sadd(self, key, *values):
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO sets VALUES (?, ?)",
+                ((key, str(value)) for value in values),
+            )
+            return conn.total_changes - before
+
+    def srem(self, key, *values):
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "DELETE FROM sets WHERE key = ? AND member = ?",
+                ((key, str(value)) for value in values),
+            )
+            return conn.total_changes - before
+
+    def sunionstore(self, destination, *keys):
+        with self._transaction() as conn:
+            members = {
+                row[0]
+                for key in keys
+                for row in conn.execute(
+                    "SELECT member FROM sets WHERE key = ?", (key,)
+                )
+            }
+            conn.execute("DELETE FROM sets WHERE key = ?", (destination,))
+            self.sadd(destination, *members)
+        return len(members)
+
+    def spop(self, key, count=None):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT rowid, member FROM sets WHERE key = ? LIMIT ?",
+                (key, count or 1),
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM sets WHERE rowid = ?",
+                ((row[0],) for row in rows),
+            )
+        members = [row[1] for row in rows]
+        if count is None:
+            return members[0] if members else None
+        return members
+
+    def smove(self, source, destination, member):
+        with self._transaction():
+            if not self.srem(source, member):
+                return False
+            self.sadd(destination, member)
+        return True
+
+    def claim(self, key, claimed_key, count=None, members=None):
+        """
+        Move up to count members, or the given members that are still
+        there, from the set to the claimed set in one transaction and
+        return them, as the claim scripts of DB do on redis.
+        """
+
+        with self._transaction() as conn:
+            if members is None:
+                rows = conn.execute(
+                    "SELECT rowid, member FROM sets WHERE key = ? LIMIT ?",
+                    (key, count or 1),
+                ).fetchall()
+            else:
+                rows = [
+                    row
+                    for member in members
+                    for row in conn.execute(
+                        "SELECT rowid, member FROM sets "
+                        "WHERE key = ? AND member = ?",
+                        (key, str(member)),
+                    )
+                ]
+            conn.executemany(
+                "UPDATE OR REPLACE sets SET key = ? WHERE rowid = ?",
+                ((claimed_key, row[0]) for row in rows),
+            )
+        return [row[1] for row in rows]
+
+    def requeue(self, key, claimed_key, members=None):
+        """
+        Move the given claimed members, or all of them, back to the set
+        in one transaction.
+        """
+
+        with self._transaction() as conn:
+            if members is None:
+                conn.execute(
+                    "UPDATE OR REPLACE sets SET key = ? WHERE key = ?",
+                    (key, claimed_key),
+                )
+            elif members:
+                self.srem(claimed_key, *members)
+                self.sadd(key, *members)
+
+    def scard(self, key):
+        return self._query("SELECT COUNT(*) FROM sets WHERE key = ?", key)[0][0]
+
+    def sismember(self, key, value):
+        return bool(
+            self._query(
+                "SELECT 1 FROM sets WHERE key = ? AND member = ?",
+                key,
+                str(value),
+            )
+        )
+
+    def rpush(self, key, *values):
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO lists VALUES (?, ?)",
+                ((key, str(value)) for value in values),
+            )
+            self._pushed.notify_all()
+        return len(values)
+
+    def lpop(self, key, count=None):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT rowid, value FROM lists WHERE key = ? "
+                "ORDER BY rowid LIMIT ?",
+                (key, count or 1),
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM lists WHERE rowid = ?",
+                ((row[0],) for row in rows),
+            )
+        values = [row[1] for row in rows]
+        if count is None:
+            return values[0] if values else None
+        return values or None
+
+    def blpop(self, keys, timeout=0):
+        deadline = time.monotonic() + timeout
+        with self._pushed:
+            while True:
+                for key in keys:
+                    value = self.lpop(key)
+                    if value is not None:
+                        return key, value
+                remaining = deadline - time.monotonic()
+                if timeout and remaining <= 0:
+                    return None
+                self._pushed.wait(remaining if timeout else None)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                ((key, str(f), str(v)) for f, v in items.items()),
+            )
+        return len(items)
+
+    def hget(self, key, field):
+        rows = self._query(
+            "SELECT value FROM hashes WHERE key = ? AND field = ?",
+            key,
+            str(field),
+        )
+        return rows[0][0] if rows else None
+
+    def hmget(self, key, fields):
+        return [self.hget(key, field) for field in fields]
+
+    def hgetall(self, key):
+        return dict(
+            self._query("SELECT field, value FROM hashes WHERE key = ?", key)
+        )
+
+    def hdel(self, key, *fields):
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "DELETE FROM hashes WHERE key = ? AND field = ?",
+                ((key, str(field)) for field in fields),
+            )
+            return conn.total_changes - before
+
+
+class SQLitePipeline:
+    """Queue SQLiteState commands and run them in one transaction."""
+
+    def __init__(self, state):
+        self._state = state
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._state, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        with self._state._transaction():
+            results = [
+                command(*args, **kwargs)
+                for command, args, kwargs in self._commands
+            ]
+        self._commands = []
+        return results
+
+
 @debug_methods
 class DB:
     def db_connect(self):
         DB_DECODE_RESPONSE = os.getenv("SBACKUP_DB_DECODE_RESPONSE", True)
 
         db_url = os.getenv("SBACKUP_DB_URL", "127.0.0.1:6379")
+        self.db_scan_count = int(os.getenv("SBACKUP_DB_SCAN_COUNT", 1000))
+
+        if db_url.startswith("sqlite:"):
+            # sqlite:///absolute/path or sqlite://relative/path
+            self.db = SQLiteState(db_url.split("://", 1)[1])
+            color_log("debug", f"---- {self.db = }")
+            return
+
+        if "://" not in db_url:
+            # Keep the old "host:port" and accept a bare unix socket path.
+            scheme = "unix" if db_url.startswith("/") else "redis"
+            db_url = f"{scheme}://{db_url}"
+        if isinstance(DB_DECODE_RESPONSE, str):
+            DB_DECODE_RESPONSE = DB_DECODE_RESPONSE.lower() not in (
+                "0",
+                "false",
+                "no",
+            )
+
+        color_log(
+            "debug",
+            f"------\n"
+            f"\tdb_url = {re.sub('://[^@/]*@', '://***@', db_url)!r}\n"
+            f"\t{DB_DECODE_RESPONSE = }",
+        )
 
-        urllib.parse.uses_netloc.append("redis")
-        url = urllib.parse.urlparse(db_url)
+        with _db_pools_lock:
+            pool = _db_pools.get((db_url, DB_DECODE_RESPONSE))
+            if pool is None:
+                pool = MeteredConnectionPool.from_url(
+                    db_url,
+                    max_connections=int(
+                        os.getenv("SBACKUP_DB_MAX_CONNECTIONS", 50)
+                    ),
+                    timeout=float(os.getenv("SBACKUP_DB_POOL_TIMEOUT", 20)),
+                    decode_responses=DB_DECODE_RESPONSE,
+                )
+                _db_pools[(db_url, DB_DECODE_RESPONSE)] = pool
+        self.db = redis.StrictRedis(connection_pool=pool)
+        color_log("debug", f"---- {self.db = }")
+
+    def pool_stats(self):
+        """
+        Return the usage counters of the connection pool, or None when
+        the state is not kept in redis.
+        """
+
+        pool = getattr(self.db, "connection_pool", None)
+        return pool.stats() if isinstance(pool, MeteredConnectionPool) else None
+
+    def key_exists(self, key):
+        return self.db.exists(key)
+
+    def find(self, pattern):
+        return list(self.db.scan_iter(pattern, count=self.db_scan_count))
+
+    def get_keys(self):
+        return self.db.keys()
+
+    def delete(self, key):
+        return self.db.delete(key)
+
+    def set(self, key, value):
+        return self.db.set(key, value)
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def set_add(self, key, value):
+        return self.db.sadd(key, value)
+
+    def set_add_many(
+        self,
+        key,
+        values,
+        marker_key=None,
+        marker=None,
+        manifest_key=None,
+        manifest=None,
+        marker_field=None,
+        queue_key=None,
+    ):
+        """
+        Add all values to the set with one SADD and, if given, move the
+        marker (a field of a hash when marker_field is given) and record
+        the manifest entries in the same transaction so the list, the
+        resume point and the manifest never disagree. Values are also
+        pushed to queue_key when a transfer is waiting for them.
+        """
+
+        pipe = self.db.pipeline(transaction=True)
+        if values:
+            pipe.sadd(key, *values)
+            if queue_key is not None:
+                pipe.rpush(queue_key, *values)
+        if marker_field is not None:
+            pipe.hset(marker_key, marker_field, marker)
+        elif marker_key is not None:
+            pipe.set(marker_key, marker)
+        if manifest:
+            pipe.hset(manifest_key, mapping=manifest)
+        return pipe.execute()
+
+    def set_contains(self, key, value):
+        return self.db.sismember(key, value)
+
+    def set_size(self, key):
+        return self.db.scard(key)
+
+    def iter_queue(self, key, count=None):
+        """
+        Yield batches of members pushed to a list until the QUEUE_END
+        pushed by end_queue() comes out of it.
+        """
+
+        count = count or self.db_scan_count
+        while True:
+            members = self.db.lpop(key, count)
+            if not members:
+                item = self.db.blpop([key], timeout=1)
+                if not item:
+                    continue
+                members = [item[1]]
+            if QUEUE_END in members:
+                members = members[: members.index(QUEUE_END)]
+                if members:
+                    yield members
+                break
+            yield members
+
+    def end_queue(self, key):
+        """Tell iter_queue() that nothing more is pushed to the list."""
+
+        return self.db.rpush(key, QUEUE_END)
+
+    def claim(self, key, claimed_key, count=None, members=None):
+        """
+        Atomically move up to count random members, or the given members
+        that are still there, from the set to the claimed set and return
+        them. A member is claimed by one worker only.
+        """
 
-        color_log(
-            "debug",
-            f"------\n"
-            f"\t{db_url = }\n"
-            f"\t{urllib = }\n"
-            f"\t{url = }\n"
-            f"\t{DB_DECODE_RESPONSE = }",
+        if isinstance(self.db, SQLiteState):
+            return self.db.claim(key, claimed_key, count, members)
+        if members is None:
+            return self.db.eval(CLAIM_POP_SCRIPT, 2, key, claimed_key, count)
+        if not members:
+            return []
+        return self.db.eval(
+            CLAIM_MEMBERS_SCRIPT, 2, key, claimed_key, *members
         )
 
-        self.db = redis.StrictRedis(
-            host=url.scheme,
-            port=url.path,
-            db=0,
-            decode_responses=DB_DECODE_RESPONSE,
-        )
-        color_log("debug", f"---- {self.db = }")
+    def ack(self, claimed_key, members, index_key=None, index=None):
+        """
+        Drop transferred members from the claimed set and, for a pack,
+        save their index entries in the same transaction.
+        """
 
-    def key_exists(self, key):
-        return self.db.exists(key)
+        pipe = self.db.pipeline(transaction=True)
+        if members:
+            pipe.srem(claimed_key, *members)
+        if index:
+            pipe.hset(index_key, mapping=index)
+        return pipe.execute()
 
-    def find(self, cursor, pattern):
-        return self.db.scan(cursor, pattern)[1]
+    def requeue(self, key, claimed_key, members=None):
+        """
+        Move the given claimed members, or all of them, back to the set.
+        """
 
-    def get_elements(self, key, cursor):
-        return self.db.sscan(key, cursor)[1]
+        if isinstance(self.db, SQLiteState):
+            return self.db.requeue(key, claimed_key, members)
+        pipe = self.db.pipeline(transaction=True)
+        if members is None:
+            pipe.sunionstore(key, key, claimed_key)
+            pipe.delete(claimed_key)
+        elif members:
+            pipe.srem(claimed_key, *members)
+            pipe.sadd(key, *members)
+        return pipe.execute()
 
-    def get_keys(self):
-        return self.db.keys()
+    def hash_set(self, key, field, value):
+        return self.db.hset(key, field, value)
 
-    def delete(self, key):
-        return self.db.delete(key)
+    def hash_get(self, key, field):
+        return self.db.hget(key, field)
 
-    def set(self, key, value):
-        return self.db.set(key, value)
+    def hash_get_many(self, key, fields):
+        return self.db.hmget(key, fields)
 
-    def get(self, key):
-        return self.db.get(key)
+    def hash_get_all(self, key):
+        return self.db.hgetall(key)
 
-    def set_add(self, key, value):
-        return self.db.sadd(key, value)
+    def start_shards(self, key, shards, marker_key):
+        """
+        Save the shards with empty markers and drop the listing marker
+        in one transaction.
+        """
+
+        pipe = self.db.pipeline(transaction=True)
+        if shards:
+            pipe.hset(key, mapping={shard: "" for shard in shards})
+        pipe.delete(marker_key)
+        return pipe.execute()
 
-    def set_remove(self, key, value):
-        return self.db.srem(key, value)
+    def hash_delete(self, key, field):
+        return self.db.hdel(key, field)
 
 
 @debug_methods
 class SafeBackup:
     __region_dest = None
+    # Destination buckets verified or created by this process.
+    __buckets_ready = set()
+    __buckets_lock = threading.Lock()
 
     def __init__(self, args):
         """
@@ -157,6 +1868,38 @@ class SafeBackup:
         DB.db_connect(self)
         color_log("debug", f" *********** args = {args} ######### ")
 
+        self.workers = args.workers
+        self.incremental = args.incremental
+        self.scan_workers = args.scan_workers
+        self.shards = args.shards
+        self.page_size = args.page_size
+        self.queue_key = None
+        self.transfer_config = TransferConfig(
+            multipart_threshold=args.multipart_threshold,
+            multipart_chunksize=args.multipart_chunksize,
+            max_concurrency=args.max_concurrency,
+            max_bandwidth=args.max_bandwidth or None,
+        )
+        self.pack_size = args.pack
+        self.pack_threshold = args.pack_threshold
+        self.pack_compress = args.pack_compress
+        self.compress = args.compress
+        self.codec_stats = CodecStats()
+        self.dedup = args.dedup
+        self.dedup_stats = CodecStats()
+        self.checksum = args.checksum
+        # (endpoint, access key) of each connected side, see __s3_connect
+        self.__s3_accounts = {}
+        self.__dirs_made = set()
+        # (method, source device, dest device) fast_copy must not try
+        self.__copy_unsupported = set()
+        self.copy_stats = CopyStats()
+        self.limiter = RateLimiter(
+            args.bandwidth_limit,
+            args.request_limit,
+            poll=lambda: DB.hash_get_all(self, LIMITS_KEY),
+        )
+
         self.__check_if_s3_connection_need(args)
 
         self.__resume_intrupting()
@@ -174,6 +1917,10 @@ class SafeBackup:
             if args.c[0] == "s3":
                 self.s3_source = self.__s3_connect("source")
                 self.s3_source_client = self.s3_source.meta.client
+        elif args.d or args.u or args.r:
+            if (args.d or args.u or args.r)[0].startswith("s3:"):
+                self.s3_source = self.__s3_connect("source")
+                self.s3_source_client = self.s3_source.meta.client
 
         if args.c:
             if args.c[2].startswith("s3:"):
@@ -183,18 +1930,29 @@ class SafeBackup:
             if args.d[1].startswith("s3:"):
                 self.s3_dest = self.__s3_connect("dest")
                 self.s3_dest_client = self.s3_dest.meta.client
+        elif args.verify:
+            if args.verify[0].startswith("s3:"):
+                self.s3_dest = self.__s3_connect("dest")
+                self.s3_dest_client = self.s3_dest.meta.client
 
     def __resume_intrupting(self):
         """
         Check and continue if any interruption occurred.
         """
 
-        db_keys = DB.find(self, 0, "*:marker_sbackup")
+        db_keys = DB.find(self, "*-marker_sbackup")
+        db_keys += DB.find(self, "*-shards_sbackup")
         for key in db_keys:
             color_log("debug", f" *********** key = {key} ######### ")
-            commands = key.split("-")
-            command_array = commands[2].split("__")
-            color_log("debug", f" *********** {commands = } ####### ")
+            state = split_state_key(key)
+            if state is None:
+                continue
+            db_key, command_key = state
+            command_array = command_key.split("__", 3)
+            # Sharded listings keep their markers in the shards hash.
+            first_marker = None
+            if key.endswith("-marker_sbackup"):
+                first_marker = DB.get(self, key)
             color_log(
                 "debug",
                 f" *********** {command_array = } ####### ",
@@ -206,31 +1964,49 @@ class SafeBackup:
                         command_array[1],
                         command_array[2],
                         intruption=True,
-                        first_marker=DB.get(self, key),
+                        first_marker=first_marker,
                     )
                 case "c":
                     self.save_files_list_in_db(
                         "c",
                         command_array[1],
                         command_array[2],
-                        commands[2],
+                        command_key,
                         intruption=True,
-                        first_marker=DB.get(self, key),
+                        first_marker=first_marker,
                     )
                     self.download_files_list_from_db(
                         "d",
-                        f"{commands[0]}:{commands[1]}",
+                        db_key,
                         command_array[3],
-                        command_array[4],
                     )
 
-        db_keys = DB.find(self, 0, "*-work_sbackup")
+        # Queues only speed up a running copy, the sets are complete.
+        for key in DB.find(self, "*-queue_sbackup"):
+            DB.delete(self, key)
+
+        # Runs of versions before claimed sets kept the member they were
+        # transferring in a -work_sbackup string, the rest of the members
+        # are still in the set; claim it so it is requeued below.
+        for key in DB.find(self, "*-work_sbackup"):
+            member = DB.get(self, key)
+            if member:
+                claimed_key = key.removesuffix("work_sbackup")
+                DB.set_add(self, f"{claimed_key}claimed_sbackup", member)
+            DB.delete(self, key)
+
+        db_keys = DB.find(self, "*-claimed_sbackup")
         for key in db_keys:
             color_log("debug", f" *********** {key} #########")
-            keys = key.split("-")
-            command = keys[1].split("__")
-            color_log("debug", f" *********** {keys} + {command} ######### ")
-            self.download_files_list_from_db("d", keys[0], command[1])
+            state = split_state_key(key)
+            if state is None:
+                continue
+            db_key, command_key = state
+            command = command_key.split("__", 1)
+            color_log("debug", f" *********** {state} + {command} ######### ")
+            # Claimed members were in flight or not acknowledged yet.
+            DB.requeue(self, db_key, key)
+            self.download_files_list_from_db("d", db_key, command[1])
 
     def check_db_key_exists(self, key):
         return DB.key_exists(self, key)
@@ -266,6 +2042,7 @@ class SafeBackup:
         else:
             print(f"The s3 destination={destination} is not defined.")
             exit(1)
+        self.__s3_accounts[destination] = (AWS_ENDPOINT_URL, AWS_ACCESS_KEY_ID)
 
         session = boto3.session.Session(
             aws_access_key_id=AWS_ACCESS_KEY_ID,
@@ -273,13 +2050,17 @@ class SafeBackup:
             aws_session_token=None,
         )
 
-        return session.resource(
+        resource = session.resource(
             "s3",
             region_name=AWS_DEFAULT_REGION,
             endpoint_url=AWS_ENDPOINT_URL,
             config=boto3.session.Config(signature_version="s3v4"),
             verify=False,
         )
+        self.limiter.attach(resource.meta.client)
+        if METRICS.enabled:
+            METRICS.attach(resource.meta.client)
+        return resource
 
     def __create_bucket(self, s3_client, bucket_name, region=None):
         """
@@ -293,6 +2074,9 @@ class SafeBackup:
         :return: True if bucket created, else False
         """
 
+        if bucket_name in self.__buckets_ready:
+            return True
+
         # Create bucket
         try:
             if region is None:
@@ -303,70 +2087,251 @@ class SafeBackup:
                     Bucket=bucket_name, CreateBucketConfiguration=location
                 )
         except ClientError as e:
-            logging.error(e)
-            return False
+            # Another worker may have created it a moment ago.
+            if e.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
+                logging.error(e)
+                return False
+        self.__buckets_ready.add(bucket_name)
         return True
 
-    def __make_db_list_from_s3_pages(self, args):
-        color_log("debug", args[1]["Key"])
-        color_log("debug", args)
-        DB.set_add(self, args[0], args[1]["Key"])
+    def __prepare_dest_bucket(self, bucket_name):
+        """
+        Check the destination bucket once per process and create it if
+        it does not exist. Return the number of S3 requests it took.
+        """
 
-    def __multiprocess(self, db_key, page_contents):
-        processes = []
-        for content in page_contents:
-            args = [
-                [db_key, content],
-            ]
-            p = multiprocessing.Process(
-                target=self.__make_db_list_from_s3_pages, args=args
-            )
-            processes.append(p)
-            p.start()
-        for p in processes:
-            p.join()
+        with self.__buckets_lock:
+            if bucket_name in self.__buckets_ready:
+                return 0
+            try:
+                self.s3_dest_client.head_bucket(Bucket=bucket_name)
+                self.__buckets_ready.add(bucket_name)
+                return 1
+            except ClientError:
+                # The bucket does not exist or you have no access.
+                # Create the destination bucket.
+                if not self.__create_bucket(
+                    self.s3_dest_client, bucket_name, self.__region_dest
+                ):
+                    print(
+                        "  ######  There was a problem to "
+                        "create destination bucket!"
+                    )
+                    exit(1)
+                return 2
 
-    def __s3_list_paginator(
+    def __save_entries(
         self,
-        bucket,
-        command_key,
-        page_items=100,
-        max_items=None,
-        first_marker="",
+        db_key,
+        entries,
+        marker_key=None,
+        marker=None,
+        marker_field=None,
     ):
-        # Create a reusable Paginator
-        paginator = self.s3_source_client.get_paginator("list_objects")
+        """
+        Save the {path: signature} entries of one batch in the db set.
+        In incremental mode, entries whose signature matches the manifest
+        are skipped and the new signatures are recorded with the batch.
+        """
 
-        # Create and Customizing page iterators
-        page_iterator = paginator.paginate(
-            Bucket=bucket.name,
-            PaginationConfig={
-                "PageSize": page_items,
-                "StartingToken": first_marker,
-                "MaxItems": max_items,
-            },
+        METRICS.inc(
+            "sbackup_listed_objects_total",
+            len(entries),
+            source=db_key.split(":")[0],
         )
+        if not self.incremental:
+            DB.set_add_many(
+                self,
+                db_key,
+                list(entries),
+                marker_key,
+                marker,
+                marker_field=marker_field,
+                queue_key=self.queue_key,
+            )
+            return
 
-        db_key = f"s3:{bucket.name}"
+        manifest_key = f"{db_key}-manifest_sbackup"
+        known = DB.hash_get_many(self, manifest_key, list(entries))
+        changed = {
+            path: signature
+            for (path, signature), old in zip(entries.items(), known)
+            if signature != old
+        }
+        self.unchanged.add(len(entries) - len(changed))
+        DB.set_add_many(
+            self,
+            db_key,
+            list(changed),
+            marker_key,
+            marker,
+            manifest_key,
+            changed,
+            marker_field,
+            self.queue_key,
+        )
 
-        for page in page_iterator:
-            color_log("debug", f" \n*********\n {page = }\n ############ \n")
-            color_log("debug", f" **** Marker ************ {page['Marker']}")
-            if page["IsTruncated"]:
-                color_log(
-                    "debug",
-                    f" **** NextMarker ******** {page['NextMarker']}",
+    def __make_db_list_from_s3_pages(
+        self, db_key, contents, marker_key=None, marker_field=None
+    ):
+        """
+        Save all keys of a listing page with one pipelined SADD and move
+        the resume marker to the last saved key in the same transaction.
+        """
+
+        if not contents:
+            return 0
+        entries = {
+            content["Key"]: f"{content['ETag']}:"
+            f"{content['LastModified'].isoformat()}"
+            for content in contents
+        }
+        METRICS.inc(
+            "sbackup_listed_bytes_total",
+            sum(content.get("Size", 0) for content in contents),
+            source="s3",
+        )
+        next_marker = contents[-1]["Key"]
+        color_log("debug", " **** NextMarker ******** %s", next_marker)
+        self.__save_entries(
+            db_key, entries, marker_key, next_marker, marker_field
+        )
+        return len(entries)
+
+    def __s3_list_pages(self, bucket, prefix="", start_after="", **kwargs):
+        """
+        Yield the ListObjectsV2 pages of a bucket. The first request
+        starts after the given key and the next ones follow the
+        NextContinuationToken, so no page is listed twice.
+        """
+
+        request = {
+            "Bucket": bucket.name,
+            "Prefix": prefix,
+            "MaxKeys": self.page_size,
+            **kwargs,
+        }
+        if start_after:
+            request["StartAfter"] = start_after
+        while True:
+            page = self.s3_source_client.list_objects_v2(**request)
+            yield page
+            if not page.get("IsTruncated"):
+                break
+            request["ContinuationToken"] = page["NextContinuationToken"]
+
+    def __s3_discover_shards(self, bucket, db_key, listed):
+        """
+        List the top level of the bucket with a '/' delimiter, save the
+        objects found there and return the common prefixes as shards.
+        """
+
+        shards = []
+        for page in self.__s3_list_pages(bucket, Delimiter="/"):
+            listed.add(
+                self.__make_db_list_from_s3_pages(
+                    db_key, page.get("Contents", [])
+                )
+            )
+            for common_prefix in page.get("CommonPrefixes", []):
+                shards.append(json.dumps([common_prefix["Prefix"], "", ""]))
+        return shards
+
+    def __s3_list_shard(
+        self, bucket, db_key, shards_key, shard, marker, listed
+    ):
+        """
+        List one shard, a [prefix, after, upto] range of keys where empty
+        bounds are open, keeping its resume marker in the shards hash.
+        """
+
+        prefix, after, upto = json.loads(shard)
+        for page in self.__s3_list_pages(bucket, prefix, marker or after):
+            contents = page.get("Contents", [])
+            inside = [c for c in contents if not upto or c["Key"] <= upto]
+            listed.add(
+                self.__make_db_list_from_s3_pages(
+                    db_key, inside, shards_key, shard
                 )
+            )
+            if len(inside) < len(contents):
+                break
+        DB.hash_delete(self, shards_key, shard)
+
+    def __s3_list_shards(self, bucket, command_key):
+        """
+        List the bucket as shards running concurrently. Shards come from
+        the '/' prefixes of the bucket when --shards is 'auto', or are
+        the key ranges between the given split keys. A key equal to a
+        split key belongs to the range before it. Shards still in the
+        shards hash are the only ones listed again after an interruption.
+        """
+
+        db_key = f"s3:{bucket.name}"
+        marker_key = f"{db_key}-{command_key}-marker_sbackup"
+        shards_key = f"{db_key}-{command_key}-shards_sbackup"
+        listed = Throughput("keys")
+
+        if not DB.key_exists(self, shards_key):
+            # An interrupted discovery restarts as a full listing.
+            DB.set(self, marker_key, "")
+            if self.shards == "auto":
+                shards = self.__s3_discover_shards(bucket, db_key, listed)
             else:
-                color_log("debug", " **** NextMarker ******** ")
+                bounds = ["", *sorted(self.shards.split(",")), ""]
+                shards = [
+                    json.dumps(["", after, upto])
+                    for after, upto in zip(bounds, bounds[1:])
+                ]
+            DB.start_shards(self, shards_key, shards, marker_key)
 
-            marker_key = f"{db_key}-{command_key}-marker_sbackup"
-            if "Contents" in list(page.keys()):
-                DB.set(self, marker_key, page["Marker"])
-                self.__multiprocess(db_key, page["Contents"])
-        else:
-            DB.delete(self, marker_key)
+        markers = DB.hash_get_all(self, shards_key)
+        color_log("debug", " *** listing %d shards", len(markers))
+        with ThreadPoolExecutor(
+            max_workers=self.scan_workers, thread_name_prefix="sbackup-shard"
+        ) as executor:
+            running = [
+                executor.submit(
+                    self.__s3_list_shard,
+                    bucket,
+                    db_key,
+                    shards_key,
+                    shard,
+                    marker,
+                    listed,
+                )
+                for shard, marker in markers.items()
+            ]
+            for future in running:
+                future.result()
+
+        print(f" Listed {listed} in {len(markers)} shards from '{db_key}'.")
+        return db_key
+
+    def __s3_list_paginator(self, bucket, command_key, first_marker=""):
+        """
+        List the bucket into the db. The marker holds the last saved key
+        and an interrupted listing resumes with it as StartAfter.
+        """
+
+        shards_key = f"s3:{bucket.name}-{command_key}-shards_sbackup"
+        if self.shards or DB.key_exists(self, shards_key):
+            return self.__s3_list_shards(bucket, command_key)
 
+        db_key = f"s3:{bucket.name}"
+        marker_key = f"{db_key}-{command_key}-marker_sbackup"
+        listed = Throughput("keys")
+
+        for page in self.__s3_list_pages(bucket, start_after=first_marker):
+            color_log("debug", " **** KeyCount ******** %s", page["KeyCount"])
+            listed.add(
+                self.__make_db_list_from_s3_pages(
+                    db_key, page.get("Contents", []), marker_key
+                )
+            )
+        DB.delete(self, marker_key)
+
+        print(f" Listed {listed} from '{db_key}'.")
         return db_key
 
     def bucket_exists(self, bucket_name):
@@ -386,6 +2351,68 @@ class SafeBackup:
                     f"'{bucket_name}'! Error is '{e}'",
                 )
 
+    def __scan_directory(self, path, prefix):
+        """
+        List one directory with os.scandir and return its files as
+        {member: signature} and its subdirectories as (path, prefix).
+        Like os.walk, symlinks to directories are not followed.
+        """
+
+        files = {}
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    member = f"{prefix}/{entry.name}"
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append((entry.path, member))
+                        continue
+                    signature = None
+                    if self.incremental:
+                        stat = entry.stat(follow_symlinks=False)
+                        signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+                    files[member] = signature
+        except OSError as e:
+            print(f" There was an error: {e}")
+        return files, subdirs
+
+    def __scan_local(self, db_key, location):
+        """
+        Walk the location with a pool of scandir workers and save its
+        files in the db in pipelined batches. Members are the paths
+        relative to the parent of the location.
+        """
+
+        scanned = Throughput("files")
+        batch = {}
+        with ThreadPoolExecutor(
+            max_workers=self.scan_workers, thread_name_prefix="sbackup-scan"
+        ) as executor:
+            running = {
+                executor.submit(
+                    self.__scan_directory, location, Path(location).name
+                )
+            }
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirs = future.result()
+                    for path, prefix in subdirs:
+                        running.add(
+                            executor.submit(self.__scan_directory, path, prefix)
+                        )
+                    color_log("debug", " *** scanned %d files", len(files))
+                    scanned.add(len(files))
+                    batch.update(files)
+                    if len(batch) >= LOCAL_BATCH_SIZE:
+                        self.__save_entries(db_key, batch)
+                        batch = {}
+        if batch:
+            self.__save_entries(db_key, batch)
+
+        print(f" Scanned {scanned} in '{location}'.")
+
     def save_files_list_in_db(
         self,
         option,
@@ -406,8 +2433,8 @@ class SafeBackup:
                                         <bucket_name> or '*' for all buckets
 
         """
-        files_path = ""
         db_key = ""
+        self.unchanged = Throughput("entries")
         match source:
             case "s3":
                 color_log(
@@ -437,112 +2464,789 @@ class SafeBackup:
                             bucket, command_key, first_marker=first_marker
                         )
 
-            case "local":
-                color_log(
-                    "debug",
-                    " *** save_files_list_in_db() => Source is a local.",
+            case "local":
+                color_log(
+                    "debug",
+                    " *** save_files_list_in_db() => Source is a local.",
+                )
+                if Path(location).is_dir() and Path(location).exists:
+                    color_log(
+                        "debug",
+                        " *** save_files_...() => Location is a directory.",
+                    )
+                    db_key = f"{source}:{location}"
+                    self.__scan_local(db_key, location)
+                    if logging.root.isEnabledFor(logging.DEBUG):
+                        color_log(
+                            "debug",
+                            " *** save_files_...() => %s",
+                            DB.get_keys(self),
+                        )
+                    print(f"Files list created in '{db_key = }' successfuly.")
+                else:
+                    print("location is not directory or not exist.")
+                    exit(1)
+            case _:
+                print("Source is not valied.")
+        if self.incremental:
+            print(f" Skipped {self.unchanged.count} unchanged entries.")
+        return db_key
+
+    def __server_side_copy(self):
+        """
+        Tell if the destination can read the source itself: both sides
+        are the same endpoint and account, so CopyObject works.
+        """
+
+        accounts = self.__s3_accounts
+        return accounts.get("source") == accounts.get("dest")
+
+    def __relay_object(self, source_copy, dest_bucket, key, head):
+        """
+        Copy a small object between endpoints through this host with one
+        GET and one PUT, keeping its headers. Return the new ETag.
+        """
+
+        body = self.s3_source_client.get_object(**source_copy)["Body"].read()
+        return self.s3_dest_client.put_object(
+            Bucket=dest_bucket,
+            Key=key,
+            Body=body,
+            **{name: head[name] for name in RELAY_HEADERS if name in head},
+        )["ETag"]
+
+    def __multipart_copy(
+        self, source_copy, dest_bucket, key, head, part_size=None
+    ):
+        """
+        Copy a large object in multipart_chunksize parts, or part_size
+        when given, on max_concurrency threads and return the ETag of the
+        copy. Parts are copied server-side with UploadPartCopy, or
+        between endpoints relayed from a ranged GET to an UploadPart, so
+        at most max_concurrency parts are held in memory.
+        """
+
+        client = self.s3_dest_client
+        relay = not self.__server_side_copy()
+        size = head["ContentLength"]
+        # S3 needs parts of at least 5 MiB and allows 10000 of them.
+        part_size = part_size or max(
+            self.transfer_config.multipart_chunksize,
+            MIN_PART_SIZE,
+            -(-size // MAX_PARTS),
+        )
+        upload_id = client.create_multipart_upload(
+            Bucket=dest_bucket,
+            Key=key,
+            **{name: head[name] for name in RELAY_HEADERS if name in head},
+        )["UploadId"]
+
+        def copy_part(number):
+            start = (number - 1) * part_size
+            end = min(start + part_size, size) - 1
+            if relay:
+                body = self.s3_source_client.get_object(
+                    **source_copy, Range=f"bytes={start}-{end}"
+                )["Body"].read()
+                response = client.upload_part(
+                    Bucket=dest_bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=body,
+                )
+                return {"PartNumber": number, "ETag": response["ETag"]}
+            response = client.upload_part_copy(
+                Bucket=dest_bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                CopySource=source_copy,
+                CopySourceRange=f"bytes={start}-{end}",
+            )
+            return {
+                "PartNumber": number,
+                "ETag": response["CopyPartResult"]["ETag"],
+            }
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.transfer_config.max_request_concurrency
+            ) as executor:
+                parts = list(
+                    executor.map(copy_part, range(1, -(-size // part_size) + 1))
+                )
+            return client.complete_multipart_upload(
+                Bucket=dest_bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )["ETag"]
+        except Exception:
+            client.abort_multipart_upload(
+                Bucket=dest_bucket, Key=key, UploadId=upload_id
+            )
+            raise
+
+    def __pack_add(self, bucket, member, path):
+        """
+        Add a small file to the pending pack and upload the pack when it
+        reaches --pack bytes. Its member stays claimed until then.
+        """
+
+        with self.__pack_lock:
+            self.__pack.append((member, path))
+            self.__pack_bytes += os.path.getsize(path)
+            if self.__pack_bytes < self.pack_size:
+                return
+            pack, self.__pack, self.__pack_bytes = self.__pack, [], 0
+        self.__pack_upload(bucket, pack)
+
+    def __pack_upload(self, bucket, pack):
+        """
+        Write the (member, path) files of a pack into one tar archive,
+        each file as its own zstd frame when --pack-compress is 'zstd',
+        upload it and index every member by archive, offset and length.
+        A file gone since it was added fails alone; when the archive
+        cannot be written or uploaded all of its members fail. Failed
+        members are requeued at the end of the transfer.
+        """
+
+        codec = self.pack_compress
+        if codec == "zstd":
+            compressor = zstandard.ZstdCompressor()
+        archive = f"{PACK_PREFIX}/{time.time_ns()}-{uuid.uuid4().hex}.tar"
+        index = {}
+        missing = []
+        try:
+            with tempfile.SpooledTemporaryFile(self.pack_size) as spool:
+                with tarfile.open(fileobj=spool, mode="w") as tar:
+                    for member, path in pack:
+                        try:
+                            stat = os.stat(path)
+                            with open(path, "rb") as file:
+                                data = file.read()
+                        except FileNotFoundError:
+                            print(f" The file {path} not exists!")
+                            missing.append(member)
+                            continue
+                        if codec == "zstd":
+                            data = compressor.compress(data)
+                        info = tarfile.TarInfo(
+                            member if codec == "none" else f"{member}.zst"
+                        )
+                        info.size = len(data)
+                        info.mtime = stat.st_mtime
+                        info.mode = stat.st_mode & 0o7777
+                        header = info.tobuf(
+                            tar.format, tar.encoding, tar.errors
+                        )
+                        offset = tar.offset + len(header)
+                        index[member] = json.dumps(
+                            [archive, offset, len(data), codec]
+                        )
+                        tar.addfile(info, io.BytesIO(data))
+                if index:
+                    spool.seek(0)
+                    self.s3_dest_client.upload_fileobj(
+                        spool, bucket, archive, Config=self.transfer_config
+                    )
+        except (OSError, ClientError, BotoCoreError) as e:
+            print(f" There was an error: {e}")
+            with self.__pack_lock:
+                self.__pack_failed.extend(member for member, _ in pack)
+            return
+        if index:
+            DB.ack(
+                self,
+                self.__pack_claimed_key,
+                list(index),
+                f"s3:{bucket}-pack_index_sbackup",
+                index,
+            )
+        with self.__pack_lock:
+            self.__pack_uploaded += len(index)
+            self.__pack_failed.extend(missing)
+        color_log("debug", " *** packed %d files in %s", len(index), archive)
+
+    def restore_packed_member(self, db_key, member, destination):
+        """
+        Restore one packed file from an s3:<BUCKET> backup with a single
+        ranged GET of its bytes in the archive.
+        """
+
+        bucket = db_key.split(":")[1]
+        entry = DB.hash_get(self, f"{db_key}-pack_index_sbackup", member)
+        if entry is None:
+            return False
+        archive, offset, length, codec = json.loads(entry)
+        body = self.s3_source_client.get_object(
+            Bucket=bucket,
+            Key=archive,
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )["Body"].read()
+        if codec == "zstd":
+            body = zstandard.ZstdDecompressor().decompress(body)
+        os.makedirs(Path(f"{destination}/{member}").parent, exist_ok=True)
+        with open(f"{destination}/{member}", "wb") as file:
+            file.write(body)
+        return True
+
+    def __upload_file(self, path, bucket, key):
+        """
+        Upload a local file, compressed on the fly when --compress is
+        set. The codec is saved in the object metadata. With --checksum
+        the bytes are hashed while they are read, the ETag S3 computed
+        is checked and (content, uploaded) checksums are returned.
+        """
+
+        config = self.transfer_config
+        if self.compress == "none" and not self.checksum:
+            self.s3_dest_client.upload_file(path, bucket, key, Config=config)
+            return None
+        extra_args = {}
+        if self.compress != "none":
+            extra_args["Metadata"] = {CODEC_METADATA: self.compress}
+        # A stream has no size, so s3transfer cuts parts of exactly the
+        # chunksize and the ETag can be computed beforehand.
+        sent = StreamChecksum(
+            max(config.multipart_chunksize, MIN_PART_SIZE),
+            config.multipart_threshold,
+            digest="auto" if self.compress == "none" else None,
+        )
+        content = sent if self.compress == "none" else StreamChecksum()
+        with open(path, "rb") as file:
+            stream = file
+            if self.checksum and content is not sent:
+                stream = HashingReader(stream, content)
+            if self.compress != "none":
+                stream = CompressingReader(
+                    stream, self.compress, self.codec_stats
+                )
+            if self.checksum:
+                stream = HashingReader(stream, sent)
+            self.s3_dest_client.upload_fileobj(
+                stream, bucket, key, ExtraArgs=extra_args, Config=config
+            )
+        if not self.checksum:
+            return None
+        etag = self.s3_dest_client.head_object(Bucket=bucket, Key=key)["ETag"]
+        if etag.strip('"') != sent.etag:
+            raise ValueError(
+                f"s3:{bucket}/{key} has ETag {etag} instead of {sent.etag}"
+            )
+        return content, sent
+
+    def __download_file(self, bucket, key, path):
+        """
+        Download an object to a temporary file next to path that is
+        renamed to path once complete, so a failed download never leaves
+        a partial file behind. A HEAD tells the size and codec: large
+        plain objects are fetched with parallel ranged GETs, unless
+        --checksum hashes the stream and checks it against the ETag, the
+        other ones are streamed and decompressed on the fly. Return the
+        checksum of the written content with --checksum.
+        """
+
+        head = self.s3_source_client.head_object(Bucket=bucket, Key=key)
+        codec = head.get("Metadata", {}).get(CODEC_METADATA)
+        limit = TokenBucket(self.transfer_config.max_bandwidth or 0)
+        part = f"{path}.{uuid.uuid4().hex[:8]}.sbackup"
+        try:
+            if (
+                not codec
+                and not self.checksum
+                and head["ContentLength"]
+                >= self.transfer_config.multipart_threshold
+            ):
+                self.__ranged_download(
+                    bucket,
+                    key,
+                    head["ContentLength"],
+                    head["ETag"],
+                    part,
+                    limit,
+                )
+                content = None
+            else:
+                for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+                    try:
+                        content = self.__stream_download(
+                            bucket, key, head, part, limit
+                        )
+                        break
+                    except BotoCoreError as e:
+                        if attempt == DOWNLOAD_ATTEMPTS:
+                            raise
+                        color_log("debug", " *** retry %r: %s", key, e)
+            os.replace(part, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(part)
+            raise
+        return content
+
+    def __stream_download(self, bucket, key, head, path, limit):
+        """
+        Write an object to path with one GET pinned to the ETag of its
+        head, taking its bytes from the limit token bucket. A response
+        cut short raises IncompleteReadError, to be retried.
+        """
+
+        codec = head.get("Metadata", {}).get(CODEC_METADATA)
+        etag = head["ETag"].strip('"')
+        received = content = None
+        if self.checksum:
+            digest = None if codec else "auto"
+            if "-" in etag:
+                # A multipart ETag depends on the part size of the upload.
+                part_size = self.s3_source_client.head_object(
+                    Bucket=bucket, Key=key, PartNumber=1
+                )["ContentLength"]
+                received = StreamChecksum(part_size, digest=digest)
+            else:
+                size = head["ContentLength"] + 1
+                received = StreamChecksum(size, size, digest=digest)
+            content = StreamChecksum() if codec else received
+        body = self.s3_source_client.get_object(
+            Bucket=bucket, Key=key, IfMatch=head["ETag"]
+        )["Body"]
+        decompressor = make_decompressor(codec) if codec else None
+        read = 0
+        with open(path, "wb") as file:
+            for chunk in body.iter_chunks(CODEC_CHUNK_SIZE):
+                limit.take(len(chunk))
+                read += len(chunk)
+                if received is not None:
+                    received.update(chunk)
+                if decompressor is None:
+                    file.write(chunk)
+                    continue
+                start = time.thread_time()
+                data = decompressor.decompress(chunk)
+                self.codec_stats.add(
+                    len(data), len(chunk), time.thread_time() - start
+                )
+                if content is not None:
+                    content.update(data)
+                file.write(data)
+        if read != head["ContentLength"]:
+            raise IncompleteReadError(
+                actual_bytes=read, expected_bytes=head["ContentLength"]
+            )
+        if received is not None and received.etag != etag:
+            raise ValueError(
+                f"s3:{bucket}/{key} has ETag {etag} but {received.etag} "
+                "was received"
+            )
+        return content
+
+    def __ranged_download(self, bucket, key, size, etag, path, limit):
+        """
+        Download a large object as multipart_chunksize ranged GETs on
+        max_concurrency threads, each written at its offset into path
+        preallocated to the size of the object. Every GET is pinned to
+        the ETag, so parts of a newer version fail the download, takes
+        its bytes from the limit token bucket, and is retried up to
+        DOWNLOAD_ATTEMPTS times when it breaks off or comes back short.
+        """
+
+        part_size = self.transfer_config.multipart_chunksize
+        with open(path, "wb") as file:
+            try:
+                os.posix_fallocate(file.fileno(), 0, size)
+            except (AttributeError, OSError):
+                # Not on this platform or file system, leave it sparse.
+                file.truncate(size)
+
+        def get_part(start):
+            end = min(start + part_size, size) - 1
+            body = self.s3_source_client.get_object(
+                Bucket=bucket,
+                Key=key,
+                Range=f"bytes={start}-{end}",
+                IfMatch=etag,
+            )["Body"]
+            with open(path, "r+b") as file:
+                file.seek(start)
+                for chunk in body.iter_chunks(CODEC_CHUNK_SIZE):
+                    limit.take(len(chunk))
+                    file.write(chunk)
+                if file.tell() != end + 1:
+                    raise IncompleteReadError(
+                        actual_bytes=file.tell() - start,
+                        expected_bytes=end + 1 - start,
+                    )
+
+        def get_part_retried(start):
+            for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+                try:
+                    return get_part(start)
+                except BotoCoreError as e:
+                    if attempt == DOWNLOAD_ATTEMPTS:
+                        raise
+                    color_log(
+                        "debug", " *** retry %r at %d: %s", key, start, e
+                    )
+
+        with ThreadPoolExecutor(
+            max_workers=self.transfer_config.max_request_concurrency
+        ) as executor:
+            list(executor.map(get_part_retried, range(0, size, part_size)))
+
+    def __copy_file(self, path, dest):
+        """
+        Copy a local file with its metadata like shutil.copy2, hashing
+        the bytes on the way, and return the checksum.
+        """
+
+        checksum = StreamChecksum()
+        with open(path, "rb") as source, open(dest, "wb") as file:
+            while chunk := source.read(CODEC_CHUNK_SIZE):
+                checksum.update(chunk)
+                file.write(chunk)
+        shutil.copystat(path, dest)
+        return checksum
+
+    def __makedirs(self, path):
+        """
+        Create a destination directory once; later files in it only cost
+        a set lookup.
+        """
+
+        if path in self.__dirs_made:
+            return
+        os.makedirs(path, exist_ok=True)
+        self.__dirs_made.add(path)
+
+    def __save_checksum(self, destination, member, size, digest, etag=None):
+        """
+        Save the size, content digest and ETag of a transferred member
+        for --verify.
+        """
+
+        record = {"size": size}
+        if digest:
+            record["digest"] = digest
+        if etag:
+            record["etag"] = etag
+        DB.hash_set(
+            self,
+            f"{destination}-checksums_sbackup",
+            member,
+            json.dumps(record),
+        )
+
+    def __dedup_upload(self, stream, bucket, key):
+        """
+        Split a stream into content-defined chunks, upload the chunks the
+        chunk index of the bucket does not know yet and save the file as
+        a recipe listing its chunks.
+        """
+
+        index_key = f"s3:{bucket}-chunks_sbackup"
+        chunks = []
+        size = 0
+        cpu = time.thread_time()
+        for chunk in cdc_chunks(stream):
+            digest = hashlib.sha256(chunk).hexdigest()
+            chunks.append([digest, len(chunk)])
+            size += len(chunk)
+            cpu = time.thread_time() - cpu
+            if DB.set_contains(self, index_key, digest):
+                self.dedup_stats.add(len(chunk), 0, cpu)
+                cpu = time.thread_time()
+                continue
+            self.s3_dest_client.put_object(
+                Bucket=bucket,
+                Key=f"{DEDUP_PREFIX}/chunks/{digest[:2]}/{digest}",
+                Body=chunk,
+            )
+            # Only an uploaded chunk is added to the index.
+            DB.set_add(self, index_key, digest)
+            self.dedup_stats.add(len(chunk), len(chunk), cpu)
+            cpu = time.thread_time()
+        self.s3_dest_client.put_object(
+            Bucket=bucket,
+            Key=f"{DEDUP_PREFIX}/recipes/{key}",
+            Body=json.dumps({"size": size, "chunks": chunks}).encode(),
+            ContentType="application/json",
+        )
+
+    def __dedup_restore(self, bucket, recipe_key, path):
+        """
+        Rebuild a file from its recipe, checking every chunk's hash.
+        """
+
+        recipe = json.loads(
+            self.s3_source_client.get_object(Bucket=bucket, Key=recipe_key)[
+                "Body"
+            ].read()
+        )
+        with open(path, "wb") as file:
+            for digest, _ in recipe["chunks"]:
+                chunk = self.s3_source_client.get_object(
+                    Bucket=bucket,
+                    Key=f"{DEDUP_PREFIX}/chunks/{digest[:2]}/{digest}",
+                )["Body"].read()
+                if hashlib.sha256(chunk).hexdigest() != digest:
+                    raise ValueError(f"chunk {digest} of {recipe_key} is bad")
+                file.write(chunk)
+
+    def __transfer_member(self, db_key, source, destination, member):
+        """
+        Copy one member to the destination and return True on success.
+        """
+
+        # Backup from local to local
+        if source[0] == "local" and not destination.startswith("s3:"):
+            color_log(
+                "debug",
+                "*** <local to local> *** download_files_...()=> "
+                "source = %s/%s --> dest = %s/%s",
+                source[1],
+                member,
+                destination,
+                member,
+            )
+            parent = Path(f"{destination}/{member}").parent
+            self.__makedirs(parent)
+            match source[0]:
+                case "local":
+                    try:
+                        if not self.checksum:
+                            path = f"{Path(source[1]).parent}/{member}"
+                            start = time.monotonic()
+                            method, size = fast_copy(
+                                path,
+                                f"{destination}/{member}",
+                                self.__copy_unsupported,
+                            )
+                            shutil.copystat(path, f"{destination}/{member}")
+                            self.copy_stats.add(
+                                method, size, time.monotonic() - start
+                            )
+                            METRICS.inc(
+                                "sbackup_transferred_bytes_total",
+                                size,
+                                path="local",
+                            )
+                        else:
+                            checksum = self.__copy_file(
+                                f"{Path(source[1]).parent}/{member}",
+                                f"{destination}/{member}",
+                            )
+                            self.__save_checksum(
+                                destination,
+                                member,
+                                checksum.size,
+                                checksum.digest,
+                            )
+                            METRICS.inc(
+                                "sbackup_transferred_bytes_total",
+                                checksum.size,
+                                path="local",
+                            )
+                    except Exception as e:
+                        print(f"There was an error: {e}")
+                        return False
+                case "s3":
+                    try:
+                        self.s3_source_client.download_file(
+                            source[1],
+                            member,
+                            f"{destination}/{member}",
+                            Config=self.transfer_config,
+                        )
+                    except Exception as e:
+                        print(f"There was an error: {e}")
+                        return False
+
+        # Backup from s3 to s3
+        elif db_key.startswith("s3:") and destination.startswith("s3:"):
+            s3_dest_bucket = destination.split(":")[1]
+            color_log(
+                "debug",
+                " *** <s3 to s3> *** member = %r --> dest = s3:%s",
+                member,
+                s3_dest_bucket,
+            )
+
+            color_log(
+                "debug",
+                " *** <s3 to s3> *** source[1] = %r -> ./%s/%s",
+                source[1],
+                destination,
+                member,
+            )
+
+            if self.dedup:
+                try:
+                    body = self.s3_source_client.get_object(
+                        Bucket=source[1], Key=member
+                    )["Body"]
+                    self.__dedup_upload(body, s3_dest_bucket, member)
+                except (ClientError, BotoCoreError, OSError) as e:
+                    print(f" There was an error: {e}")
+                    return False
+                return True
+
+            # upload to s3 destination
+            source_copy = {"Bucket": source[1], "Key": member}
+            try:
+                head = self.s3_source_client.head_object(
+                    Bucket=source[1], Key=member
                 )
-                if Path(location).is_dir() and Path(location).exists:
-                    color_log(
-                        "debug",
-                        " *** save_files_...() => Location is a directory.",
+                source_etag = head["ETag"].strip('"')
+                part_size = None
+                if self.checksum and "-" in source_etag:
+                    # Copied in the parts of the source, the copy must
+                    # have the same ETag.
+                    part_size = self.s3_source_client.head_object(
+                        Bucket=source[1], Key=member, PartNumber=1
+                    )["ContentLength"]
+                if (
+                    part_size
+                    or head["ContentLength"]
+                    >= self.transfer_config.multipart_threshold
+                ):
+                    etag = self.__multipart_copy(
+                        source_copy, s3_dest_bucket, member, head, part_size
                     )
-                    root_path = location.split(os.sep)[-1]
-                    files_path = root_path
-                    for folderName, subfolders, filenames in os.walk(location):
-                        fn_split = folderName.split(os.sep)
-                        fp_split = files_path.split(os.sep)
-                        color_log(
-                            "debug",
-                            " *** save_files_...() => 1"
-                            "-----------------------------------------------",
-                        )
-                        color_log(
-                            "debug",
-                            " *** save_files_...() => "
-                            "The folderName is " + folderName,
-                        )
-                        color_log(
-                            "debug",
-                            " *** save_files_...() => "
-                            "The folderName.split(os.sep)[-1] folder is "
-                            + fn_split[-1],
-                        )
-                        color_log(
-                            "debug",
-                            " *** save_files_...() => "
-                            "The files_path folder is " + files_path,
-                        )
-                        color_log(
-                            "debug",
-                            " *** save_files_...() => "
-                            "The files_path.split(os.sep)[-1] folder is "
-                            + fp_split[-1],
-                        )
-                        color_log(
-                            "debug",
-                            " *** save_files_...() => "
-                            "2 ---------------------------------------------",
-                        )
-                        if not fn_split[-1] == files_path:
-                            color_log(
-                                "debug",
-                                " *** save_files_...() => "
-                                "The folderName.split(os.sep)[-2] folder is "
-                                + fn_split[-2],
-                            )
-                            if fn_split[-2] == fp_split[-1]:
-                                parent_path = files_path
-                                files_path += f"/{fn_split[-1]}"
-                                color_log(
-                                    "debug",
-                                    " *** save_files_...() => if : "
-                                    "The current files_path is " + files_path,
-                                )
-                            elif fn_split[-2] == fp_split[-2]:
-                                files_path = f"{parent_path}/{fn_split[-1]}"
-                                color_log(
-                                    "debug",
-                                    " *** save_files_...() => elif 1: "
-                                    "The current files_path is " + files_path,
-                                )
-                            elif fn_split[-2] == root_path:
-                                files_path = f"{root_path}/{fn_split[-1]}"
-                                color_log(
-                                    "debug",
-                                    " *** save_files_...() => elif 2: "
-                                    "The current files_path is " + files_path,
-                                )
-
-                        for filename in filenames:
-                            color_log(
-                                "debug",
-                                " *** save_files_...() => FILE INSIDE "
-                                + files_path
-                                + ": "
-                                + filename,
-                            )
-                            file_path = f"{files_path}/{filename}"
-                            db_key = f"{source}:{location}"
-                            DB.set_add(self, db_key, file_path)
-                    color_log(
-                        "debug",
-                        f" *** save_files_...() => {DB.get_keys(self)}",
+                elif not self.__server_side_copy():
+                    etag = self.__relay_object(
+                        source_copy, s3_dest_bucket, member, head
                     )
-                    print(f"Files list created in '{db_key = }' successfuly.")
                 else:
-                    print("location is not directory or not exist.")
-                    exit(1)
-            case _:
-                print("Source is not valied.")
-        return db_key
+                    etag = self.s3_dest_client.copy_object(
+                        CopySource=source_copy,
+                        Bucket=s3_dest_bucket,
+                        Key=member,
+                    )["CopyObjectResult"]["ETag"]
+            except (ClientError, BotoCoreError, OSError) as e:
+                print(f" There was an error: {e}")
+                return False
+            if self.checksum:
+                etag = etag.strip('"')
+                if "-" in etag and "-" not in source_etag:
+                    # The MD5 of a whole object cannot be checked against
+                    # the ETag of its parts without reading it again.
+                    print(f" The copy of {member} in parts is not verified.")
+                    return True
+                if etag != source_etag:
+                    print(f" The copy of {member} has ETag {etag}!")
+                    return False
+                self.__save_checksum(
+                    destination, member, head["ContentLength"], None, etag
+                )
+
+        # Backup from local to s3
+        elif source[0] == "local" and destination.startswith("s3:"):
+            s3_dest_bucket = destination.split(":")[1]
+            color_log(
+                "debug",
+                " *** <local to s3> *** member = %r --> dest = s3:%s",
+                member,
+                s3_dest_bucket,
+            )
+            color_log(
+                "debug",
+                " *** <local to s3> *** source[1] = %r -> ./%s/%s",
+                source[1],
+                destination,
+                member,
+            )
+            color_log("debug", " *** elif-2 *** member = %r", member)
+            source_path_parent = Path(source[1]).parent
+            if self.dedup:
+                try:
+                    with open(f"{source_path_parent}/{member}", "rb") as file:
+                        self.__dedup_upload(file, s3_dest_bucket, member)
+                except (OSError, ClientError) as e:
+                    print(f" There was an error: {e}")
+                    return False
+                return True
+            if (
+                self.pack_size
+                and os.path.isfile(f"{source_path_parent}/{member}")
+                and os.path.getsize(f"{source_path_parent}/{member}")
+                < self.pack_threshold
+            ):
+                self.__pack_add(
+                    s3_dest_bucket,
+                    member,
+                    f"{source_path_parent}/{member}",
+                )
+                return PACKED
+            if os.path.exists(Path(f"{source_path_parent}/{member}")):
+                try:
+                    checksums = self.__upload_file(
+                        f"{source_path_parent}/{member}",
+                        s3_dest_bucket,
+                        member,
+                    )
+                    if checksums:
+                        content, sent = checksums
+                        self.__save_checksum(
+                            destination,
+                            member,
+                            sent.size,
+                            content.digest,
+                            sent.etag,
+                        )
+                except (ClientError, ValueError) as e:
+                    print(f" There was an error: {e}")
+                    return False
+            else:
+                spp = source_path_parent
+                print(f" The file {spp}/{member} not exists!")
+                return False
+
+        # Backup from s3 to local
+        elif source[0] == "s3" and not destination.startswith("s3:"):
+            if member.startswith(f"{DEDUP_PREFIX}/chunks/"):
+                # Chunks are only read through the recipes.
+                return True
+            path = f"{destination}/{member}"
+            if member.startswith(f"{DEDUP_PREFIX}/recipes/"):
+                path = f"{destination}/{member[len(DEDUP_PREFIX) + 9:]}"
+            parent = Path(path).parent
+            self.__makedirs(parent)
+            try:
+                if member.startswith(f"{DEDUP_PREFIX}/recipes/"):
+                    self.__dedup_restore(source[1], member, path)
+                else:
+                    checksum = self.__download_file(source[1], member, path)
+                    if checksum:
+                        self.__save_checksum(
+                            destination,
+                            member,
+                            checksum.size,
+                            checksum.digest,
+                        )
+            except Exception as e:
+                print(f"There was an error: {e}")
+                return False
+        else:
+            print(" Something went wrong in download process!")
+            exit(2)
+        return True
 
     def download_files_list_from_db(
         self,
         option,
         db_key,
         destination,
+        batches=None,
     ):
+        """
+        Copy the members of the db set to the destination, or only the
+        given batches of members, e.g. a queue filled while the source is
+        listed. Members are claimed from the set in batches, moving them
+        to a claimed set, and acknowledged in batches once transferred;
+        failed ones go back to the set at the end.
+        """
+
         source = db_key.split(":")
         color_log(
             "debug",
@@ -550,158 +3254,338 @@ class SafeBackup:
         )
 
         db_key_worker = f"{db_key}-{option}__{destination}"
-        for member in DB.get_elements(self, db_key, 0):
-            DB.set(self, f"{db_key_worker}-work_sbackup", member)
+        claimed_key = f"{db_key_worker}-claimed_sbackup"
+        bucket_requests = 0
+        if destination.startswith("s3:"):
+            bucket_requests = self.__prepare_dest_bucket(
+                destination.split(":")[1]
+            )
 
-            # Backup from local to local
-            if source[0] == "local" and not destination.startswith("s3:"):
-                color_log(
-                    "debug",
-                    f"*** <local to local> *** download_files_...()=> "
-                    f"source = {Path(source[1]).parent}/{member} "
-                    f"--> dest = {destination}/{member}",
-                )
-                parent = Path(f"{destination}/{member}").parent
-                if not os.path.exists(parent):
-                    os.makedirs(parent)
-                match source[0]:
-                    case "local":
-                        try:
-                            shutil.copy2(
-                                f"{Path(source[1]).parent}/{member}",
-                                f"{destination}/{member}",
-                            )
-                        except Exception as e:
-                            print(f"There was an error: {e}")
-                    case "s3":
-                        try:
-                            self.s3_source_client.download_file(
-                                source[1],
-                                member,
-                                f"{destination}/{member}",
-                            )
-                        except Exception as e:
-                            print(f"There was an error: {e}")
+        if self.pack_size:
+            self.__pack = []
+            self.__pack_bytes = 0
+            self.__pack_lock = threading.Lock()
+            self.__pack_claimed_key = claimed_key
+            # Packed members count once their pack is uploaded.
+            self.__pack_uploaded = 0
+            self.__pack_failed = []
 
-            # Backup from s3 to s3
-            elif db_key.startswith("s3:") and destination.startswith("s3:"):
-                s3_dest_bucket = destination.split(":")[1]
-                color_log(
-                    "debug",
-                    f" *** <s3 to s3> *** {member = } --> "
-                    f"dest = s3:{s3_dest_bucket}",
-                )
+        transferred = Throughput("files")
+        running = {}
+        acks = []
+        failures = []
+        kind = "s3" if destination.startswith("s3:") else "local"
+        METRICS.set("sbackup_workers", self.workers)
+        METRICS.set_function(
+            "sbackup_pending_members",
+            lambda: DB.set_size(self, db_key),
+            db_key=db_key,
+        )
+        METRICS.set_function(
+            "sbackup_claimed_members",
+            lambda: DB.set_size(self, claimed_key),
+            db_key=db_key,
+        )
 
-                color_log(
-                    "debug",
-                    f" *** <s3 to s3> *** {source[1] = } -> "
-                    f"./{destination}/{member}",
+        def transfer(member):
+            METRICS.inc("sbackup_workers_busy")
+            start = time.monotonic()
+            try:
+                return self.__transfer_member(
+                    db_key, source, destination, member
+                )
+            finally:
+                METRICS.inc("sbackup_workers_busy", -1)
+                METRICS.inc(
+                    "sbackup_worker_busy_seconds_total",
+                    time.monotonic() - start,
                 )
 
-                # upload to s3 destination
-                # Check destination bucket and create it if not exists
+        def count(futures):
+            for future in futures:
+                member = running.pop(future)
                 try:
-                    color_log(
-                        "debug",
-                        f" ** <s3 to s3> ** "
-                        f"{self.s3_dest_client.list_buckets()['Buckets'] = }",
-                    )
-                    self.s3_dest_client.head_bucket(Bucket=s3_dest_bucket)
-                except ClientError:
-                    # The bucket does not exist or you have no access.
-                    # Create the destination bucket.
-                    if not self.__create_bucket(
-                        self.s3_dest_client,
-                        s3_dest_bucket,
-                        self.__region_dest,
-                    ):
-                        print(
-                            "  ######  There was a problem to "
-                            "create destination bucket!"
-                        )
-                        exit(1)
+                    result = future.result()
+                except Exception as e:
+                    # One member must not abort the batch, it is requeued.
+                    print(f" There was an error with {member}: {e}")
+                    result = False
+                if not result:
+                    failures.append(member)
+                    METRICS.inc("sbackup_errors_total", type="transfer")
+                    continue
+                if result is PACKED:
+                    # Packed members are counted and acknowledged with
+                    # their pack.
+                    continue
+                transferred.add()
+                METRICS.inc(
+                    "sbackup_transferred_objects_total", destination=kind
+                )
+                acks.append(member)
+            if len(acks) >= ACK_BATCH_SIZE:
+                DB.ack(self, claimed_key, acks)
+                acks.clear()
 
-                source_copy = {"Bucket": source[1], "Key": member}
-                try:
-                    self.s3_dest_client.copy(
-                        source_copy,
-                        s3_dest_bucket,
-                        member,
+        if batches is None:
+            claims = iter(
+                lambda: DB.claim(
+                    self, db_key, claimed_key, count=self.workers * 2
+                ),
+                [],
+            )
+        else:
+            claims = (
+                DB.claim(self, db_key, claimed_key, members=batch)
+                for batch in batches
+            )
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="sbackup-worker"
+        ) as executor:
+            for claim in claims:
+                for member in claim:
+                    # Keep the number of queued members bounded.
+                    if len(running) >= self.workers * 2:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        count(done)
+                    future = executor.submit(transfer, member)
+                    running[future] = member
+            count(wait(running).done)
+        if self.pack_size:
+            if self.__pack:
+                self.__pack_upload(destination.split(":")[1], self.__pack)
+                self.__pack = []
+            transferred.add(self.__pack_uploaded)
+            METRICS.inc(
+                "sbackup_transferred_objects_total",
+                self.__pack_uploaded,
+                destination=kind,
+            )
+            if self.__pack_failed:
+                failures.extend(self.__pack_failed)
+                METRICS.inc(
+                    "sbackup_errors_total",
+                    len(self.__pack_failed),
+                    type="transfer",
+                )
+        DB.ack(self, claimed_key, acks)
+        DB.requeue(self, db_key, claimed_key, failures)
+        failed = len(failures)
+
+        if not transferred.count + failed:
+            return
+        print(f" Transferred {transferred} with {self.workers} workers.")
+        if destination.startswith("s3:"):
+            # Each member used to cost a list_buckets and a head_bucket.
+            saved = 2 * (transferred.count + failed) - bucket_requests
+            print(f" Saved {max(saved, 0)} destination bucket requests.")
+        if self.codec_stats.raw:
+            print(f" Compression handled {self.codec_stats}.")
+        if self.dedup_stats.raw:
+            print(f" Deduplication stored {self.dedup_stats}.")
+        pool = DB.pool_stats(self)
+        if pool:
+            print(
+                f" Used at most {pool['peak']} of {pool['max_connections']} "
+                f"db connections, waiting {pool['waited']:.2f}s for them."
+            )
+        for line in self.copy_stats.lines():
+            print(f" Copied {line}.")
+        if self.limiter.slowdowns:
+            print(f" Backed off {self.limiter.slowdowns} times on SlowDown.")
+        if failed:
+            print(f" {failed} files failed and remain in '{db_key}'.")
+
+    def verify_files(self, destination):
+        """
+        Check a finished backup against the checksums saved by --checksum
+        without copying data again: HEAD every object of s3:<BUCKET> for
+        its size and ETag, or re-hash every file of a local directory.
+        Return the members that do not match.
+        """
+
+        records = DB.hash_get_all(self, f"{destination}-checksums_sbackup")
+        verified = Throughput("files")
+
+        def check(member):
+            record = json.loads(records[member])
+            try:
+                if destination.startswith("s3:"):
+                    head = self.s3_dest_client.head_object(
+                        Bucket=destination.split(":")[1], Key=member
                     )
-                except ClientError as e:
-                    print(f" There was an error: {e}")
-                    exit(1)
+                    etag = head["ETag"].strip('"')
+                    matches = head["ContentLength"] == record["size"] and (
+                        record.get("etag", etag) == etag
+                    )
+                else:
+                    path = f"{destination}/{member}"
+                    matches = os.path.getsize(path) == record["size"] and (
+                        "digest" not in record
+                        or hash_file(path, record["digest"]) == record["digest"]
+                    )
+            except (ClientError, OSError, ValueError) as e:
+                color_log("debug", " *** verify %r: %s", member, e)
+                matches = False
+            verified.add()
+            return matches
 
-            # Backup from local to s3
-            elif source[0] == "local" and destination.startswith("s3:"):
-                s3_dest_bucket = destination.split(":")[1]
-                color_log(
-                    "debug",
-                    f" *** <local to s3> *** {member = } --> "
-                    f"dest = s3:{s3_dest_bucket}",
+        def checked(member):
+            with PROFILER.stage("verify"):
+                return check(member)
+
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="sbackup-verify"
+        ) as executor:
+            mismatched = [
+                member
+                for member, matches in zip(
+                    records, executor.map(checked, records)
                 )
-                color_log(
-                    "debug",
-                    f" *** <local to s3> *** {source[1] = } -> "
-                    f"./{destination}/{member}",
+                if not matches
+            ]
+        print(f" Verified {verified} with {self.workers} workers.")
+        for member in mismatched:
+            print(f" {member} does not match its checksum!")
+        return mismatched
+
+    def __restore_candidates(self, bucket, paths, prefixes):
+        """
+        Find the files of an s3:<BUCKET> backup under the paths, each a
+        file or a directory, or starting with the prefixes, or all of
+        them without either. Return (group, size, member, kind) tuples
+        in listing order, where group is the index of the first path
+        that matched, or len(paths) for the other files. Files kept with
+        --dedup are found through their recipes and files kept with
+        --pack through the pack index in db.
+        """
+
+        def group(member):
+            for i, path in enumerate(paths):
+                if member == path or member.startswith(f"{path}/"):
+                    return i
+            if not (paths or prefixes) or member.startswith(tuple(prefixes)):
+                return len(paths)
+            return None
+
+        # Prefixes inside another one would list the same keys twice.
+        listed = sorted(set(paths) | set(prefixes)) or [""]
+        listed = [
+            prefix
+            for i, prefix in enumerate(listed)
+            if not any(prefix.startswith(other) for other in listed[:i])
+        ]
+        recipes = f"{DEDUP_PREFIX}/recipes/"
+        source = self.s3_source.Bucket(bucket)
+        candidates = {}
+        for prefix in listed:
+            for kind, start in (("object", ""), ("recipe", recipes)):
+                pages = self.__s3_list_pages(source, f"{start}{prefix}")
+                for page in pages:
+                    for content in page.get("Contents", []):
+                        member = content["Key"][len(start):]
+                        if kind == "object" and member.startswith(".sbackup/"):
+                            continue
+                        found = group(member)
+                        if found is not None:
+                            # A recipe grows with the chunks of its file,
+                            # so its size orders deduplicated files too.
+                            candidates.setdefault(
+                                member, (found, content["Size"], member, kind)
+                            )
+
+        db_key = f"s3:{bucket}"
+        for member, entry in DB.hash_get_all(
+            self, f"{db_key}-pack_index_sbackup"
+        ).items():
+            found = group(member)
+            if found is not None:
+                candidates.setdefault(
+                    member, (found, json.loads(entry)[2], member, "packed")
                 )
-                # Check destination bucket and create it if not exists
-                try:
-                    color_log(
-                        "debug",
-                        f" ** <local to s3> ** "
-                        f"{self.s3_dest_client.list_buckets()['Buckets'] = }",
-                    )
-                    self.s3_dest_client.head_bucket(Bucket=s3_dest_bucket)
-                except ClientError:
-                    # The bucket does not exist or you have no access.
-                    # Create the destination bucket.
-                    if not self.__create_bucket(
-                        self.s3_dest_client, s3_dest_bucket, self.__region_dest
-                    ):
-                        print(
-                            "  ######  There was a problem to "
-                            "create destination bucket!"
-                        )
-                        exit(1)
+        return list(candidates.values())
 
-                color_log(
-                    "debug",
-                    f" *** elif-2 *** {member = } -> " f"{member = }",
+    def __restore_member(self, bucket, member, kind, destination):
+        """
+        Restore one file found by __restore_candidates and return True on
+        success.
+        """
+
+        path = f"{destination}/{member}"
+        try:
+            if kind == "packed":
+                return self.restore_packed_member(
+                    f"s3:{bucket}", member, destination
+                )
+            self.__makedirs(Path(path).parent)
+            if kind == "recipe":
+                self.__dedup_restore(
+                    bucket, f"{DEDUP_PREFIX}/recipes/{member}", path
                 )
-                source_path_parent = Path(source[1]).parent
-                if os.path.exists(Path(f"./{source_path_parent}/{member}")):
-                    try:
-                        self.s3_dest_client.upload_file(
-                            f"./{source_path_parent}/{member}",
-                            s3_dest_bucket,
-                            member,
-                        )
-                    except ClientError as e:
-                        print(f" There was an error: {e}")
-                else:
-                    spp = source_path_parent
-                    print(f" The file ./{spp}/{member} not exists!")
-
-            # Backup from s3 to local
-            elif source[0] == "s3" and not destination.startswith("s3:"):
-                parent = Path(f"./{destination}/{member}").parent
-                if not os.path.exists(parent):
-                    os.makedirs(parent)
-                try:
-                    self.s3_source_client.download_file(
-                        source[1],
-                        member,
-                        f"{destination}/{member}",
-                    )
-                except Exception as e:
-                    print(f"There was an error: {e}")
             else:
-                print(" Something went wrong in download process!")
-                exit(2)
-            DB.set_remove(self, db_key, member)
+                checksum = self.__download_file(bucket, member, path)
+                if checksum:
+                    self.__save_checksum(
+                        destination, member, checksum.size, checksum.digest
+                    )
+        except Exception as e:
+            print(f" There was an error: {e}")
+            return False
+        return True
+
+    def restore_files(
+        self, bucket, destination, paths=(), prefixes=(), order="listed"
+    ):
+        """
+        Restore an s3:<BUCKET> backup to a local directory in priority
+        order: the files under each path in the order the paths are
+        given, then the other matches, or with order 'smallest' the
+        smallest files first. Return the members that failed.
+        """
+
+        start = time.monotonic()
+        paths = [path.strip("/") for path in paths]
+        candidates = self.__restore_candidates(bucket, paths, prefixes)
+        # sort() is stable, so the listing order breaks ties.
+        if order == "smallest":
+            candidates.sort(key=lambda candidate: candidate[1])
         else:
-            DB.delete(self, f"{db_key_worker}-work_sbackup")
+            candidates.sort(key=lambda candidate: candidate[0])
+        print(
+            f" Selected {len(candidates)} files in "
+            f"{time.monotonic() - start:.2f}s."
+        )
+
+        restored = Throughput("files")
+        first = None
+        failed = []
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="sbackup-restore"
+        ) as executor:
+            running = {
+                executor.submit(
+                    self.__restore_member, bucket, member, kind, destination
+                ): member
+                for _, _, member, kind in candidates
+            }
+            for future in as_completed(running):
+                if not future.result():
+                    failed.append(running[future])
+                    METRICS.inc("sbackup_errors_total", type="restore")
+                    continue
+                if first is None:
+                    first = time.monotonic() - start
+                restored.add()
+                METRICS.inc(
+                    "sbackup_transferred_objects_total", destination="local"
+                )
+
+        print(f" Restored {restored} with {self.workers} workers.")
+        if first is not None:
+            print(f" The first file was restored after {first:.2f}s.")
+        for member in failed:
+            print(f" {member} could not be restored!")
+        return failed
 
     def copy_files(self, option, source, location, destination):
         """
@@ -714,10 +3598,37 @@ class SafeBackup:
         lo = location
         command_key = f"{o}__{source}__{lo}__{d}"
 
-        # Make list of source files to db
-        db_key = self.save_files_list_in_db(o, source, lo, command_key)
+        # The lister pushes every new member to a queue that the transfer
+        # workers consume at once. The db set stays the source of truth.
+        db_key = f"{source}:{lo}"
+        self.queue_key = f"{db_key}-d__{d}-queue_sbackup"
+        # An interrupted run may have left its QUEUE_END behind.
+        DB.delete(self, self.queue_key)
+        queue_key = self.queue_key
+        with ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sbackup-lister"
+        ) as lister:
+            # Make list of source files to db
+            listing = lister.submit(
+                self.save_files_list_in_db, o, source, lo, command_key
+            )
+            # Also when the listing fails, so the transfers stop waiting
+            listing.add_done_callback(
+                lambda _: DB.end_queue(self, queue_key)
+            )
+
+            # Download or copy source files as soon as they are listed
+            self.download_files_list_from_db(
+                "d",
+                db_key,
+                d,
+                DB.iter_queue(self, self.queue_key),
+            )
+        self.queue_key = None
+        DB.delete(self, f"{db_key}-d__{d}-queue_sbackup")
+        db_key = listing.result()
 
-        # Download or copy source files list that we made before in db
+        # Retry what is left in the set, e.g. from an earlier run
         self.download_files_list_from_db("d", db_key, d)
 
 
@@ -741,6 +3652,209 @@ def main():
         help="Print version and exit",
     )
 
+    parser.add_argument(
+        "--trace",
+        nargs="+",
+        metavar=("<METHOD>"),
+        help="Log calls and return values of the given DB and SafeBackup "
+        "methods only, e.g. 'set_add_many' (implies -L INFO)",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only list new or changed files, compared by size and mtime "
+        "for 'local' and by ETag and LastModified for 's3' sources",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar=("<N>"),
+        help="Transfer <N> files concurrently (default 1)",
+    )
+
+    parser.add_argument(
+        "--scan-workers",
+        type=int,
+        default=8,
+        metavar=("<N>"),
+        help="Scan <N> local directories or s3 shards concurrently "
+        "(default 8)",
+    )
+
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        metavar=("<N>"),
+        help="List up to <N> s3 keys per request, at most 1000 (default 1000)",
+    )
+
+    parser.add_argument(
+        "--shards",
+        metavar=("<auto | KEY,KEY,...>"),
+        help="List an s3 source as shards, up to --scan-workers at a time: "
+        "'auto' makes one shard per top-level '/' prefix, and a "
+        "comma-separated list of keys splits the bucket into key ranges",
+    )
+
+    parser.add_argument(
+        "--multipart-threshold",
+        type=parse_size,
+        default=os.getenv("SBACKUP_MULTIPART_THRESHOLD", "8MiB"),
+        metavar=("<SIZE>"),
+        help="Transfer objects of at least <SIZE> in parallel parts, with "
+        "server-side UploadPartCopy for s3 to s3 (default 8MiB)",
+    )
+    parser.add_argument(
+        "--multipart-chunksize",
+        type=parse_size,
+        default=os.getenv("SBACKUP_MULTIPART_CHUNKSIZE", "8MiB"),
+        metavar=("<SIZE>"),
+        help="Size of each part of a multipart transfer (default 8MiB)",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=int(os.getenv("SBACKUP_MAX_CONCURRENCY", 10)),
+        metavar=("<N>"),
+        help="Transfer up to <N> parts of one object at once (default 10)",
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        type=parse_size,
+        default=os.getenv("SBACKUP_MAX_BANDWIDTH", "0"),
+        metavar=("<SIZE>"),
+        help="Limit each upload and download to <SIZE> bytes per second, "
+        "0 is unlimited (default 0)",
+    )
+    parser.add_argument(
+        "--bandwidth-limit",
+        type=parse_size,
+        default=os.getenv("SBACKUP_BANDWIDTH_LIMIT", "0"),
+        metavar=("<SIZE>"),
+        help="Limit all s3 transfers of this process together to <SIZE> "
+        "bytes per second, 0 is unlimited; the 'bandwidth' field of the "
+        f"'{LIMITS_KEY}' hash in db changes it at runtime (default 0)",
+    )
+    parser.add_argument(
+        "--request-limit",
+        type=int,
+        default=int(os.getenv("SBACKUP_REQUEST_LIMIT", 0)),
+        metavar=("<N>"),
+        help="Send at most <N> s3 requests per second, 0 is unlimited; the "
+        f"'requests' field of the '{LIMITS_KEY}' hash in db changes it at "
+        "runtime (default 0)",
+    )
+
+    parser.add_argument(
+        "--pack",
+        type=parse_size,
+        default=0,
+        metavar=("<SIZE>"),
+        help="For local to s3, pack small files into tar archives of about "
+        f"<SIZE> bytes uploaded under '{PACK_PREFIX}/' (default 0, off)",
+    )
+    parser.add_argument(
+        "--pack-threshold",
+        type=parse_size,
+        default="1MiB",
+        metavar=("<SIZE>"),
+        help="Pack only files smaller than <SIZE> (default 1MiB)",
+    )
+    parser.add_argument(
+        "--pack-compress",
+        choices=("none", "zstd"),
+        default="none",
+        help="Compress every packed file as a zstd frame (default none)",
+    )
+
+    parser.add_argument(
+        "--compress",
+        choices=("none", "gzip", "zstd"),
+        default="none",
+        help="Compress local to s3 uploads on the fly; s3 to local "
+        "downloads decompress them automatically (default none)",
+    )
+
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Store files sent to s3:<BUCKET_NAME> as content-defined chunks "
+        f"under '{DEDUP_PREFIX}/', uploading only chunks the bucket does not "
+        "have yet; -d of that bucket to a directory rebuilds the files",
+    )
+
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help="Hash files while they are transferred, check uploads and "
+        "downloads against the s3 ETag and save the checksums in db "
+        "for --verify",
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=os.getenv("SBACKUP_METRICS_PORT"),
+        metavar=("<PORT>"),
+        help="Serve Prometheus metrics of the run on "
+        "http://127.0.0.1:<PORT>/metrics",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=os.getenv("SBACKUP_METRICS_FILE"),
+        metavar=("<PATH>"),
+        help="Write Prometheus metrics of the run to <PATH> when it ends, "
+        "e.g. for the node_exporter textfile collector",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the wall and CPU time of every DB and SafeBackup "
+        "method and of the list, queue, transfer and verify stages when "
+        "the run ends",
+    )
+    parser.add_argument(
+        "--profile-stats",
+        metavar=("<PATH>"),
+        help="Also run cProfile in every thread and save the pstats to "
+        "<PATH>; much slower (implies --profile)",
+    )
+    parser.add_argument(
+        "--profile-stacks",
+        metavar=("<PATH>"),
+        help="Also sample the stacks of all threads every "
+        f"{PROFILE_SAMPLE_INTERVAL * 1000:g}ms and write them to <PATH> "
+        "in the collapsed format of flamegraph.pl (implies --profile)",
+    )
+
+    parser.add_argument(
+        "--path",
+        nargs="+",
+        default=[],
+        metavar=("<PATH>"),
+        help="With -r, restore only these files or directories, in this "
+        "order with --order listed",
+    )
+    parser.add_argument(
+        "--prefix",
+        nargs="+",
+        default=[],
+        metavar=("<PREFIX>"),
+        help="With -r, restore only the files starting with <PREFIX>",
+    )
+    parser.add_argument(
+        "--order",
+        choices=("listed", "smallest"),
+        default="listed",
+        help="With -r, restore the files under each --path first, in the "
+        "order given, or the smallest files first (default listed)",
+    )
+
     group = parser.add_mutually_exclusive_group(required=True)
 
     group.add_argument(
@@ -771,9 +3885,35 @@ def main():
         help="read db and download source files safety to <DEST> "
         "which can be a <LOCAL_DIRECTORY> or s3:<BUCKET_NAME>",
     )
+    group.add_argument(
+        "-u",
+        nargs=3,
+        metavar=("s3:<BUCKET_NAME>", "<MEMBER>", "<DEST>"),
+        help="restore one file packed with --pack from s3:<BUCKET_NAME> "
+        "to the <LOCAL_DIRECTORY> <DEST>",
+    )
+    group.add_argument(
+        "-r",
+        nargs=2,
+        metavar=("s3:<BUCKET_NAME>", "<DEST>"),
+        help="restore the files backed up to s3:<BUCKET_NAME> to the "
+        "<LOCAL_DIRECTORY> <DEST> in priority order, large files with "
+        "parallel ranged downloads",
+    )
+    group.add_argument(
+        "--verify",
+        nargs=1,
+        metavar=("<DEST>"),
+        help="check every file copied to <DEST> with --checksum against "
+        "its saved checksum, without copying it again",
+    )
 
     args = parser.parse_args()
 
+    # tracing chosen methods needs at least the INFO level
+    if args.trace and not args.L:
+        args.L = ["INFO"]
+
     # disable logging
     if not args.L or args.L[0].upper() == "NOTSET":
         logging.disable()
@@ -790,6 +3930,53 @@ def main():
         else:
             parser.error(f"<LOG_LEVEL>='{args.L[0]}' is not defined!")
 
+    # wrap methods only when their calls will really be logged
+    if args.trace:
+        trace_methods(args.trace)
+    elif logging.root.isEnabledFor(logging.INFO):
+        trace_methods()
+
+    if args.workers < 1:
+        parser.error(f"<N>='{args.workers}' must be at least 1!")
+    if not 1 <= args.page_size <= 1000:
+        parser.error(f"<N>='{args.page_size}' must be between 1 and 1000!")
+    if args.pack_compress == "zstd" and zstandard is None:
+        parser.error("--pack-compress zstd needs 'pip install zstandard'!")
+    if args.compress == "zstd" and zstandard is None:
+        parser.error("--compress zstd needs 'pip install zstandard'!")
+    if args.dedup and fastcdc_cy is None:
+        parser.error("--dedup needs 'pip install fastcdc'!")
+    if args.dedup and args.checksum:
+        parser.error("--dedup cannot be combined with --checksum!")
+    if args.dedup and args.compress != "none":
+        parser.error("--dedup cannot be combined with --compress!")
+    if args.dedup and args.pack:
+        parser.error("--dedup cannot be combined with --pack!")
+    if args.max_concurrency < 1:
+        parser.error(f"<N>='{args.max_concurrency}' must be at least 1!")
+    if args.request_limit < 0:
+        parser.error(f"<N>='{args.request_limit}' must not be negative!")
+    if args.scan_workers < 1:
+        parser.error(f"<N>='{args.scan_workers}' must be at least 1!")
+
+    if (args.path or args.prefix) and not args.r:
+        parser.error("--path and --prefix only select files for -r!")
+
+    if args.metrics_port is not None or args.metrics_file:
+        METRICS.enable()
+        instrument_db()
+        if args.metrics_port is not None:
+            try:
+                METRICS.serve(args.metrics_port)
+            except OSError as e:
+                parser.error(f"<PORT>='{args.metrics_port}' {e.strerror}!")
+
+    if args.profile or args.profile_stats or args.profile_stacks:
+        profile_methods()
+        PROFILER.enable(
+            stats=bool(args.profile_stats), stacks=bool(args.profile_stacks)
+        )
+
     print(f"debug", f"main() *** {args = }")
     color_log("debug", f"main() *** {args = }")
     color_log("debug", f"main() *** {args.l = }")
@@ -797,6 +3984,7 @@ def main():
     color_log("debug", f"main() *** {args.d = }")
 
     safe_backup = SafeBackup(args)
+    status = 0
 
     if args.l:
         if not args.l[0] == "local" and not args.l[0] == "s3":
@@ -862,13 +4050,69 @@ def main():
         )
         print(f" Download to <DEST> = {args.d[1]} successfully completed.")
 
+    elif args.u:
+        if not args.u[0].startswith("s3:") or not len(args.u[0]) > 3:
+            parser.error("You must define s3:<bucket_name> to unpack from!")
+        if not Path(args.u[2]).is_dir():
+            parser.error(f"<DEST>='{args.u[2]}' is not directory!")
+
+        if not safe_backup.restore_packed_member(*args.u):
+            parser.error(f"<MEMBER>='{args.u[1]}' is not packed!")
+        print(f" Restore of {args.u[1]} to {args.u[2]} successfully completed.")
+
+    elif args.r:
+        if not args.r[0].startswith("s3:") or not len(args.r[0]) > 3:
+            parser.error("You must define the s3:<BUCKET_NAME> to restore!")
+        result, msg = safe_backup.bucket_exists(args.r[0].split(":")[1])
+        if not result:
+            parser.error(msg)
+        if not Path(args.r[1]).is_dir():
+            parser.error(f"<DEST>='{args.r[1]}' is not directory or not exist!")
+
+        if safe_backup.restore_files(
+            args.r[0].split(":")[1],
+            args.r[1],
+            args.path,
+            args.prefix,
+            args.order,
+        ):
+            status = 1
+        else:
+            print(f" Restore to <DEST> = {args.r[1]} successfully completed.")
+
+    elif args.verify:
+        destination = args.verify[0]
+        if not destination.startswith("s3:") and not Path(destination).is_dir():
+            parser.error(
+                f"<DEST>='{destination}' "
+                "is not directory or not started with 's3:'!"
+            )
+        key = f"{destination}-checksums_sbackup"
+        if not safe_backup.check_db_key_exists(key) == 1:
+            parser.error(f"No checksums of <DEST>='{destination}' in db!")
+
+        if safe_backup.verify_files(destination):
+            status = 1
+        else:
+            print(f" Verify of <DEST> = {destination} successfully completed.")
+
     else:
         parser.error(f"Input args='{args}' is not defined!")
 
-    return 0
+    if args.metrics_file:
+        METRICS.write(args.metrics_file)
+    if PROFILER.enabled:
+        PROFILER.stop()
+        for line in PROFILER.lines():
+            print(f" {line}")
+        if args.profile_stats:
+            PROFILER.write_stats(args.profile_stats)
+            print(f" cProfile stats saved in '{args.profile_stats}'.")
+        if args.profile_stacks:
+            PROFILER.write_stacks(args.profile_stacks)
+            print(f" Stack samples saved in '{args.profile_stacks}'.")
+    return status
 
 
 if __name__ == "__main__":
-    import sys
-
     sys.exit(main())
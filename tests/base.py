@@ -0,0 +1,260 @@
+"""
+Shared fixtures of the tests: s3 is moto, the db is a fakeredis server
+behind the real connection pool, or an SQLite file, and sbackup runs
+in process through main().
+"""
+
+import collections
+import contextlib
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import boto3
+import botocore.client
+import botocore.response
+import fakeredis
+from moto import mock_aws
+
+from safe_backup import safe_backup
+
+# sbackup creates buckets with a LocationConstraint, which us-east-1 rejects
+REGION = "us-west-2"
+S3_ENV = {
+    "SBACKUP_AWS_DEFAULT_REGION": REGION,
+    "SBACKUP_AWS_ACCESS_KEY_ID": "testing",
+    "SBACKUP_AWS_SECRET_ACCESS_KEY": "testing",
+    "SBACKUP_AWS_ENDPOINT_URL": "https://s3.amazonaws.com",
+}
+
+
+def make_args(**options):
+    """Return the parsed arguments of an sbackup run with no command."""
+
+    args = dict(
+        l=None,
+        c=None,
+        d=None,
+        u=None,
+        r=None,
+        verify=None,
+        L=None,
+        trace=None,
+        incremental=False,
+        workers=1,
+        scan_workers=2,
+        shards=None,
+        page_size=1000,
+        multipart_threshold=8 * 1024**2,
+        multipart_chunksize=8 * 1024**2,
+        max_concurrency=4,
+        max_bandwidth=0,
+        bandwidth_limit=0,
+        request_limit=0,
+        pack=0,
+        pack_threshold=1024**2,
+        pack_compress="none",
+        compress="none",
+        dedup=False,
+        checksum=False,
+    )
+    args.update(options)
+    return types.SimpleNamespace(**args)
+
+
+class SafeBackupTestCase(unittest.TestCase):
+    """
+    Base of the tests that run sbackup. Set backend to "sqlite" to keep
+    the state in an SQLite file instead of fakeredis.
+    """
+
+    backend = "redis"
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix="sbackup-test-"))
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+        env = dict(S3_ENV)
+        if self.backend == "sqlite":
+            env["SBACKUP_DB_URL"] = f"sqlite:///{self.tmp}/state.db"
+        else:
+            env["SBACKUP_DB_URL"] = "redis://sbackup-test:6379/0"
+            self.server = fakeredis.FakeServer()
+            from_url = safe_backup.MeteredConnectionPool.from_url
+
+            def fake_from_url(url, **kwargs):
+                return from_url(
+                    url,
+                    connection_class=fakeredis.FakeRedisConnection,
+                    server=self.server,
+                    **kwargs,
+                )
+
+            self.patch(
+                mock.patch.object(
+                    safe_backup.MeteredConnectionPool,
+                    "from_url",
+                    fake_from_url,
+                )
+            )
+        self.db_url = env["SBACKUP_DB_URL"]
+        self.patch(mock.patch.dict(os.environ, env))
+        self.patch(mock.patch.dict(safe_backup._db_pools, clear=True))
+        self.patch(
+            mock.patch.object(safe_backup, "METRICS", safe_backup.Metrics())
+        )
+        self.patch(
+            mock.patch.object(safe_backup, "PROFILER", safe_backup.Profiler())
+        )
+        # Destination buckets are checked once per process.
+        self.patch(
+            mock.patch.object(
+                safe_backup.SafeBackup, "_SafeBackup__buckets_ready", set()
+            )
+        )
+        # trace_methods, instrument_db and profile_methods wrap methods
+        # in place, so every test gets the classes back as they were.
+        for cls in {*safe_backup._traced_classes, safe_backup.DB}:
+            self.addCleanup(self._restore_class, cls, dict(vars(cls)))
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        self.patch(mock_aws())
+        self.s3 = boto3.client("s3", region_name=REGION)
+
+    def patch(self, patcher):
+        value = patcher.start()
+        self.addCleanup(patcher.stop)
+        return value
+
+    @staticmethod
+    def _restore_class(cls, attributes):
+        for name, value in attributes.items():
+            if vars(cls).get(name) is not value:
+                setattr(cls, name, value)
+
+    def db(self):
+        """Return a client of the db sbackup keeps its state in."""
+
+        if self.db_url.startswith("sqlite:"):
+            return safe_backup.SQLiteState(self.db_url.split("://", 1)[1])
+        return fakeredis.FakeStrictRedis(
+            server=self.server, decode_responses=True
+        )
+
+    def members(self, key):
+        """Return the members of a set in the db."""
+
+        db = self.db()
+        if isinstance(db, safe_backup.SQLiteState):
+            rows = db._query("SELECT member FROM sets WHERE key = ?", key)
+            return {row[0] for row in rows}
+        return db.smembers(key)
+
+    def state(self, **options):
+        """Return a SafeBackup of no command, e.g. to read the db."""
+
+        return safe_backup.SafeBackup(make_args(**options))
+
+    def sbackup(self, *argv):
+        """Run sbackup with argv and return its exit status and output."""
+
+        output = io.StringIO()
+        with mock.patch.object(sys, "argv", ["sbackup", *argv]):
+            with contextlib.redirect_stdout(output):
+                status = safe_backup.main()
+        return status, output.getvalue()
+
+    @contextlib.contextmanager
+    def s3_calls(self):
+        """Count the s3 operations called inside the block by name."""
+
+        calls = collections.Counter()
+        make_api_call = botocore.client.BaseClient._make_api_call
+
+        def counted(client, operation_name, api_params):
+            calls[operation_name] += 1
+            return make_api_call(client, operation_name, api_params)
+
+        with mock.patch.object(
+            botocore.client.BaseClient, "_make_api_call", counted
+        ):
+            yield calls
+
+    @contextlib.contextmanager
+    def cut_downloads(self, count):
+        """
+        Cut the body of the next count GetObject responses in half, as a
+        connection that breaks off would.
+        """
+
+        left = [count]
+        lock = threading.Lock()
+        make_api_call = botocore.client.BaseClient._make_api_call
+
+        def cut(client, operation_name, api_params):
+            response = make_api_call(client, operation_name, api_params)
+            if operation_name != "GetObject":
+                return response
+            with lock:
+                if not left[0]:
+                    return response
+                left[0] -= 1
+            data = response["Body"].read()
+            response["Body"] = botocore.response.StreamingBody(
+                io.BytesIO(data[: len(data) // 2]), len(data)
+            )
+            return response
+
+        with mock.patch.object(
+            botocore.client.BaseClient, "_make_api_call", cut
+        ):
+            yield left
+
+    def make_tree(self, name, files):
+        """Write {relative path: bytes} under a new directory name."""
+
+        root = self.tmp / name
+        root.mkdir()
+        for member, data in files.items():
+            path = root / member
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+        return root
+
+    def read_tree(self, root):
+        """Return {relative path: bytes} of the files under root."""
+
+        root = Path(root)
+        return {
+            str(path.relative_to(root)): path.read_bytes()
+            for path in sorted(root.rglob("*"))
+            if path.is_file()
+        }
+
+    def make_bucket(self, name, objects=()):
+        self.s3.create_bucket(
+            Bucket=name,
+            CreateBucketConfiguration={"LocationConstraint": REGION},
+        )
+        for key, data in dict(objects).items():
+            self.s3.put_object(Bucket=name, Key=key, Body=data)
+
+    def read_bucket(self, name, prefix=""):
+        """Return {key: bytes} of the objects of a bucket."""
+
+        paginator = self.s3.get_paginator("list_objects_v2")
+        return {
+            content["Key"]: self.s3.get_object(
+                Bucket=name, Key=content["Key"]
+            )["Body"].read()
+            for page in paginator.paginate(Bucket=name, Prefix=prefix)
+            for content in page.get("Contents", [])
+        }
@@ -0,0 +1,119 @@
+import contextlib
+import io
+import json
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import bench  # noqa: E402
+
+
+def result(dataset, case, files, db_ops, **rate):
+    return {
+        "dataset": dataset,
+        "case": case,
+        "files": files,
+        "db_ops_per_file": db_ops,
+        "s3_requests_per_file": 1.0,
+        **rate,
+    }
+
+
+class BenchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix="sbackup-test-"))
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_trees_are_the_same_for_a_seed(self):
+        trees = []
+        for name in ("a", "b"):
+            root = self.tmp / name
+            size = bench.make_tree(root, 20, 10, 100, 3, random.Random(1))
+            files = {
+                str(path.relative_to(root)): path.read_bytes()
+                for path in root.rglob("*")
+                if path.is_file()
+            }
+            self.assertEqual(size, sum(map(len, files.values())))
+            trees.append(files)
+
+        self.assertEqual(trees[0], trees[1])
+        self.assertEqual(len(trees[0]), 20)
+        self.assertTrue(all(name.count("/") == 3 for name in trees[0]))
+
+    def test_read_metrics_sums_the_samples_of_each_name(self):
+        path = self.tmp / "metrics.prom"
+        path.write_text(
+            "# HELP sbackup_listed_objects_total Objects listed.\n"
+            "# TYPE sbackup_listed_objects_total counter\n"
+            'sbackup_listed_objects_total{source="local"} 20\n'
+            'sbackup_db_operation_seconds_count{method="claim"} 3\n'
+            'sbackup_db_operation_seconds_count{method="ack"} 2\n'
+            "sbackup_workers 4\n"
+        )
+
+        self.assertEqual(
+            bench.read_metrics(path),
+            {
+                "sbackup_listed_objects_total": 20,
+                "sbackup_db_operation_seconds_count": 5,
+                "sbackup_workers": 4,
+            },
+        )
+
+    def test_compare_prints_the_change_of_each_case(self):
+        old, new = self.tmp / "old.json", self.tmp / "new.json"
+        old.write_text(
+            json.dumps(
+                {
+                    "version": "1.0",
+                    "results": [
+                        result("small", "upload", 10, 4.0, mb_per_second=2),
+                        result(
+                            "deep", "list_local", 10, 1.0, keys_per_second=100
+                        ),
+                    ],
+                }
+            )
+        )
+        new.write_text(
+            json.dumps(
+                {
+                    "version": "1.1",
+                    "results": [
+                        result("small", "upload", 10, 2.5, mb_per_second=3),
+                        result("huge", "upload", 3, 5.0, mb_per_second=9),
+                    ],
+                }
+            )
+        )
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            bench.compare(old, new)
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], " 1.0 -> 1.1")
+        self.assertEqual(len(lines), 2)
+        self.assertRegex(
+            lines[1],
+            r"small +upload +2 -> +3 MB/s +\(\+50\.0%\) db ops/file -1\.500",
+        )
+
+    def test_format_result_shows_the_rate_of_the_case(self):
+        line = bench.format_result(
+            result("small", "list_s3", 2000, 0.5, keys_per_second=1234.5)
+        )
+
+        self.assertIn("2000 files", line)
+        self.assertIn("1234.5 keys/s", line)
+        self.assertIn("0.5 db ops/file", line)
+
+
+if __name__ == "__main__":
+    unittest.main()
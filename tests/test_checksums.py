@@ -0,0 +1,154 @@
+import hashlib
+import json
+import unittest
+import zlib
+from unittest import mock
+
+import boto3.s3.transfer
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import StreamChecksum
+from tests.base import SafeBackupTestCase
+
+MIB = 1024**2
+
+
+class StreamChecksumTest(SafeBackupTestCase):
+    def upload(self, data, threshold, chunksize):
+        config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=threshold, multipart_chunksize=chunksize
+        )
+        self.s3.upload_fileobj(
+            safe_backup.HashingReader(safe_backup.io.BytesIO(data)),
+            "dst",
+            "object",
+            Config=config,
+        )
+        return self.s3.head_object(Bucket="dst", Key="object")["ETag"]
+
+    def test_etag_of_a_multipart_upload(self):
+        self.make_bucket("dst")
+        data = bytes(range(256)) * (48 * 1024)  # 12 MiB, three parts
+        checksum = StreamChecksum(5 * MIB, 8 * MIB)
+        # Pieces that straddle the part boundaries.
+        view = memoryview(data)
+        while view:
+            checksum.update(view[:777777])
+            view = view[777777:]
+
+        etag = self.upload(data, 8 * MIB, 5 * MIB)
+
+        self.assertEqual(checksum.etag, etag.strip('"'))
+        self.assertTrue(checksum.etag.endswith("-3"))
+
+    def test_etag_of_a_single_put_longer_than_a_part(self):
+        self.make_bucket("dst")
+        data = b"x" * (6 * MIB)
+        checksum = StreamChecksum(5 * MIB, 8 * MIB)
+        checksum.update(data)
+
+        etag = self.upload(data, 8 * MIB, 5 * MIB)
+
+        self.assertEqual(checksum.etag, etag.strip('"'))
+        self.assertEqual(checksum.etag, hashlib.md5(data).hexdigest())
+
+    def test_digest_falls_back_to_crc32(self):
+        with mock.patch.object(safe_backup, "xxhash", None):
+            checksum = StreamChecksum()
+        checksum.update(b"some ")
+        checksum.update(b"bytes")
+
+        self.assertEqual(checksum.size, 10)
+        self.assertEqual(
+            checksum.digest, f"crc32:{zlib.crc32(b'some bytes'):08x}"
+        )
+        self.assertIsNone(checksum.etag)
+
+    def test_hash_file_uses_the_algorithm_of_the_digest(self):
+        path = self.tmp / "file"
+        path.write_bytes(b"some bytes")
+
+        digest = f"crc32:{zlib.crc32(b'some bytes'):08x}"
+        self.assertEqual(safe_backup.hash_file(path, digest), digest)
+        if safe_backup.xxhash is None:
+            with self.assertRaises(ValueError):
+                safe_backup.hash_file(path, "xxh3:0")
+
+
+class VerifyTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {
+            "small": b"small file",
+            "dir/large": bytes(range(256)) * (40 * 1024),
+        }
+        self.source = self.make_tree("source", self.files)
+        self.sbackup("-l", "local", str(self.source))
+        self.db_key = f"local:{self.source}"
+
+    def records(self, destination):
+        records = self.db().hgetall(f"{destination}-checksums_sbackup")
+        return {member: json.loads(r) for member, r in records.items()}
+
+    def test_local_copy_saves_checksums_and_verifies(self):
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        status, _ = self.sbackup("--checksum", "-d", self.db_key, str(dest))
+
+        self.assertEqual(status, 0)
+        records = self.records(str(dest))
+        self.assertEqual(
+            {member: r["size"] for member, r in records.items()},
+            {f"source/{m}": len(data) for m, data in self.files.items()},
+        )
+        status, output = self.sbackup("--verify", str(dest))
+        self.assertEqual(status, 0)
+        self.assertIn("Verified 2 files", output)
+
+        # Same size, other bytes: only a re-hash notices.
+        (dest / "source/small").write_bytes(b"SMALL FILE")
+        status, output = self.sbackup("--verify", str(dest))
+        self.assertEqual(status, 1)
+        self.assertIn("source/small does not match its checksum!", output)
+        self.assertNotIn("source/dir/large does not match", output)
+
+    def test_upload_checks_the_etag_and_verifies_with_heads(self):
+        status, _ = self.sbackup(
+            "--checksum",
+            "--multipart-threshold",
+            "6MiB",
+            "--multipart-chunksize",
+            "5MiB",
+            "-d",
+            self.db_key,
+            "s3:dst",
+        )
+
+        self.assertEqual(status, 0)
+        records = self.records("s3:dst")
+        for member in records:
+            head = self.s3.head_object(Bucket="dst", Key=member)
+            self.assertEqual(records[member]["etag"], head["ETag"].strip('"'))
+        self.assertTrue(records["source/dir/large"]["etag"].endswith("-2"))
+
+        with self.s3_calls() as calls:
+            status, _ = self.sbackup("--verify", "s3:dst")
+        self.assertEqual(status, 0)
+        self.assertEqual(calls, {"HeadObject": 2})
+
+        self.s3.put_object(Bucket="dst", Key="source/small", Body=b"x" * 10)
+        status, output = self.sbackup("--verify", "s3:dst")
+        self.assertEqual(status, 1)
+        self.assertIn("source/small does not match its checksum!", output)
+
+    def test_verify_needs_saved_checksums(self):
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        with self.assertRaises(SystemExit):
+            self.sbackup("--verify", str(dest))
+
+
+if __name__ == "__main__":
+    unittest.main()
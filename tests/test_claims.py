@@ -0,0 +1,89 @@
+import threading
+import unittest
+from unittest import mock
+
+from parameterized import parameterized_class
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import DB
+from tests.base import SafeBackupTestCase
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class ClaimsTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {f"file{i:02}": b"%d" % i for i in range(40)}
+        self.source = self.make_tree("source", self.files)
+        self.sbackup("-l", "local", str(self.source))
+        self.db_key = f"local:{self.source}"
+        self.dest = self.tmp / "dest"
+        self.dest.mkdir()
+        self.claimed_key = f"{self.db_key}-d__{self.dest}-claimed_sbackup"
+
+    def test_concurrent_claims_never_share_a_member(self):
+        state = self.state()
+        claims = []
+
+        def claim():
+            while members := DB.claim(
+                state, self.db_key, self.claimed_key, count=3
+            ):
+                claims.extend(members)
+
+        threads = [threading.Thread(target=claim) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(claims), len(self.files))
+        self.assertEqual(
+            set(claims), {f"source/{name}" for name in self.files}
+        )
+        self.assertEqual(self.members(self.claimed_key), set(claims))
+
+    def test_acknowledges_in_batches(self):
+        batches = []
+        ack = DB.ack
+
+        def recorded(state, claimed_key, members, *args):
+            batches.append(list(members))
+            return ack(state, claimed_key, members, *args)
+
+        with mock.patch.object(safe_backup, "ACK_BATCH_SIZE", 10):
+            with mock.patch.object(DB, "ack", recorded):
+                self.sbackup(
+                    "--workers", "2", "-d", self.db_key, str(self.dest)
+                )
+
+        acked = [member for batch in batches for member in batch]
+        self.assertEqual(len(acked), len(self.files))
+        self.assertLessEqual(len(batches), 6)
+        self.assertEqual(self.members(self.claimed_key), set())
+
+    def test_resumes_claimed_members_after_a_crash(self):
+        DB.claim(self.state(), self.db_key, self.claimed_key, count=10)
+
+        # Resuming happens when sbackup starts, before its own command.
+        self.state()
+
+        self.assertEqual(self.read_tree(self.dest / "source"), self.files)
+        self.assertEqual(self.members(self.db_key), set())
+        self.assertEqual(self.db().keys("*claimed_sbackup"), [])
+
+    def test_resumes_a_transfer_of_an_older_version(self):
+        db = self.db()
+        left = sorted(self.members(self.db_key))[:5]
+        db.delete(self.db_key)
+        db.sadd(self.db_key, *left)
+        db.set(f"{self.db_key}-d__{self.dest}-work_sbackup", left[0])
+
+        self.state()
+
+        self.assertEqual(set(self.read_tree(self.dest)), set(left))
+        self.assertEqual(self.db().keys("*_sbackup"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
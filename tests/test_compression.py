@@ -0,0 +1,115 @@
+import gzip
+import os
+import unittest
+from unittest import mock
+
+from parameterized import parameterized
+
+from safe_backup import safe_backup
+from tests.base import SafeBackupTestCase
+
+CODECS = [("gzip",), ("zstd",)]
+
+
+def decompress(codec, data):
+    if codec == "gzip":
+        return gzip.decompress(data)
+    decompressor = safe_backup.zstandard.ZstdDecompressor().decompressobj()
+    return decompressor.decompress(data)
+
+
+class CompressionTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = b"compressible line of text\n" * 40000
+        self.source = self.make_tree("source", {"text": self.data})
+
+    def require(self, codec):
+        if codec == "zstd" and safe_backup.zstandard is None:
+            self.skipTest("zstandard is not installed")
+
+    @parameterized.expand(CODECS)
+    def test_uploads_compressed_with_the_codec_in_metadata(self, codec):
+        self.require(codec)
+
+        status, output = self.sbackup(
+            "--compress", codec, "-c", "local", str(self.source), "s3:dst"
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn("Compression handled", output)
+        response = self.s3.get_object(Bucket="dst", Key="source/text")
+        self.assertEqual(response["Metadata"], {"sbackup-codec": codec})
+        body = response["Body"].read()
+        self.assertLess(len(body), len(self.data) // 10)
+        self.assertEqual(decompress(codec, body), self.data)
+
+    @parameterized.expand(CODECS)
+    def test_downloads_decompress_on_the_fly(self, codec):
+        self.require(codec)
+        self.sbackup(
+            "--compress", codec, "-c", "local", str(self.source), "s3:dst"
+        )
+        self.sbackup("-l", "s3", "dst")
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        with self.s3_calls() as calls:
+            status, _ = self.sbackup("-d", "s3:dst", str(dest))
+
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read_tree(dest), {"source/text": self.data})
+        self.assertEqual(calls["HeadObject"], 1)
+        self.assertEqual(calls["GetObject"], 1)
+
+
+class DownloadTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(300 * 1024)
+        self.make_bucket("src", {"dir/file": self.data})
+        self.sbackup("-l", "s3", "src")
+        self.dest = self.tmp / "dest"
+        self.dest.mkdir()
+
+    def test_retries_a_response_that_breaks_off(self):
+        with self.cut_downloads(safe_backup.DOWNLOAD_ATTEMPTS - 1) as left:
+            status, _ = self.sbackup("-d", "s3:src", str(self.dest))
+
+        self.assertEqual(status, 0)
+        self.assertEqual(left, [0])
+        self.assertEqual(self.read_tree(self.dest), {"dir/file": self.data})
+
+    def test_leaves_no_partial_file_behind(self):
+        (self.dest / "dir").mkdir()
+        (self.dest / "dir/file").write_bytes(b"previous backup")
+
+        with self.cut_downloads(safe_backup.DOWNLOAD_ATTEMPTS):
+            status, output = self.sbackup("-d", "s3:src", str(self.dest))
+
+        self.assertIn("1 files failed", output)
+        self.assertEqual(
+            self.read_tree(self.dest), {"dir/file": b"previous backup"}
+        )
+        self.assertEqual(self.members("s3:src"), {"dir/file"})
+
+    def test_takes_downloaded_bytes_from_the_bandwidth_limit(self):
+        taken = []
+        take = safe_backup.TokenBucket.take
+
+        def record(bucket, amount=1):
+            if bucket.rate == 10 * 1024**2:
+                taken.append(amount)
+            return take(bucket, amount)
+
+        with mock.patch.object(safe_backup.TokenBucket, "take", record):
+            self.sbackup(
+                "--max-bandwidth", "10MiB", "-d", "s3:src", str(self.dest)
+            )
+
+        self.assertEqual(sum(taken), len(self.data))
+        self.assertEqual(self.read_tree(self.dest), {"dir/file": self.data})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from parameterized import parameterized_class
+
+from safe_backup.safe_backup import DB, SafeBackup
+from tests.base import SafeBackupTestCase
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class CopyPipelineTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {f"dir{i % 3}/file{i:02}": b"%d" % i for i in range(40)}
+        self.source = self.make_tree("source", self.files)
+        self.dest = self.tmp / "dest"
+        self.dest.mkdir()
+
+    def test_copies_every_file_and_leaves_no_state(self):
+        status, output = self.sbackup(
+            "--workers", "4", "-c", "local", str(self.source), str(self.dest)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read_tree(self.dest / "source"), self.files)
+        self.assertEqual(self.members(f"local:{self.source}"), set())
+        self.assertEqual(self.db().keys("*queue_sbackup"), [])
+        self.assertEqual(self.db().keys("*claimed_sbackup"), [])
+
+    def test_queue_yields_members_until_its_end(self):
+        state = self.state()
+        DB.set_add_many(state, "set", ["a", "b"], queue_key="queue")
+        batches = DB.iter_queue(state, "queue")
+
+        self.assertEqual(sorted(next(batches)), ["a", "b"])
+        DB.set_add_many(state, "set", ["c"], queue_key="queue")
+        DB.end_queue(state, "queue")
+        start = time.monotonic()
+        self.assertEqual(list(batches), [["c"]])
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_failed_listing_does_not_leave_transfers_waiting(self):
+        errors = []
+
+        def copy():
+            try:
+                self.sbackup("-c", "local", str(self.source), str(self.dest))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(
+            SafeBackup,
+            "save_files_list_in_db",
+            side_effect=OSError("listing failed"),
+        ):
+            thread = threading.Thread(target=copy, daemon=True)
+            thread.start()
+            thread.join(timeout=10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([str(e) for e in errors], ["listing failed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import unittest
+from unittest import mock
+
+from parameterized import parameterized_class
+
+from safe_backup.safe_backup import DB
+from tests.base import SafeBackupTestCase
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class DBIterationTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch(
+            mock.patch.dict(os.environ, {"SBACKUP_DB_SCAN_COUNT": "10"})
+        )
+
+    def test_find_follows_the_cursor_to_the_end(self):
+        db = self.db()
+        keys = {f"local:/src{i}-manifest_sbackup" for i in range(35)}
+        for key in keys:
+            db.hset(key, "member", "1:1")
+        db.set("other", "value")
+
+        found = DB.find(self.state(), "*-manifest_sbackup")
+
+        self.assertEqual(sorted(found), sorted(keys))
+
+    def test_transfer_drains_a_set_larger_than_a_page(self):
+        files = {f"file{i:03}": b"%d" % i for i in range(120)}
+        source = self.make_tree("source", files)
+        self.sbackup("-l", "local", str(source))
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        status, output = self.sbackup(
+            "--workers", "2", "-d", f"local:{source}", str(dest)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read_tree(dest / "source"), files)
+        self.assertEqual(self.members(f"local:{source}"), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
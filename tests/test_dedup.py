@@ -0,0 +1,136 @@
+import contextlib
+import io
+import random
+import unittest
+from unittest import mock
+
+from parameterized import parameterized
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import (
+    CDC_MAX_SIZE,
+    CDC_MIN_SIZE,
+    DEDUP_PREFIX,
+    cdc_chunks,
+)
+from tests.base import SafeBackupTestCase
+
+MIB = 1024**2
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+@unittest.skipIf(safe_backup.fastcdc_cy is None, "fastcdc is not installed")
+class ChunkingTest(unittest.TestCase):
+    def test_chunks_join_back_within_bounds(self):
+        data = random_bytes(40 * MIB)
+
+        chunks = list(cdc_chunks(io.BytesIO(data)))
+
+        self.assertEqual(b"".join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), CDC_MIN_SIZE)
+            self.assertLessEqual(len(chunk), CDC_MAX_SIZE)
+
+    def test_an_insert_only_changes_the_chunks_around_it(self):
+        data = random_bytes(40 * MIB)
+        middle = 20 * MIB
+        edited = data[:middle] + b"inserted" + data[middle:]
+
+        before = list(cdc_chunks(io.BytesIO(data)))
+        after = list(cdc_chunks(io.BytesIO(edited)))
+
+        self.assertGreaterEqual(len(set(before) & set(after)), len(before) - 2)
+
+    def test_small_and_empty_streams(self):
+        self.assertEqual(list(cdc_chunks(io.BytesIO(b"small"))), [b"small"])
+        self.assertEqual(list(cdc_chunks(io.BytesIO(b""))), [])
+
+
+@unittest.skipIf(safe_backup.fastcdc_cy is None, "fastcdc is not installed")
+class DedupTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        data = random_bytes(6 * MIB)
+        self.files = {
+            "first": data,
+            "second": data[:MIB] + b"edit" + data[MIB:],
+        }
+        self.source = self.make_tree("source", self.files)
+
+    def test_stores_repeated_chunks_once(self):
+        status, output = self.sbackup(
+            "--dedup", "-c", "local", str(self.source), "s3:dst"
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn("Deduplication stored", output)
+        objects = self.read_bucket("dst")
+        recipes = {
+            key: data
+            for key, data in objects.items()
+            if key.startswith(f"{DEDUP_PREFIX}/recipes/")
+        }
+        chunks = [
+            k for k in objects if k.startswith(f"{DEDUP_PREFIX}/chunks/")
+        ]
+        self.assertEqual(len(recipes), 2)
+        stored = sum(len(objects[key]) for key in chunks)
+        self.assertLess(stored, 6 * MIB * 1.5)
+        self.assertEqual(
+            len(chunks), len(self.db().smembers("s3:dst-chunks_sbackup"))
+        )
+
+    def test_restores_deduplicated_files(self):
+        self.sbackup("--dedup", "-c", "local", str(self.source), "s3:dst")
+        self.sbackup("-l", "s3", "dst")
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        status, _ = self.sbackup("-d", "s3:dst", str(dest))
+
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            self.read_tree(dest / "source"),
+            self.files,
+        )
+
+    def test_needs_fastcdc(self):
+        with mock.patch.object(safe_backup, "fastcdc_cy", None):
+            with self.assertRaises(SystemExit):
+                self.sbackup(
+                    "--dedup", "-c", "local", str(self.source), "s3:dst"
+                )
+
+    @parameterized.expand(
+        [
+            ("--checksum",),
+            ("--compress", "gzip"),
+            ("--pack", "4KiB"),
+        ]
+    )
+    def test_rejects_options_it_would_ignore(self, option, *value):
+        errors = io.StringIO()
+
+        with contextlib.redirect_stderr(errors):
+            with self.assertRaises(SystemExit):
+                self.sbackup(
+                    "--dedup",
+                    option,
+                    *value,
+                    "-c",
+                    "local",
+                    str(self.source),
+                    "s3:dst",
+                )
+
+        self.assertIn(
+            f"--dedup cannot be combined with {option}!", errors.getvalue()
+        )
+        self.assertEqual(self.s3.list_buckets()["Buckets"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from parameterized import parameterized
+
+from tests.base import SafeBackupTestCase
+
+
+class DestBucketTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {f"file{i:02}": b"data" for i in range(20)}
+        self.source = self.make_tree("source", self.files)
+        self.sbackup("-l", "local", str(self.source))
+
+    @parameterized.expand([("missing", False, 1), ("existing", True, 0)])
+    def test_checks_the_bucket_once_per_run(self, _, exists, creates):
+        if exists:
+            self.make_bucket("dst")
+
+        with self.s3_calls() as calls:
+            status, output = self.sbackup(
+                "--workers", "4", "-d", f"local:{self.source}", "s3:dst"
+            )
+
+        self.assertEqual(status, 0)
+        self.assertEqual(calls["HeadBucket"], 1)
+        self.assertEqual(calls["CreateBucket"], creates)
+        self.assertEqual(calls["ListBuckets"], 0)
+        self.assertEqual(calls["PutObject"], 20)
+        self.assertEqual(len(self.read_bucket("dst")), 20)
+        self.assertIn(f"Saved {40 - 1 - creates} destination bucket", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import CopyStats, fast_copy
+from tests.base import SafeBackupTestCase
+
+
+class FastCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix="sbackup-test-"))
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.data = os.urandom(300 * 1024 + 7)
+        self.source = self.tmp / "source"
+        self.source.write_bytes(self.data)
+        self.dest = self.tmp / "dest"
+        device = os.stat(self.tmp).st_dev
+        self.devices = (device, device)
+
+    def copy(self, unsupported):
+        name, size = fast_copy(self.source, self.dest, unsupported)
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(self.dest.read_bytes(), self.data)
+        return name
+
+    def test_skips_the_methods_marked_unsupported(self):
+        unsupported = {
+            (name, *self.devices) for name, _ in safe_backup.COPY_METHODS
+        }
+        unsupported.discard(("read/write", *self.devices))
+
+        self.assertEqual(self.copy(unsupported), "read/write")
+
+    def test_unsupported_method_is_marked_for_the_devices(self):
+        unsupported = {("reflink", *self.devices)}
+        error = OSError(errno.EXDEV, "cross-device")
+
+        with mock.patch.object(os, "copy_file_range", side_effect=error):
+            self.assertEqual(self.copy(unsupported), "sendfile")
+
+        self.assertIn(("copy_file_range", *self.devices), unsupported)
+
+    def test_short_copy_falls_back_without_marking(self):
+        unsupported = {("reflink", *self.devices)}
+
+        with mock.patch.object(os, "copy_file_range", return_value=0):
+            self.assertEqual(self.copy(unsupported), "sendfile")
+
+        self.assertEqual(unsupported, {("reflink", *self.devices)})
+
+    def test_other_errors_are_raised(self):
+        unsupported = {("reflink", *self.devices)}
+        error = OSError(errno.EIO, "I/O error")
+
+        with mock.patch.object(os, "copy_file_range", side_effect=error):
+            with self.assertRaises(OSError):
+                fast_copy(self.source, self.dest, unsupported)
+
+    def test_copy_stats_lines(self):
+        stats = CopyStats()
+        stats.add("sendfile", 1024**2, 0.5)
+        stats.add("sendfile", 1024**2, 0.5)
+        stats.add("copy_file_range", 10, 0)
+
+        self.assertEqual(
+            list(stats.lines()),
+            [
+                "1 files (10 bytes) with copy_file_range at 0.0 MiB/s "
+                "per worker",
+                "2 files (2097152 bytes) with sendfile at 2.0 MiB/s "
+                "per worker",
+            ],
+        )
+
+
+class LocalCopyTest(SafeBackupTestCase):
+    def test_local_copy_reports_the_methods_used(self):
+        files = {f"f{i}": os.urandom(1000 + i) for i in range(5)}
+        source = self.make_tree("source", files)
+        os.utime(source / "f0", (1_000_000, 1_000_000))
+        self.sbackup("-l", "local", str(source))
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        status, output = self.sbackup("-d", f"local:{source}", str(dest))
+
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read_tree(dest / "source"), files)
+        self.assertEqual(os.stat(dest / "source/f0").st_mtime, 1_000_000)
+        self.assertRegex(output, r"Copied 5 files \(5010 bytes\) with ")
+
+
+if __name__ == "__main__":
+    unittest.main()
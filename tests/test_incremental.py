@@ -0,0 +1,75 @@
+import os
+import unittest
+
+from parameterized import parameterized_class
+
+from tests.base import SafeBackupTestCase
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class IncrementalTest(SafeBackupTestCase):
+    def test_local_lists_only_new_and_changed_files(self):
+        files = {f"dir/file{i}": b"data" for i in range(10)}
+        source = self.make_tree("source", files)
+        self.sbackup("--incremental", "-l", "local", str(source))
+        self.db().delete(f"local:{source}")
+
+        (source / "dir/file3").write_bytes(b"changed")
+        os.utime(source / "dir/file5", ns=(0, 10**9))
+        (source / "dir/new").write_bytes(b"new")
+        status, output = self.sbackup(
+            "--incremental", "-l", "local", str(source)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn("Skipped 8 unchanged entries", output)
+        self.assertEqual(
+            self.members(f"local:{source}"),
+            {"source/dir/file3", "source/dir/file5", "source/dir/new"},
+        )
+
+    def test_s3_lists_only_new_and_changed_objects(self):
+        self.make_bucket("src", {f"key{i}": b"data" for i in range(10)})
+        self.sbackup("--incremental", "-l", "s3", "src")
+        self.db().delete("s3:src")
+
+        self.s3.put_object(Bucket="src", Key="key3", Body=b"changed")
+        self.s3.put_object(Bucket="src", Key="new", Body=b"new")
+        status, output = self.sbackup("--incremental", "-l", "s3", "src")
+
+        self.assertEqual(status, 0)
+        self.assertIn("Skipped 9 unchanged entries", output)
+        self.assertEqual(self.members("s3:src"), {"key3", "new"})
+
+    def test_copy_transfers_only_changes_on_the_next_run(self):
+        source = self.make_tree("source", {"a": b"a", "b": b"b", "c": b"c"})
+        dest = self.tmp / "dest"
+        dest.mkdir()
+        self.sbackup("--incremental", "-c", "local", str(source), str(dest))
+
+        (source / "b").write_bytes(b"changed")
+        status, output = self.sbackup(
+            "--incremental", "-c", "local", str(source), str(dest)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn("Transferred 1 files", output)
+        self.assertEqual(
+            self.read_tree(dest / "source"),
+            {"a": b"a", "b": b"changed", "c": b"c"},
+        )
+
+    def test_without_incremental_everything_is_listed(self):
+        source = self.make_tree("source", {"a": b"a", "b": b"b"})
+        self.sbackup("--incremental", "-l", "local", str(source))
+        self.db().delete(f"local:{source}")
+
+        self.sbackup("-l", "local", str(source))
+
+        self.assertEqual(
+            self.members(f"local:{source}"), {"source/a", "source/b"}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
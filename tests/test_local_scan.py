@@ -0,0 +1,61 @@
+import os
+import unittest
+from unittest import mock
+
+from parameterized import parameterized
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import DB
+from tests.base import SafeBackupTestCase
+
+
+class LocalScanTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {
+            "/".join(f"d{(i >> level) % 2}" for level in range(6))
+            + f"/file{i}": b"data"
+            for i in range(64)
+        }
+        self.files["top"] = b"top"
+        self.source = self.make_tree("source", self.files)
+
+    @parameterized.expand([("1",), ("8",)])
+    def test_lists_every_file_of_a_deep_tree(self, scan_workers):
+        status, output = self.sbackup(
+            "--scan-workers", scan_workers, "-l", "local", str(self.source)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn(f"Scanned {len(self.files)} files", output)
+        self.assertEqual(
+            self.members(f"local:{self.source}"),
+            {f"source/{member}" for member in self.files},
+        )
+
+    def test_does_not_follow_directory_symlinks(self):
+        outside = self.make_tree("outside", {"secret": b"secret"})
+        os.symlink(outside, self.source / "link")
+
+        self.sbackup("-l", "local", str(self.source))
+
+        members = self.members(f"local:{self.source}")
+        self.assertEqual(len(members), len(self.files))
+        self.assertFalse(any(m.startswith("source/link") for m in members))
+
+    def test_saves_files_in_batches(self):
+        with mock.patch.object(safe_backup, "LOCAL_BATCH_SIZE", 10):
+            with mock.patch.object(
+                DB, "set_add_many", autospec=True, side_effect=DB.set_add_many
+            ) as set_add_many:
+                self.sbackup("-l", "local", str(self.source))
+
+        self.assertGreater(set_add_many.call_count, 1)
+        saved = [
+            m for call in set_add_many.call_args_list for m in call.args[2]
+        ]
+        self.assertEqual(len(saved), len(self.files))
+
+
+if __name__ == "__main__":
+    unittest.main()
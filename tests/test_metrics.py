@@ -0,0 +1,116 @@
+import unittest
+import urllib.request
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import METRICS_BUCKETS, Metrics
+from tests.base import SafeBackupTestCase
+
+
+def samples(text):
+    """Return {sample name with labels: value} of a Prometheus text."""
+
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in text.splitlines()
+        if line and not line.startswith("#")
+    }
+
+
+class MetricsTest(unittest.TestCase):
+    def test_nothing_is_recorded_until_enabled(self):
+        metrics = Metrics()
+        metrics.inc("sbackup_errors_total", type="transfer")
+        metrics.observe("sbackup_db_operation_seconds", 1, method="claim")
+        metrics.set_function("sbackup_workers", lambda: 4)
+
+        self.assertEqual(metrics.render(), "\n")
+
+    def test_renders_counters_gauges_and_histograms(self):
+        metrics = Metrics()
+        metrics.enable()
+        metrics.inc("sbackup_errors_total", type='s3:"Slow"\nDown')
+        metrics.inc("sbackup_errors_total", 2, type='s3:"Slow"\nDown')
+        metrics.set_function("sbackup_workers", lambda: 4)
+        metrics.observe("sbackup_db_operation_seconds", 0.02, method="ack")
+        metrics.observe("sbackup_db_operation_seconds", 30, method="ack")
+
+        text = metrics.render()
+
+        self.assertIn("# TYPE sbackup_errors_total counter\n", text)
+        self.assertIn("# TYPE sbackup_workers gauge\n", text)
+        values = samples(text)
+        self.assertEqual(
+            values['sbackup_errors_total{type="s3:\\"Slow\\"\\nDown"}'], 3
+        )
+        self.assertEqual(values["sbackup_workers"], 4)
+        name = "sbackup_db_operation_seconds"
+        for bound in METRICS_BUCKETS:
+            self.assertEqual(
+                values[f'{name}_bucket{{method="ack",le="{bound}"}}'],
+                0 if bound < 0.02 else 1,
+            )
+        self.assertEqual(values[f'{name}_bucket{{method="ack",le="+Inf"}}'], 2)
+        self.assertEqual(values[f'{name}_count{{method="ack"}}'], 2)
+        self.assertEqual(values[f'{name}_sum{{method="ack"}}'], 30.02)
+
+    def test_serves_over_http(self):
+        metrics = Metrics()
+        metrics.enable()
+        metrics.inc("sbackup_listed_objects_total", 7, source="s3")
+        server = metrics.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+
+        self.assertEqual(body, metrics.render())
+
+
+class MetricsFileTest(SafeBackupTestCase):
+    def test_run_writes_its_metrics_file(self):
+        files = {f"f{i}": b"x" * 100 for i in range(4)}
+        source = self.make_tree("source", files)
+        path = self.tmp / "metrics.prom"
+        # A CreateBucket body would count as uploaded bytes too.
+        self.make_bucket("dst")
+
+        self.sbackup("-l", "local", str(source))
+        status, _ = self.sbackup(
+            "--metrics-file", str(path), "-d", f"local:{source}", "s3:dst"
+        )
+
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            [p.name for p in self.tmp.iterdir() if "metrics" in p.name],
+            ["metrics.prom"],
+        )
+        values = samples(path.read_text())
+        self.assertEqual(
+            values['sbackup_transferred_objects_total{destination="s3"}'], 4
+        )
+        self.assertEqual(
+            values['sbackup_transferred_bytes_total{path="upload"}'], 400
+        )
+        self.assertEqual(
+            values['sbackup_s3_request_seconds_count{operation="PutObject"}'],
+            4,
+        )
+        self.assertGreater(
+            values['sbackup_db_operation_seconds_count{method="claim"}'], 0
+        )
+        self.assertNotIn("sbackup_listed_objects_total", path.read_text())
+
+    def test_run_without_metrics_records_nothing(self):
+        source = self.make_tree("source", {"f": b"x"})
+
+        self.sbackup("-l", "local", str(source))
+
+        self.assertFalse(safe_backup.METRICS.enabled)
+        self.assertEqual(safe_backup.METRICS.render(), "\n")
+        self.assertNotIn("wrapper_timed", repr(vars(safe_backup.DB)))
+
+
+if __name__ == "__main__":
+    unittest.main()
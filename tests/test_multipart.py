@@ -0,0 +1,98 @@
+import argparse
+import os
+import unittest
+
+from parameterized import parameterized
+
+from safe_backup.safe_backup import parse_size
+from tests.base import SafeBackupTestCase
+
+MIB = 1024**2
+
+
+class ParseSizeTest(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ("1024", 1024),
+            ("8MB", 8 * 1000**2),
+            ("64MiB", 64 * MIB),
+            (" 2 kib ", 2048),
+            ("1GB", 1000**3),
+        ]
+    )
+    def test_parses(self, text, size):
+        self.assertEqual(parse_size(text), size)
+
+    @parameterized.expand([("",), ("8XB",), ("-1",), ("1.5MiB",)])
+    def test_rejects(self, text):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_size(text)
+
+
+class MultipartTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(12 * MIB + 5)
+
+    def test_upload_uses_the_given_part_size(self):
+        source = self.make_tree("source", {"big": self.data})
+
+        status, _ = self.sbackup(
+            "--multipart-threshold",
+            "5MiB",
+            "--multipart-chunksize",
+            "5MiB",
+            "-c",
+            "local",
+            str(source),
+            "s3:dst",
+        )
+
+        self.assertEqual(status, 0)
+        head = self.s3.head_object(Bucket="dst", Key="source/big")
+        self.assertTrue(head["ETag"].endswith('-3"'))
+        self.assertEqual(self.read_bucket("dst"), {"source/big": self.data})
+
+    def test_small_files_stay_single_part(self):
+        source = self.make_tree("source", {"big": self.data})
+
+        self.sbackup(
+            "--multipart-threshold",
+            "64MiB",
+            "-c",
+            "local",
+            str(source),
+            "s3:dst",
+        )
+
+        head = self.s3.head_object(Bucket="dst", Key="source/big")
+        self.assertNotIn("-", head["ETag"])
+
+    def test_s3_copy_of_a_large_object_copies_parts(self):
+        self.make_bucket("src", {"big": self.data, "small": b"small"})
+        self.sbackup("-l", "s3", "src")
+
+        with self.s3_calls() as calls:
+            status, _ = self.sbackup(
+                "--multipart-threshold",
+                "5MiB",
+                "--multipart-chunksize",
+                "5MiB",
+                "-d",
+                "s3:src",
+                "s3:dst",
+            )
+
+        self.assertEqual(status, 0)
+        self.assertEqual(calls["UploadPartCopy"], 3)
+        self.assertEqual(calls["CopyObject"], 1)
+        self.assertEqual(calls["GetObject"], 0)
+        self.assertEqual(
+            self.read_bucket("dst"), {"big": self.data, "small": b"small"}
+        )
+        head = self.s3.head_object(Bucket="dst", Key="big")
+        self.assertTrue(head["ETag"].endswith('-3"'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+import io
+import json
+import os
+import tarfile
+import unittest
+from unittest import mock
+
+import botocore.client
+from botocore.exceptions import ClientError
+from parameterized import parameterized
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import SafeBackup
+from tests.base import SafeBackupTestCase
+
+
+class PackTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.small = {
+            f"small/file{i:02}": b"%03d" % i * 100 for i in range(30)
+        }
+        self.large = {"large": b"L" * 2048}
+        self.source = self.make_tree("source", {**self.small, **self.large})
+
+    def backup(self, *options):
+        return self.sbackup(
+            "--pack",
+            "4KiB",
+            "--pack-threshold",
+            "1KiB",
+            *options,
+            "-c",
+            "local",
+            str(self.source),
+            "s3:dst",
+        )
+
+    def test_packs_small_files_into_tar_archives(self):
+        status, _ = self.backup()
+
+        self.assertEqual(status, 0)
+        objects = self.read_bucket("dst")
+        self.assertEqual(objects.pop("source/large"), self.large["large"])
+        self.assertTrue(objects)
+        self.assertLess(len(objects), len(self.small) // 5)
+        packed = {}
+        for key, data in objects.items():
+            self.assertTrue(key.startswith(safe_backup.PACK_PREFIX))
+            with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                for info in tar.getmembers():
+                    packed[info.name] = tar.extractfile(info).read()
+        self.assertEqual(
+            packed, {f"source/{m}": data for m, data in self.small.items()}
+        )
+
+    def test_indexes_every_packed_file(self):
+        self.backup()
+
+        index = self.db().hgetall("s3:dst-pack_index_sbackup")
+        self.assertEqual(set(index), {f"source/{m}" for m in self.small})
+        archive, offset, length, codec = json.loads(
+            index["source/small/file07"]
+        )
+        data = self.s3.get_object(
+            Bucket="dst",
+            Key=archive,
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )["Body"].read()
+        self.assertEqual(data, self.small["small/file07"])
+        self.assertEqual(codec, "none")
+        self.assertEqual(self.db().keys("*claimed_sbackup"), [])
+
+    @parameterized.expand([("none",), ("zstd",)])
+    def test_restores_one_packed_file(self, codec):
+        if codec == "zstd" and safe_backup.zstandard is None:
+            self.skipTest("zstandard is not installed")
+        self.backup("--pack-compress", codec)
+        dest = self.tmp / "restore"
+        dest.mkdir()
+
+        status, _ = self.sbackup(
+            "-u", "s3:dst", "source/small/file11", str(dest)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            self.read_tree(dest),
+            {"source/small/file11": self.small["small/file11"]},
+        )
+
+    def test_unknown_member_is_an_error(self):
+        self.backup()
+        dest = self.tmp / "restore"
+        dest.mkdir()
+
+        with self.assertRaises(SystemExit):
+            self.sbackup("-u", "s3:dst", "source/large", str(dest))
+
+    def test_a_file_gone_before_its_pack_fails_alone(self):
+        pack_upload = SafeBackup._SafeBackup__pack_upload
+        gone = []
+
+        def remove_first(state, bucket, pack):
+            if not gone:
+                member, path = pack[0]
+                os.remove(path)
+                gone.append(member)
+            return pack_upload(state, bucket, pack)
+
+        with mock.patch.object(
+            SafeBackup, "_SafeBackup__pack_upload", remove_first
+        ):
+            status, output = self.backup()
+
+        self.assertIn("Transferred 30 files", output)
+        self.assertIn("1 files failed and remain", output)
+        self.assertEqual(self.members(f"local:{self.source}"), set(gone))
+        index = self.db().hgetall("s3:dst-pack_index_sbackup")
+        self.assertEqual(
+            set(index), {f"source/{m}" for m in self.small} - set(gone)
+        )
+        self.assertEqual(self.db().keys("*claimed_sbackup"), [])
+
+    def test_a_failed_pack_upload_requeues_its_members(self):
+        make_api_call = botocore.client.BaseClient._make_api_call
+
+        def failing(client, operation_name, api_params):
+            if operation_name == "PutObject" and api_params["Key"].startswith(
+                safe_backup.PACK_PREFIX
+            ):
+                raise ClientError(
+                    {"Error": {"Code": "InternalError"}}, operation_name
+                )
+            return make_api_call(client, operation_name, api_params)
+
+        with mock.patch.object(
+            botocore.client.BaseClient, "_make_api_call", failing
+        ):
+            status, output = self.backup()
+
+        self.assertIn("Transferred 1 files", output)
+        self.assertIn("30 files failed and remain", output)
+        self.assertEqual(
+            self.members(f"local:{self.source}"),
+            {f"source/{m}" for m in self.small},
+        )
+        self.assertEqual(self.db().keys("*claimed_sbackup"), [])
+        self.assertEqual(self.db().hgetall("s3:dst-pack_index_sbackup"), {})
+
+        # The next run packs what is left.
+        status, output = self.sbackup(
+            "--pack",
+            "4KiB",
+            "--pack-threshold",
+            "1KiB",
+            "-d",
+            f"local:{self.source}",
+            "s3:dst",
+        )
+        self.assertIn("Transferred 30 files", output)
+        self.assertEqual(self.members(f"local:{self.source}"), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
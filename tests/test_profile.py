@@ -0,0 +1,93 @@
+import pstats
+import unittest
+from unittest import mock
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import Profiler
+from tests.base import SafeBackupTestCase
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_stage_is_a_no_op_until_enabled(self):
+        profiler = Profiler()
+
+        with profiler.stage("list"):
+            pass
+
+        self.assertEqual(profiler._tables, [])
+
+    def test_nested_calls_of_a_stage_count_once(self):
+        profiler = Profiler()
+        profiler.enable()
+
+        with profiler.stage("transfer"):
+            with profiler.stage("transfer"):
+                pass
+        with profiler.stage("transfer"):
+            pass
+
+        (table,) = profiler._tables
+        self.assertEqual(table["stages"]["transfer"][0], 2)
+
+    def test_wrapped_methods_are_timed_in_their_stage(self):
+        profiler = Profiler()
+        profiler.enable()
+
+        def save_files_list_in_db(value):
+            return value * 2
+
+        wrapped = profiler.wrap(save_files_list_in_db, "SafeBackup.save")
+        self.assertEqual([wrapped(i) for i in range(3)], [0, 2, 4])
+
+        lines = profiler.lines()
+        self.assertRegex(lines[0], r"^Profile of \S+s wall and \S+s CPU")
+        (stage,) = [line for line in lines if line.startswith("list ")]
+        self.assertEqual(stage.split()[1], "3")
+        (method,) = [line for line in lines if "SafeBackup.save" in line]
+        self.assertEqual(method.split()[1], "3")
+
+
+class ProfileOptionTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        files = {f"dir{i % 3}/f{i}": b"x" * i for i in range(30)}
+        self.source = self.make_tree("source", files)
+
+    def test_profile_prints_stages_and_methods(self):
+        status, output = self.sbackup(
+            "--profile", "-l", "local", str(self.source)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn(" Profile of ", output)
+        self.assertRegex(output, r"\n list +\d+ ")
+        self.assertRegex(output, r"\n SafeBackup\.save_files_list_in_db +1 ")
+        self.assertRegex(output, r"\n DB\.\w+ +\d+ ")
+
+    def test_profile_stats_and_stacks_are_saved(self):
+        stats = self.tmp / "run.pstats"
+        stacks = self.tmp / "run.folded"
+
+        with mock.patch.object(safe_backup, "PROFILE_SAMPLE_INTERVAL", 0.001):
+            status, output = self.sbackup(
+                "--profile-stats",
+                str(stats),
+                "--profile-stacks",
+                str(stacks),
+                "-l",
+                "local",
+                str(self.source),
+            )
+
+        self.assertEqual(status, 0)
+        self.assertIn(" Profile of ", output)
+        functions = {name for _, _, name in pstats.Stats(str(stats)).stats}
+        self.assertIn("save_files_list_in_db", functions)
+        samples = stacks.read_text().splitlines()
+        self.assertTrue(samples)
+        for line in samples:
+            self.assertRegex(line, r"^[\w-]+(;[\w.<>]+:[\w.<>]+)* \d+$")
+
+
+if __name__ == "__main__":
+    unittest.main()
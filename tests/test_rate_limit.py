@@ -0,0 +1,158 @@
+import types
+import unittest
+from unittest import mock
+
+from parameterized import parameterized_class
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import DB, RateLimiter, TokenBucket
+from tests.base import SafeBackupTestCase
+
+
+class Clock:
+    """Stand-in for the time module whose sleeps only move it forward."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(
+            safe_backup,
+            "time",
+            types.SimpleNamespace(
+                monotonic=self.clock.monotonic, sleep=self.clock.sleep
+            ),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def slowdown():
+    return (types.SimpleNamespace(status_code=503), {"Error": {}})
+
+
+class TokenBucketTest(ClockTestCase):
+    def test_zero_rate_is_unlimited(self):
+        bucket = TokenBucket()
+        for _ in range(1000):
+            bucket.take(1024**3)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_takes_wait_for_the_rate(self):
+        bucket = TokenBucket(100)
+        for _ in range(10):
+            bucket.take(50)
+        # The first take is free, the other 450 tokens come at 100/s.
+        self.assertAlmostEqual(self.clock.slept, 4.5)
+
+    def test_burst_is_at_most_one_second(self):
+        bucket = TokenBucket(100)
+        self.clock.now += 60
+        for _ in range(4):
+            bucket.take(50)
+        self.assertAlmostEqual(self.clock.slept, 0.5)
+
+
+class RateLimiterTest(ClockTestCase):
+    def test_polls_the_limits_at_most_every_interval(self):
+        limits = {"bandwidth": "1MiB", "requests": "50"}
+        poll = mock.Mock(return_value=limits)
+        limiter = RateLimiter(poll=poll)
+        request = types.SimpleNamespace(headers={})
+
+        limiter.before_send(request)
+        limiter.before_send(request)
+
+        self.assertEqual(poll.call_count, 1)
+        self.assertEqual(limiter.bytes_bucket.rate, 1024**2)
+        self.assertEqual(limiter.requests_bucket.rate, 50)
+
+        limits["requests"] = "oops"
+        self.clock.now += safe_backup.LIMITS_POLL_INTERVAL
+        limiter.before_send(request)
+        self.assertEqual(poll.call_count, 2)
+        self.assertEqual(limiter.requests_bucket.rate, 50)
+
+    def test_takes_the_bytes_of_a_request(self):
+        limiter = RateLimiter(bandwidth=1000)
+        for _ in range(3):
+            limiter.before_send(
+                types.SimpleNamespace(headers={"Content-Length": "1000"})
+            )
+        self.assertAlmostEqual(self.clock.slept, 2)
+
+    def test_slowdown_halves_the_rate_and_recovers(self):
+        limiter = RateLimiter(requests=100)
+
+        limiter.needs_retry(response=slowdown())
+
+        self.assertEqual(limiter.slowdowns, 1)
+        self.assertEqual(limiter.requests_bucket.rate, 50)
+        self.assertGreater(limiter._paused_until, self.clock.now)
+        request = types.SimpleNamespace(headers={})
+        for _ in range(10):
+            self.clock.now += 1
+            limiter.before_send(request)
+        self.assertEqual(limiter.requests_bucket.rate, 100)
+
+    def test_ignores_other_errors(self):
+        limiter = RateLimiter(requests=100)
+        response = (
+            types.SimpleNamespace(status_code=404),
+            {"Error": {"Code": "NoSuchKey"}},
+        )
+
+        limiter.needs_retry(response=response)
+
+        self.assertEqual(limiter.slowdowns, 0)
+        self.assertEqual(limiter.requests_bucket.rate, 100)
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class RuntimeLimitsTest(SafeBackupTestCase):
+    def test_limits_are_read_from_db(self):
+        state = self.state(bandwidth_limit=1000, request_limit=10)
+        DB.hash_set(state, safe_backup.LIMITS_KEY, "requests", "25")
+
+        state.limiter._refresh(safe_backup.time.monotonic())
+
+        self.assertEqual(state.limiter.requests_bucket.rate, 25)
+        self.assertEqual(state.limiter.bytes_bucket.rate, 1000)
+
+    def test_every_s3_request_goes_through_the_limiter(self):
+        source = self.make_tree("source", {f"f{i}": b"x" for i in range(5)})
+        before_send = RateLimiter.before_send
+        sent = []
+
+        def counted(limiter, request, **kwargs):
+            sent.append(request)
+            return before_send(limiter, request, **kwargs)
+
+        with mock.patch.object(RateLimiter, "before_send", counted):
+            with self.s3_calls() as calls:
+                status, _ = self.sbackup(
+                    "--request-limit",
+                    "1000",
+                    "-c",
+                    "local",
+                    str(source),
+                    "s3:dst",
+                )
+
+        self.assertEqual(status, 0)
+        self.assertEqual(len(sent), sum(calls.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
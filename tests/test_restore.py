@@ -0,0 +1,163 @@
+import os
+import unittest
+from unittest import mock
+
+from safe_backup import safe_backup
+from tests.base import SafeBackupTestCase
+
+MIB = 1024**2
+
+
+class RestoreTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.objects = {
+            "logs/a.log": b"a" * 300,
+            "logs/b.log": b"b" * 100,
+            "db/dump.sql": b"d" * 200,
+            "db/schema.sql": b"s" * 50,
+            "etc/hosts": b"h" * 400,
+        }
+        self.make_bucket("backup", self.objects)
+        self.dest = self.tmp / "dest"
+        self.dest.mkdir()
+
+    def restore(self, *options):
+        """Restore with one worker and return the members in order."""
+
+        order = []
+        restore_member = safe_backup.SafeBackup._SafeBackup__restore_member
+
+        def recorded(state, bucket, member, kind, destination):
+            order.append(member)
+            return restore_member(state, bucket, member, kind, destination)
+
+        with mock.patch.object(
+            safe_backup.SafeBackup, "_SafeBackup__restore_member", recorded
+        ):
+            status, output = self.sbackup(
+                "--workers", "1", *options, "-r", "s3:backup", str(self.dest)
+            )
+        self.assertEqual(status, 0)
+        self.assertIn("The first file was restored after", output)
+        self.assertEqual(
+            self.read_tree(self.dest),
+            {member: self.objects[member] for member in order},
+        )
+        return order
+
+    def test_restores_everything_by_default(self):
+        order = self.restore()
+
+        self.assertEqual(sorted(order), sorted(self.objects))
+
+    def test_listed_paths_come_first_in_their_order(self):
+        order = self.restore(
+            "--path", "/etc/hosts", "db", "--prefix", "logs/a"
+        )
+
+        self.assertEqual(
+            order, ["etc/hosts", "db/dump.sql", "db/schema.sql", "logs/a.log"]
+        )
+
+    def test_smallest_files_come_first(self):
+        order = self.restore("--prefix", "db/", "logs/", "--order", "smallest")
+
+        self.assertEqual(
+            order, ["db/schema.sql", "logs/b.log", "db/dump.sql", "logs/a.log"]
+        )
+
+    def test_filters_only_go_with_restores(self):
+        with self.assertRaises(SystemExit):
+            self.sbackup("--path", "db", "-l", "s3", "backup")
+
+    def test_needs_a_local_directory(self):
+        with self.assertRaises(SystemExit):
+            self.sbackup("-r", "s3:backup", str(self.tmp / "missing"))
+
+
+class LargeRestoreTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(11 * MIB)
+        self.make_bucket("backup", {"big": self.data, "small": b"small"})
+        self.dest = self.tmp / "dest"
+        self.dest.mkdir()
+
+    def restore(self):
+        return self.sbackup(
+            "--multipart-threshold",
+            "5MiB",
+            "--multipart-chunksize",
+            "5MiB",
+            "-r",
+            "s3:backup",
+            str(self.dest),
+        )
+
+    def test_large_objects_are_fetched_in_ranges(self):
+        with self.s3_calls() as calls:
+            status, _ = self.restore()
+
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            self.read_tree(self.dest), {"big": self.data, "small": b"small"}
+        )
+        # Three ranges of the large object and one GET of the small one.
+        self.assertEqual(calls["GetObject"], 4)
+
+    def test_a_range_that_breaks_off_is_fetched_again(self):
+        with self.cut_downloads(1) as left:
+            with self.s3_calls() as calls:
+                status, _ = self.restore()
+
+        self.assertEqual(status, 0)
+        self.assertEqual(left, [0])
+        self.assertEqual(calls["GetObject"], 5)
+        self.assertEqual(
+            self.read_tree(self.dest), {"big": self.data, "small": b"small"}
+        )
+
+    def test_a_failed_download_leaves_no_file(self):
+        with self.cut_downloads(100):
+            status, output = self.restore()
+
+        self.assertEqual(status, 1)
+        self.assertIn("big could not be restored!", output)
+        self.assertNotIn("big", os.listdir(self.dest))
+        self.assertFalse(
+            [name for name in os.listdir(self.dest) if "sbackup" in name]
+        )
+
+
+class PackedRestoreTest(SafeBackupTestCase):
+    def test_restores_packed_and_deduplicated_files(self):
+        small = {f"small/f{i}": b"%02d" % i * 50 for i in range(10)}
+        large = {"large": os.urandom(64 * 1024)}
+        packed = self.make_tree("packed", small)
+        self.sbackup(
+            "--pack",
+            "4KiB",
+            "--pack-threshold",
+            "1KiB",
+            "-c",
+            "local",
+            str(packed),
+            "s3:dst",
+        )
+        kept = self.make_tree("kept", large)
+        options = ["--dedup"] if safe_backup.fastcdc_cy is not None else []
+        self.sbackup(*options, "-c", "local", str(kept), "s3:dst")
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        status, output = self.sbackup("-r", "s3:dst", str(dest))
+
+        self.assertEqual(status, 0)
+        self.assertIn("Selected 11 files", output)
+        self.assertEqual(self.read_tree(dest / "packed"), small)
+        self.assertEqual(self.read_tree(dest / "kept"), large)
+
+
+if __name__ == "__main__":
+    unittest.main()
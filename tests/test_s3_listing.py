@@ -0,0 +1,42 @@
+import unittest
+from unittest import mock
+
+from parameterized import parameterized_class
+
+from safe_backup.safe_backup import DB
+from tests.base import SafeBackupTestCase
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class S3ListingTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.keys = [f"dir{i % 3}/key{i:03}" for i in range(23)]
+        self.make_bucket("source", {key: b"data" for key in self.keys})
+
+    def test_saves_every_key(self):
+        status, output = self.sbackup("-l", "s3", "source")
+
+        self.assertEqual(status, 0)
+        self.assertIn("db_key = 's3:source'", output)
+        self.assertEqual(self.members("s3:source"), set(self.keys))
+
+    def test_one_pipelined_write_per_page(self):
+        with mock.patch.object(
+            DB, "set_add_many", autospec=True, side_effect=DB.set_add_many
+        ) as set_add_many:
+            self.sbackup("-l", "s3", "source", "--page-size", "5")
+
+        self.assertEqual(set_add_many.call_count, 5)
+        pages = [call.args[2] for call in set_add_many.call_args_list]
+        self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 3])
+        self.assertEqual(sorted(sum(pages, [])), sorted(self.keys))
+
+    def test_marker_is_dropped_when_done(self):
+        self.sbackup("-l", "s3", "source", "--page-size", "5")
+
+        self.assertEqual(self.db().keys("*marker_sbackup"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
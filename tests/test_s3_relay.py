@@ -0,0 +1,135 @@
+import io
+import os
+import unittest
+from unittest import mock
+
+import boto3.s3.transfer
+import botocore.client
+import botocore.exceptions
+from parameterized import parameterized
+
+from tests.base import SafeBackupTestCase
+
+MIB = 1024**2
+
+
+class S3RelayTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.big = os.urandom(11 * MIB)
+        self.make_bucket("src")
+        self.s3.put_object(
+            Bucket="src",
+            Key="small",
+            Body=b"small",
+            ContentType="text/plain",
+            Metadata={"owner": "ops"},
+        )
+        self.s3.put_object(
+            Bucket="src",
+            Key="big",
+            Body=self.big,
+            ContentType="application/x-tar",
+            Metadata={"owner": "ops"},
+        )
+        self.sbackup("-l", "s3", "src")
+
+    def copy(self, *options):
+        with self.s3_calls() as calls:
+            status, _ = self.sbackup(
+                "--multipart-threshold",
+                "5MiB",
+                "--multipart-chunksize",
+                "5MiB",
+                *options,
+                "-d",
+                "s3:src",
+                "s3:dst",
+            )
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            self.read_bucket("dst"), {"small": b"small", "big": self.big}
+        )
+        for key in ("small", "big"):
+            source = self.s3.head_object(Bucket="src", Key=key)
+            copy = self.s3.head_object(Bucket="dst", Key=key)
+            self.assertEqual(copy["ContentType"], source["ContentType"])
+            self.assertEqual(copy["Metadata"], {"owner": "ops"})
+        return calls
+
+    def test_same_account_copies_server_side(self):
+        calls = self.copy()
+
+        self.assertEqual(calls["CopyObject"], 1)
+        self.assertEqual(calls["UploadPartCopy"], 3)
+        self.assertEqual(calls["GetObject"], 0)
+        self.assertEqual(calls["PutObject"], 0)
+        self.assertEqual(calls["UploadPart"], 0)
+
+    def test_other_account_relays_through_this_host(self):
+        with mock.patch.dict(
+            os.environ, {"SBACKUP_DEST_AWS_ACCESS_KEY_ID": "other"}
+        ):
+            calls = self.copy()
+
+        self.assertEqual(calls["CopyObject"], 0)
+        self.assertEqual(calls["UploadPartCopy"], 0)
+        # One GET of the small object and one ranged GET per part.
+        self.assertEqual(calls["GetObject"], 4)
+        self.assertEqual(calls["PutObject"], 1)
+        self.assertEqual(calls["UploadPart"], 3)
+
+    @parameterized.expand([("same",), ("other",)])
+    def test_checksum_compares_the_etags_of_copies(self, account):
+        config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=5 * MIB, multipart_chunksize=5 * MIB
+        )
+        self.s3.upload_fileobj(
+            io.BytesIO(self.big), "src", "parts", Config=config
+        )
+        self.sbackup("-l", "s3", "src")
+        env = {"SBACKUP_DEST_AWS_ACCESS_KEY_ID": account}
+        if account == "same":
+            env = {}
+
+        with mock.patch.dict(os.environ, env):
+            status, output = self.sbackup(
+                "--checksum", "-d", "s3:src", "s3:dst"
+            )
+            self.assertEqual(status, 0)
+            status, verified = self.sbackup("--verify", "s3:dst")
+
+        # The copy of parts is made in the parts of its source.
+        source = self.s3.head_object(Bucket="src", Key="parts")
+        copy = self.s3.head_object(Bucket="dst", Key="parts")
+        self.assertEqual(copy["ETag"], source["ETag"])
+        self.assertTrue(copy["ETag"].endswith('-3"'))
+        self.assertEqual(self.read_bucket("dst", "parts"), {"parts": self.big})
+        # big has the MD5 of one PUT, its copy in parts is not checked.
+        self.assertIn("The copy of big in parts is not verified.", output)
+        records = self.db().hgetall("s3:dst-checksums_sbackup")
+        self.assertEqual(set(records), {"small", "parts"})
+        self.assertEqual(status, 0)
+        self.assertIn("Verified 2 files", verified)
+
+    def test_copy_errors_fail_the_member(self):
+        make_api_call = botocore.client.BaseClient._make_api_call
+
+        def broken(client, operation_name, api_params):
+            if operation_name == "CopyObject":
+                raise botocore.exceptions.ConnectionClosedError(
+                    endpoint_url="https://s3.amazonaws.com"
+                )
+            return make_api_call(client, operation_name, api_params)
+
+        with mock.patch.object(
+            botocore.client.BaseClient, "_make_api_call", broken
+        ):
+            status, output = self.sbackup("-d", "s3:src", "s3:dst")
+
+        self.assertIn("1 files failed and remain", output)
+        self.assertEqual(self.members("s3:src"), {"small"})
+
+
+if __name__ == "__main__":
+    unittest.main()
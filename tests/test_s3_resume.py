@@ -0,0 +1,36 @@
+import unittest
+
+from parameterized import parameterized_class
+
+from tests.base import SafeBackupTestCase
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class S3ResumeTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.keys = [f"key{i:02}" for i in range(23)]
+        self.make_bucket("src", {key: b"data" for key in self.keys})
+
+    def test_lists_with_list_objects_v2(self):
+        with self.s3_calls() as calls:
+            self.sbackup("--page-size", "5", "-l", "s3", "src")
+
+        self.assertEqual(calls["ListObjectsV2"], 5)
+        self.assertEqual(calls["ListObjects"], 0)
+        self.assertEqual(self.members("s3:src"), set(self.keys))
+
+    def test_resumes_after_the_saved_marker(self):
+        self.db().set("s3:src-l__s3__src-marker_sbackup", "key10")
+
+        with self.s3_calls() as calls:
+            # Resuming happens when sbackup starts, before its command.
+            self.state(l=["s3", "src"], page_size=5)
+
+        self.assertEqual(self.members("s3:src"), set(self.keys[11:]))
+        self.assertEqual(calls["ListObjectsV2"], 3)
+        self.assertEqual(self.db().keys("*marker_sbackup"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import json
+import unittest
+
+from parameterized import parameterized, parameterized_class
+
+from tests.base import SafeBackupTestCase
+
+
+@parameterized_class(("backend",), [("redis",), ("sqlite",)])
+class S3ShardsTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.keys = [f"p{i % 4}/key{i:02}" for i in range(40)] + ["top"]
+        self.make_bucket("src", {key: b"data" for key in self.keys})
+
+    @parameterized.expand(
+        [("auto", "auto", 4), ("split_keys", "p1/key20,p2/key10", 3)]
+    )
+    def test_lists_every_key_once(self, _, shards, count):
+        status, output = self.sbackup(
+            "--shards", shards, "--page-size", "3", "-l", "s3", "src"
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn(f"Listed {len(self.keys)} keys", output)
+        self.assertIn(f"in {count} shards", output)
+        self.assertEqual(self.members("s3:src"), set(self.keys))
+        self.assertEqual(self.db().keys("*shards_sbackup"), [])
+
+    def test_resumes_only_unfinished_shards_after_their_marker(self):
+        shard = json.dumps(["p1/", "", ""])
+        self.db().hset("s3:src-l__s3__src-shards_sbackup", shard, "p1/key17")
+
+        # Resuming happens when sbackup starts, before its own command.
+        self.state(l=["s3", "src"])
+
+        resumed = {f"p1/key{i:02}" for i in range(21, 40, 4)}
+        self.assertEqual(self.members("s3:src"), resumed)
+        self.assertEqual(self.db().keys("*shards_sbackup"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
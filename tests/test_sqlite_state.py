@@ -0,0 +1,155 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+import fakeredis
+from parameterized import parameterized_class
+
+from safe_backup.safe_backup import DB, SQLiteState
+from tests.base import SafeBackupTestCase
+
+
+def sqlite_state(tmp):
+    return SQLiteState(str(tmp / "state.db"))
+
+
+def redis_state(tmp):
+    return fakeredis.FakeStrictRedis(
+        server=fakeredis.FakeServer(), decode_responses=True
+    )
+
+
+@parameterized_class(
+    ("name", "connect"),
+    [
+        ("redis", staticmethod(redis_state)),
+        ("sqlite", staticmethod(sqlite_state)),
+    ],
+)
+class StateCommandsTest(unittest.TestCase):
+    """The commands DB uses answer the same on SQLite as on redis."""
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix="sbackup-test-"))
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.db = self.connect(self.tmp)
+        # DB methods only need the client and the scan page size.
+        self.state = SimpleNamespace(db=self.db, db_scan_count=10)
+
+    def test_strings_and_keys(self):
+        self.db.set("a-marker_sbackup", "key")
+        self.db.sadd("b", "x")
+
+        self.assertEqual(self.db.get("a-marker_sbackup"), "key")
+        self.assertIsNone(self.db.get("missing"))
+        self.assertEqual(self.db.exists("a-marker_sbackup", "b", "c"), 2)
+        self.assertEqual(sorted(self.db.keys("*")), ["a-marker_sbackup", "b"])
+        self.assertEqual(
+            list(self.db.scan_iter("*_sbackup")), ["a-marker_sbackup"]
+        )
+        self.assertEqual(self.db.delete("a-marker_sbackup", "c"), 1)
+
+    def test_sets(self):
+        self.assertEqual(self.db.sadd("s", "a", "b", "c"), 3)
+        self.assertEqual(self.db.sadd("s", "a", "d"), 1)
+        self.assertEqual(self.db.srem("s", "a", "z"), 1)
+        self.assertEqual(self.db.scard("s"), 3)
+        self.assertTrue(self.db.sismember("s", "b"))
+        self.assertFalse(self.db.sismember("s", "a"))
+        self.assertTrue(self.db.smove("s", "t", "b"))
+        self.assertFalse(self.db.smove("s", "t", "b"))
+        self.assertEqual(self.db.sunionstore("u", "s", "t"), 3)
+        popped = self.db.spop("u", 2)
+        self.assertEqual(len(popped), 2)
+        self.assertEqual(self.db.scard("u"), 1)
+
+    def test_hashes(self):
+        self.db.hset("h", mapping={"a": "1", "b": "2"})
+        self.db.hset("h", "c", "3")
+
+        self.assertEqual(self.db.hget("h", "a"), "1")
+        self.assertEqual(self.db.hmget("h", ["a", "x", "c"]), ["1", None, "3"])
+        self.assertEqual(self.db.hdel("h", "a", "x"), 1)
+        self.assertEqual(self.db.hgetall("h"), {"b": "2", "c": "3"})
+
+    def test_lists(self):
+        self.db.rpush("l", "a", "b", "c")
+
+        self.assertEqual(self.db.lpop("l", 2), ["a", "b"])
+        self.assertEqual(self.db.blpop(["l"], timeout=1), ("l", "c"))
+        self.assertIsNone(self.db.lpop("l", 2))
+        self.assertIsNone(self.db.blpop(["l"], timeout=0.1))
+
+    def test_blpop_wakes_up_on_push(self):
+        threading.Timer(0.1, self.db.rpush, ("l", "late")).start()
+        start = time.monotonic()
+
+        self.assertEqual(self.db.blpop(["l"], timeout=5), ("l", "late"))
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_pipeline(self):
+        pipe = self.db.pipeline(transaction=True)
+        pipe.sadd("s", "a", "b")
+        pipe.set("m", "b")
+        pipe.hset("h", mapping={"a": "1"})
+
+        self.assertEqual(pipe.execute(), [2, True, 1])
+        self.assertEqual(self.db.get("m"), "b")
+
+    def test_claim_and_requeue(self):
+        self.db.sadd("set", *"abcdef")
+
+        claimed = DB.claim(self.state, "set", "claimed", count=4)
+        self.assertEqual(len(claimed), 4)
+        self.assertEqual(self.db.scard("set"), 2)
+        self.assertEqual(self.db.scard("claimed"), 4)
+        rest = sorted(set("abcdef") - set(claimed))
+        self.assertEqual(
+            DB.claim(self.state, "set", "claimed", members=[*rest, "z"]),
+            rest,
+        )
+        self.assertEqual(DB.claim(self.state, "set", "claimed", count=4), [])
+
+        DB.requeue(self.state, "set", "claimed", claimed[:1])
+        self.assertEqual(self.db.scard("set"), 1)
+        DB.ack(self.state, "claimed", claimed[1:3])
+        DB.requeue(self.state, "set", "claimed")
+        self.assertEqual(self.db.scard("set"), 4)
+        self.assertEqual(self.db.scard("claimed"), 0)
+
+
+class SQLiteStateTest(SafeBackupTestCase):
+    backend = "sqlite"
+
+    def test_a_failed_pipeline_changes_nothing(self):
+        db = self.db()
+        pipe = db.pipeline()
+        pipe.sadd("s", "a")
+        pipe.hset("h", mapping=None)
+        pipe.hget("h")
+
+        with self.assertRaises(TypeError):
+            pipe.execute()
+        self.assertEqual(db.scard("s"), 0)
+
+    def test_state_is_kept_between_runs(self):
+        source = self.make_tree("source", {"a": b"a", "b": b"b"})
+        self.sbackup("-l", "local", str(source))
+
+        db = SQLiteState(self.db_url.split("://", 1)[1])
+        self.assertEqual(db.scard(f"local:{source}"), 2)
+        dest = self.tmp / "dest"
+        dest.mkdir()
+        status, _ = self.sbackup("-d", f"local:{source}", str(dest))
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            self.read_tree(dest / "source"), {"a": b"a", "b": b"b"}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import logging
+import unittest
+
+from safe_backup import safe_backup
+from safe_backup.safe_backup import DB, SafeBackup, color_log
+from tests.base import SafeBackupTestCase
+
+
+class Exploding(str):
+    def __repr__(self):
+        raise AssertionError("formatted while the level is disabled")
+
+
+class TracingTest(SafeBackupTestCase):
+    def test_methods_stay_unwrapped_until_traced(self):
+        self.assertIn(DB, safe_backup._traced_classes)
+        self.assertIn(SafeBackup, safe_backup._traced_classes)
+        self.assertFalse(hasattr(DB.set_add_many, "__wrapped__"))
+
+        safe_backup.trace_methods(["set_add_many"])
+
+        self.assertTrue(hasattr(DB.set_add_many, "__wrapped__"))
+        self.assertFalse(hasattr(DB.set_add, "__wrapped__"))
+
+    def test_color_log_skips_disabled_levels(self):
+        logging.disable(logging.INFO)
+
+        color_log("debug", " *** %r", Exploding())
+        color_log("info", " *** %r", Exploding())
+
+    def test_traced_method_skips_formatting_when_disabled(self):
+        safe_backup.trace_methods(["set_contains"])
+        logging.disable(logging.INFO)
+        state = self.state()
+
+        self.assertFalse(DB.set_contains(state, "key", Exploding("member")))
+
+    def test_trace_logs_only_the_given_methods(self):
+        source = self.make_tree("source", {"file": b"data"})
+
+        with self.assertLogs(level="INFO") as logs:
+            self.sbackup("-l", "local", str(source), "--trace", "set_add_many")
+
+        calls = [line for line in logs.output if "Calling" in line]
+        self.assertTrue(calls)
+        self.assertTrue(all("set_add_many" in line for line in calls))
+
+
+class SQLiteTracingTest(SafeBackupTestCase):
+    backend = "sqlite"
+
+    def test_traces_a_run_on_sqlite(self):
+        source = self.make_tree("source", {"file": b"data"})
+
+        with self.assertLogs(level="INFO") as logs:
+            status, _ = self.sbackup("-L", "INFO", "-l", "local", str(source))
+
+        self.assertEqual(status, 0)
+        self.assertTrue(any("SQLiteState(" in line for line in logs.output))
+        self.assertFalse(
+            hasattr(safe_backup.SQLiteState.__repr__, "__wrapped__")
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
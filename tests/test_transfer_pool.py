@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from safe_backup.safe_backup import SafeBackup
+from tests.base import SafeBackupTestCase
+
+
+class TransferPoolTest(SafeBackupTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {f"dir{i % 4}/file{i:02}": b"x" * i for i in range(30)}
+        self.source = self.make_tree("source", self.files)
+
+    def test_copies_every_member_with_workers(self):
+        self.sbackup("-l", "local", str(self.source))
+        dest = self.tmp / "dest"
+        dest.mkdir()
+
+        status, output = self.sbackup(
+            "--workers", "4", "-d", f"local:{self.source}", str(dest)
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn("Transferred 30 files", output)
+        self.assertIn("with 4 workers", output)
+        self.assertEqual(self.read_tree(dest / "source"), self.files)
+        self.assertEqual(self.members(f"local:{self.source}"), set())
+
+    def test_bounds_concurrent_transfers(self):
+        self.sbackup("-l", "local", str(self.source))
+        dest = self.tmp / "dest"
+        dest.mkdir()
+        transfer = SafeBackup._SafeBackup__transfer_member
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def slow_transfer(*args):
+            with lock:
+                running.append(None)
+                peak.append(len(running))
+            time.sleep(0.01)
+            try:
+                return transfer(*args)
+            finally:
+                with lock:
+                    running.pop()
+
+        with mock.patch.object(
+            SafeBackup, "_SafeBackup__transfer_member", slow_transfer
+        ):
+            self.sbackup(
+                "--workers", "3", "-d", f"local:{self.source}", str(dest)
+            )
+
+        self.assertEqual(len(peak), 30)
+        self.assertLessEqual(max(peak), 3)
+        self.assertGreater(max(peak), 1)
+
+    def test_failed_s3_copy_stays_in_the_set(self):
+        self.make_bucket("src", {f"key{i}": b"data" for i in range(5)})
+        self.sbackup("-l", "s3", "src")
+        self.s3.delete_object(Bucket="src", Key="key3")
+
+        status, output = self.sbackup(
+            "--workers", "2", "-d", "s3:src", "s3:dst"
+        )
+
+        self.assertEqual(status, 0)
+        self.assertIn("1 files failed and remain in 's3:src'", output)
+        self.assertEqual(self.members("s3:src"), {"key3"})
+        self.assertEqual(
+            set(self.read_bucket("dst")), {"key0", "key1", "key2", "key4"}
+        )
+
+    def test_a_raising_member_is_requeued(self):
+        self.sbackup("-l", "local", str(self.source))
+        dest = self.tmp / "dest"
+        dest.mkdir()
+        transfer = SafeBackup._SafeBackup__transfer_member
+
+        def broken_transfer(state, db_key, source, destination, member):
+            if member == "source/dir1/file05":
+                raise RuntimeError("broken")
+            return transfer(state, db_key, source, destination, member)
+
+        with mock.patch.object(
+            SafeBackup, "_SafeBackup__transfer_member", broken_transfer
+        ):
+            status, output = self.sbackup(
+                "--workers", "4", "-d", f"local:{self.source}", str(dest)
+            )
+
+        self.assertIn("There was an error with source/dir1/file05", output)
+        self.assertIn("Transferred 29 files", output)
+        self.assertIn("1 files failed and remain", output)
+        self.assertEqual(
+            self.members(f"local:{self.source}"), {"source/dir1/file05"}
+        )
+        self.assertEqual(self.db().keys("*claimed_sbackup"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()